@@ -27,29 +27,18 @@ Input may be one of the following:
 - arXiv abstract page
 - arXiv identifier
 """
-import datetime
-import difflib
-import fnmatch
-import glob
-import logging
-import math
-import optparse
+# only what every mode needs is imported here; the rest (pyperclip,
+# http.client, subprocess, tempfile...) is imported where it is used,
+# keeping start-up fast (see --benchmark startup)
+import codecs
+import collections
 import os
-import pprint
 import re
-import socket
 import sys
-import tempfile
 import time
-import pyperclip # for copying text into the clipboard
 
-# cgi.parse_qs is deprecated since 2.6
-# but OS X 10.5 only has 2.5
-import cgi
-import urllib.request, urllib.error, urllib.parse
-import urllib.parse
-
-import subprocess as sp
+import urllib.error, urllib.parse
+import zlib
 
 #from html.parser import HTMLParser, HTMLParseError
 from html.parser import HTMLParser # https://github.com/stephenmcd/mezzanine/issues/1413
@@ -61,14 +50,39 @@ except ImportError:  # Python 3.5+
 
 from html.entities import name2codepoint
 
-# default timeout for url calls
-socket.setdefaulttimeout(30)
+
+class _LazyModule(object):
+    """Stands in for the module `name` until one of its attributes is
+    used: the module is imported then, and replaces this object as the
+    global of the same name."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = __import__(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+# importing logging costs as much as the rest of the start-up; the
+# daemon fast path of main() never needs it
+logging = _LazyModule('logging')
 
 VERSION = "3.2.0"
 
 
 def main():
     """Parse options and launch main loop"""
+    # fast path: plain article tokens go straight to a running daemon,
+    # without building the option parser or setting up logging
+    if not any(arg.startswith('-') for arg in sys.argv[1:]):
+        prefs = Preferences()
+        daemon = connect_daemon(prefs['daemon_socket'])
+        if daemon is not None:
+            process_articles(sys.argv[1:], prefs, daemon=daemon)
+            return
+
+    import optparse
     usage = """Usage: %prog [options] [article_token or pdf_directory]
 
 adsbibdesk helps you add astrophysics articles listed on NASA/ADS
@@ -105,6 +119,101 @@ updated if it has a new bibcode."""
         '-o', '--only_pdf',
         default=False, action='store_true',
         help="Download and open PDF for the selected [article_token].")
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs', default=4, type='int',
+        help="Number of article tokens resolved concurrently (default 4).")
+    parser.add_option(
+        '--output',
+        dest='output', default=None, metavar='FILE',
+        help="Write the entries to FILE instead of standard output.")
+    parser.add_option(
+        '--format',
+        dest='format', default='bibtex', choices=sorted(WRITERS),
+        help="Output format: %s (default bibtex)."
+             % ', '.join(sorted(WRITERS)))
+    parser.add_option(
+        '--clipboard',
+        dest='clipboard', default=None, action='store_true',
+        help="Copy the BibTeX entries to the clipboard. This is the"
+             " default unless --output is given or several tokens are"
+             " read from standard input.")
+    parser.add_option(
+        '--no-clipboard',
+        dest='clipboard', default=None, action='store_false',
+        help="Do not copy the BibTeX entries to the clipboard.")
+    parser.add_option(
+        '--bulk',
+        dest='bulk', default=False, action='store_true',
+        help="Fetch the BibTeX of bibcodes in bulk from the ADS export"
+             " API (see the ads_export_url and ads_token preferences);"
+             " other tokens, and bibcodes it misses, are resolved as"
+             " usual.")
+    parser.add_option(
+        '--journal',
+        dest='journal', default=None, metavar='FILE',
+        help="Record the outcome of each token in FILE, so that an"
+             " interrupted run can be picked up with --resume.")
+    parser.add_option(
+        '--resume',
+        dest='resume', default=None, metavar='FILE',
+        help="Continue the run recorded in the journal FILE: tokens"
+             " already resolved are taken from it, the others (including"
+             " those that failed) are resolved again.")
+    parser.add_option(
+        '--stream',
+        dest='stream', default=False, action='store_true',
+        help="Read tokens lazily, keep at most twice --jobs of them in"
+             " flight, and write one JSON line per token (index, token,"
+             " status, bibcode, timings, bibtex or error) as soon as it is"
+             " resolved, in completion order. For very long token lists;"
+             " the clipboard is not used.")
+    parser.add_option(
+        '--search',
+        dest='search', default=None, metavar='QUERY',
+        help="Print the papers resolved before whose title, authors or"
+             " abstract match QUERY (e.g. 'author:nemmen jet*'), from the"
+             " local index, without any network access.")
+    parser.add_option(
+        '--search-limit',
+        dest='search_limit', default=20, type='int', metavar='N',
+        help="Number of papers printed by --search (default 20).")
+    parser.add_option(
+        '--daemon',
+        dest='daemon', default=False, action='store_true',
+        help="Stay resident and resolve the tokens sent by later"
+             " invocations through a local socket (see daemon_socket).")
+    parser.add_option(
+        '--no-daemon',
+        dest='no_daemon', default=False, action='store_true',
+        help="Resolve the tokens in this process even if a daemon is"
+             " running.")
+    parser.add_option(
+        '--stop-daemon',
+        dest='stop_daemon', default=False, action='store_true',
+        help="Stop the running daemon.")
+    parser.add_option(
+        '--set',
+        dest='settings', default=[], action='append', metavar='KEY=VALUE',
+        help="Override a preference of ~/.adsbibdesk for this run; may be"
+             " repeated. ADSPASTE_<KEY> environment variables do the same"
+             " for every run.")
+    parser.add_option(
+        '--no-cache',
+        dest='no_cache', default=False, action='store_true',
+        help="Do not read or write the local response cache.")
+    parser.add_option(
+        '--refresh',
+        dest='refresh', default=False, action='store_true',
+        help="Ignore cached responses and fetch everything again.")
+    parser.add_option(
+        '--auto-mirror',
+        dest='auto_mirror', default=False, action='store_true',
+        help="Send requests to the fastest healthy ADS mirror.")
+    parser.add_option(
+        '--probe-mirrors',
+        dest='probe_mirrors', default=False, action='store_true',
+        help="Measure the latency of all ADS mirrors before starting.")
 
     pdf_ingest_group = optparse.OptionGroup(parser, "PDF Ingest Mode",
                                             description=None)
@@ -126,7 +235,8 @@ updated if it has a new bibcode."""
     arxiv_update_group.add_option(
         '-u', '--update_arxiv',
         default=False, action="store_true",
-        help='Check arXiv pre-prints for updated bibcodes')
+        help='Check the arXiv pre-prints of the BibTeX files given as'
+             ' arguments for refereed bibcodes, and update them in place')
     arxiv_update_group.add_option(
         '-f', '--from_date',
         help='MM/YY date of publication from which to start updating arXiv')
@@ -134,10 +244,56 @@ updated if it has a new bibcode."""
         '-t', '--to_date',
         help='MM/YY date of publication up to which update arXiv')
     parser.add_option_group(arxiv_update_group)
+
+    development_group = optparse.OptionGroup(parser, "Development",
+                                             description=None)
+    development_group.add_option(
+        '--benchmark',
+        dest='benchmark', default=None, metavar='NAME',
+        help="Run a benchmark from a source checkout and print the results"
+             " as JSON; its options follow the arguments after --"
+             " (see python -m benchmarks --help).")
+    development_group.add_option(
+        '--record-fixtures',
+        dest='record_fixtures', default=None, metavar='FILE',
+        help="Append every HTTP response of this run to FILE, for the"
+             " benchmarks.")
+    development_group.add_option(
+        '--trace',
+        dest='trace', default=None, metavar='FILE',
+        help="Record timing spans of every stage and HTTP request, and"
+             " write them to FILE when done.")
+    development_group.add_option(
+        '--trace-format',
+        dest='trace_format', default='json',
+        choices=sorted(TRACE_FORMATS),
+        help="Format of the --trace file: json (default), chrome"
+             " (trace-event file for chrome://tracing or Perfetto) or"
+             " prometheus (text exposition snapshot).")
+    parser.add_option_group(development_group)
     options, args = parser.parse_args()
+    if options.stream and options.bulk:
+        parser.error('--stream and --bulk cannot be combined')
+    if options.resume:
+        options.journal = options.resume
+    if options.benchmark or options.record_fixtures:
+        try:
+            import benchmarks
+        except ImportError:
+            parser.error('--benchmark and --record-fixtures need the'
+                         ' benchmarks package of a source checkout')
+    for name in ('from_date', 'to_date'):
+        try:
+            _month_stamp(getattr(options, name), None)
+        except ValueError:
+            parser.error('--%s: expected a MM/YY date, got %r'
+                         % (name, getattr(options, name)))
 
     # Get preferences from (optional) config file
-    prefs = Preferences()
+    try:
+        prefs = Preferences(parse_pref_overrides(options.settings))
+    except ValueError as err:
+        parser.error('--set: %s' % err)
     # inject options into preferences for later reference
     prefs['options'] = options.__dict__
     if options.debug:
@@ -159,23 +315,91 @@ updated if it has a new bibcode."""
     logging.debug("ADS Paste version %s" % VERSION)
     logging.debug("Python: %s", sys.version)
 
+    if options.stop_daemon:
+        stop_daemon(prefs['daemon_socket'])
+        return
+    # article tokens go to a running daemon when there is one
+    daemon = None
+    if not (options.daemon or options.no_daemon or options.benchmark or options.ingest_pdfs
+            or options.only_pdf or options.update_arxiv
+            or options.no_cache or options.refresh or options.trace
+            or options.record_fixtures or options.stream
+            or options.search):
+        daemon = connect_daemon(prefs['daemon_socket'])
+    if daemon is not None:
+        process_articles(args, prefs, jobs=options.jobs,
+                         output=options.output, fmt=options.format,
+                         clipboard=options.clipboard, bulk=options.bulk,
+                         daemon=daemon, journal=open_journal(options))
+        return
+
+    configure_http(prefs)
+    if options.record_fixtures:
+        from benchmarks.fixtures import FixtureRecorder
+        # responses must really be fetched to be recorded
+        options.refresh = True
+        get_http_client().recorder = FixtureRecorder(options.record_fixtures)
+    configure_cache(prefs)
+    configure_index(prefs)
+    configure_mirrors(prefs)
+    configure_arxiv_mirrors(prefs)
+    configure_tracing(prefs)
+
     # Launch the specific workflow
-    if options.ingest_pdfs:
+    if options.daemon:
+        serve_daemon(prefs['daemon_socket'], prefs)
+    elif options.benchmark:
+        from benchmarks.suite import main as run_benchmark
+        run_benchmark([options.benchmark] + args, prefs)
+    elif options.ingest_pdfs:
         ingest_pdfs(options, args, prefs)
     elif options.only_pdf:
         # short-circuit process_articles
         # since BibDesk is not needed
-        # FIXME smells like a refactor
-        process_token(args[0], prefs, None)
+        process_pdfs(args, prefs, jobs=options.jobs)
     elif options.update_arxiv:
-        update_arxiv(options, prefs)
+        update_arxiv(options, args, prefs)
+    elif options.stream:
+        process_stream(args, prefs, jobs=options.jobs, output=options.output)
+    elif options.search:
+        search_index(options.search, prefs, limit=options.search_limit,
+                     output=options.output, fmt=options.format)
     else:
-        process_articles(args, prefs)
-
-
-def process_articles(args, prefs, delay=15):
-    """Workflow for processing article tokens and running process_token()
-    to add the article to BibDesk.
+        process_articles(args, prefs, jobs=options.jobs,
+                         output=options.output, fmt=options.format,
+                         clipboard=options.clipboard, bulk=options.bulk,
+                         journal=open_journal(options))
+
+    # remember mirror latencies for the next run
+    if get_mirror_manager() is not None:
+        get_mirror_manager().save()
+    if options.trace:
+        get_tracer().export(options.trace, options.trace_format)
+        logging.info("Trace written to %s", options.trace)
+
+
+def process_articles(args, prefs, jobs=4, output=None, fmt='bibtex',
+                     clipboard=None, bulk=False, daemon=None, journal=None):
+    """Workflow for processing article tokens and running resolve_tokens()
+    to resolve them through a bounded pool of workers.
+
+    Entries are streamed, in the order of the input tokens, to `output`
+    (standard output by default) in the `fmt` format, see
+    :func:`open_writer`; with `clipboard` they are also copied, as
+    BibTeX, to the clipboard, which by default (`None`) is only done
+    without `output` and unless several tokens come from standard input,
+    as the entries are held in memory until the end. Tokens that fail
+    are reported at the end.
+    With `bulk`, bibcodes are first exported together, see
+    :func:`bulk_export`. With a `daemon` socket (see
+    :func:`connect_daemon`) the tokens are resolved by the daemon.
+
+    If the daemon dies midway, the tokens it has not answered yet are
+    resolved in this process instead.
+
+    With a :class:`Journal`, the outcome of each token is recorded as it
+    is written out; tokens the journal already has an entry for are not
+    resolved again, their entry is written from the journal instead.
     """
     # FIXME is there ever actually a case where args is None?
     if args:
@@ -184,45 +408,931 @@ def process_articles(args, prefs, delay=15):
         # Try to use standard input
         article_tokens = [s.strip() for s in sys.stdin.readlines()
                           if s.strip()]
+    if clipboard is None:
+        clipboard = output is None and (bool(args) or
+                                        len(article_tokens) <= 1)
+
+    completed = journal.completed() if journal is not None else {}
+    pending = [t for t in article_tokens if t not in completed]
+    if completed:
+        logging.info('Resuming: %d of %d tokens already resolved' %
+                     (len(article_tokens) - len(pending),
+                      len(article_tokens)))
+
+    writers = [open_writer(fmt, output)]
+    if clipboard:
+        # copies text to the clipboard for easy importing into
+        # whatever program you have
+        writers.append(ClipboardSink())
+    resolved = 0
+    failed = []
+    finished = False
+    taken = 0  # results taken from `results` so far
+    try:
+        if daemon is not None:
+            results = daemon_results(daemon, pending, jobs=jobs, bulk=bulk)
+        else:
+            results = resolve_tokens(pending, prefs, jobs=jobs, bulk=bulk)
+        for index, article_token in enumerate(article_tokens):
+            if article_token in completed:
+                result = TokenResult(index, article_token, entry=next(
+                    BibTex.iter_entries(completed[article_token]['bibtex'])))
+            else:
+                try:
+                    result = next(results)
+                except DaemonException as err:
+                    logging.warning('Daemon failed (%s): resolving the'
+                                    ' remaining tokens here' % err)
+                    configure_http(prefs)
+                    configure_cache(prefs)
+                    configure_index(prefs)
+                    configure_mirrors(prefs)
+                    configure_arxiv_mirrors(prefs)
+                    results = resolve_tokens(pending[taken:], prefs,
+                                             jobs=jobs, bulk=bulk)
+                    result = next(results)
+                taken += 1
+                result.index = index
+            if result.ok:
+                for writer in writers:
+                    writer.write(result.entry)
+                resolved += 1
+            else:
+                logging.error('%s failed - %s' % (result.token, result.error))
+                failed.append(result)
+            if journal is not None and article_token not in completed:
+                journal.record(result, output=output or '-')
+        finished = True
+    finally:
+        for writer in writers:
+            writer.close()
+        if journal is not None:
+            # a run that was cut short keeps its journal as it is
+            journal.close(compact=finished)
+
+    if len(article_tokens) > 1:
+        logging.info('Resolved %d of %d tokens' %
+                     (resolved, len(article_tokens)))
+    return failed
+
+
+def process_stream(args, prefs, jobs=4, output=None):
+    """Workflow for long token lists: tokens are read lazily (from
+    standard input when `args` is empty), resolved by :func:`stream_tokens`
+    and reported as JSON Lines on `output` (standard output by default)
+    as soon as each one is done, see :func:`stream_record`.
+
+    :return: the number of tokens that failed
+    """
+    import json
+    if args:
+        article_tokens = iter(args)
+    else:
+        article_tokens = (line.strip() for line in sys.stdin if line.strip())
+    stream = sys.stdout if output in (None, '-') \
+        else open(output, 'w', encoding='utf-8')
+    failed = 0
+    try:
+        results = stream_tokens(article_tokens, prefs, jobs=jobs)
+        for batch in results:
+            for result in batch:
+                if not result.ok:
+                    failed += 1
+                stream.write(json.dumps(stream_record(result),
+                                        ensure_ascii=False) + '\n')
+            # one flush per batch of results finished at the same time
+            stream.flush()
+    except BrokenPipeError:
+        # the reading end (`head`, say) is gone: stop quietly
+        results.close()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), stream.fileno())
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    return failed
+
+
+def stream_record(result):
+    """:return: the JSON-serializable dict reported by `--stream` for a
+    :class:`TokenResult`: its input position and token, ``status`` (``ok``
+    or ``error``), ``bibcode``, ``elapsed`` and per-stage ``timings`` in
+    seconds, and ``bibtex`` or ``error``"""
+    record = {'index': result.index,
+              'token': result.token,
+              'status': 'ok' if result.ok else 'error',
+              'bibcode': result.entry.bibcode if result.ok else None,
+              'elapsed': round(result.elapsed, 6),
+              'timings': dict((name, round(duration, 6))
+                              for name, duration in result.timings.items())}
+    if result.ok:
+        record['bibtex'] = result.bibtex
+    else:
+        record['error'] = str(result.error)
+    return record
 
-    # AppKit hook for BibDesk
-    #bibdesk = BibDesk()
 
-    for article_token in article_tokens:
+def process_pdfs(args, prefs, jobs=4):
+    """Workflow for downloading the PDF of each article token.
+
+    PDFs that arXiv is still generating are re-checked in the background
+    while the other tokens are processed; at the end we wait up to
+    `pdf_pending_wait` seconds for them and report those still pending.
+    """
+    article_tokens = list(args)
+    for result in resolve_tokens(article_tokens, prefs, jobs=jobs, pdf=True):
+        if result.ok:
+            print('%s: %s' % (result.token, result.pdf))
+        else:
+            logging.error('%s failed - %s' % (result.token, result.error))
+
+    scheduler = get_pdf_scheduler()
+    if scheduler.pending():
+        logging.info('Waiting for %d PDF(s) being generated by arXiv'
+                     % len(scheduler.pending()))
+        scheduler.wait(float(prefs['pdf_pending_wait']))
+    for label, pdf in sorted(scheduler.done.items()):
+        print('%s: %s' % (label, pdf))
+    for label in scheduler.pending() + sorted(scheduler.failed):
+        logging.warning('PDF for %s is still pending at arXiv' % label)
+
+
+def ingest_pdfs(options, args, prefs):
+    """Workflow for PDF Ingest mode: the PDFs found in the directories of
+    `args` (see :func:`scan_pdfs`) are searched for a DOI or an arXiv
+    identifier by a pool of processes (see :func:`identify_pdfs`), the
+    identifiers are resolved as they come with :func:`stream_tokens`,
+    and the BibTeX entries are written, with the PDF in their ``file``
+    field, to `--output` (standard output by default). Progress is
+    logged every few seconds.
+    """
+    if not args:
+        logging.error("PDF Ingest mode needs a directory of PDFs")
+        return
+    stats = collections.Counter()
+    paths = {}  # PDF of each token being resolved, by token index
+    started = [time.time(), time.time()]  # start, last progress report
+
+    def report(force=False):
+        now = time.time()
+        if not force and now - started[1] < 5:
+            return
+        started[1] = now
+        logging.info("%d PDFs scanned, %d identified, %d resolved,"
+                     " %d failed (%.1f PDFs/s)"
+                     % (stats['scanned'], stats['identified'],
+                        stats['resolved'], stats['failed'],
+                        stats['scanned'] / max(now - started[0], 1e-6)))
+
+    def tokens():
+        for path, token in identify_pdfs(scan_pdfs(args, options.recursive),
+                                         pool, processes):
+            stats['scanned'] += 1
+            if token is None:
+                logging.debug("No DOI or arXiv identifier in %s" % path)
+            else:
+                paths[stats['identified']] = path
+                stats['identified'] += 1
+                yield token
+            report()
+
+    processes = os.cpu_count() or 1
+    # started here: tokens() runs in the stream_tokens feeder thread
+    pool = pdf_process_pool(processes)
+    writer = open_writer(options.format, options.output)
+    try:
+        for batch in stream_tokens(tokens(), prefs, jobs=options.jobs):
+            for result in batch:
+                path = paths.pop(result.index)
+                if result.ok:
+                    result.entry.info['file'] = bibtex_file_field(path)
+                    writer.write(result.entry)
+                    stats['resolved'] += 1
+                else:
+                    logging.warning('%s (%s) failed - %s'
+                                    % (path, result.token, result.error))
+                    stats['failed'] += 1
+            report()
+    finally:
+        writer.close()
+        pool.shutdown(cancel_futures=True)
+    report(force=True)
+    if stats['scanned'] > stats['identified']:
+        logging.info("%d PDFs had no DOI or arXiv identifier (see the"
+                     " debug log)" % (stats['scanned'] - stats['identified']))
+
+
+def update_arxiv(options, args, prefs):
+    """Workflow for Pre-print Update mode: the arXiv-only entries of the
+    BibTeX files `args` published between `--from_date` and `--to_date`
+    (MM/YY) are looked up in batches with :class:`ADSSearch` for a
+    refereed bibcode, and those that have one are replaced, in place, by
+    the refereed entry (see :func:`updated_entry`); the rest of each file
+    is left untouched.
+
+    When each pre-print was last checked is kept in `arxiv_update_state`,
+    and pre-prints checked less than `arxiv_update_interval` days ago are
+    skipped (unless `--refresh`). Without an `ads_token` the pre-prints
+    are looked up one by one instead.
+    """
+    import json
+    import shutil
+    if not args:
+        logging.error("Pre-print Update mode needs a BibTeX file")
+        return
+    window = (_month_stamp(options.from_date, (0, 0)),
+              _month_stamp(options.to_date, (9999, 12)))
+    state_path = prefs['arxiv_update_state']
+    try:
+        with open(state_path) as f:
+            checked = json.load(f)
+    except (IOError, OSError, ValueError):
+        checked = {}
+    now = time.time()
+    interval = float(prefs['arxiv_update_interval']) * 86400
+
+    libraries = {}
+    preprints = {}  # arXiv identifier -> [(path, entry span...)]
+    skipped = 0
+    for path in args:
         try:
-            #process_token(article_token, prefs, bibdesk)
-            process_token(article_token, prefs)
-        except ADSException as err:
-            logging.debug('%s failed - %s' % (article_token, err))
-        if len(article_tokens) > 1 and article_token != article_tokens[-1]:
-            time.sleep(delay)
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            entries = list(parse_bibtex(text, spans=True))
+        except (IOError, OSError, BibTexException) as err:
+            logging.error("Cannot read %s: %s" % (path, err))
+            continue
+        libraries[path] = text
+        for entry in entries:
+            arxiv_id = bibtex_arxiv_id(entry[1], entry[2])
+            if arxiv_id is None or not window[0] <= \
+                    bibtex_month(entry[2]) <= window[1]:
+                continue
+            if not options.refresh and \
+                    now - checked.get(arxiv_id, 0) < interval:
+                skipped += 1
+                continue
+            preprints.setdefault(arxiv_id, []).append((path, entry))
+    logging.info("Checking %d arXiv pre-prints (%d checked recently)"
+                 % (len(preprints), skipped))
+
+    refereed, looked_up = find_refereed(list(preprints), prefs,
+                                        jobs=options.jobs)
+    # pre-prints whose lookup failed are tried again on the next run
+    for arxiv_id in looked_up:
+        checked[arxiv_id] = now
+    edits = {}  # path -> [(start, end, new entry text)]
+    for arxiv_id, entry in sorted(refereed.items()):
+        for path, (entry_type, key, fields, start, end) in \
+                preprints[arxiv_id]:
+            logging.info("%s: arXiv:%s is now %s" % (key, arxiv_id,
+                                                     entry.bibcode))
+            edits.setdefault(path, []).append(
+                (start, end, updated_entry(key, fields, entry)))
+        # no longer a pre-print
+        checked.pop(arxiv_id, None)
+
+    for path, changes in edits.items():
+        text = libraries[path]
+        pieces = []
+        pos = 0
+        for start, end, new in sorted(changes):
+            pieces.append(text[pos:start])
+            pieces.append(new)
+            pos = end
+        pieces.append(text[pos:])
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(''.join(pieces))
+        # keep the permissions of the library, not those of a new file
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+        logging.info("Updated %d entries in %s" % (len(changes), path))
+    tmp = state_path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(checked, f, indent=1, sort_keys=True)
+        os.replace(tmp, state_path)
+    except (IOError, OSError) as err:
+        logging.warning("Could not save the pre-print state: %s" % err)
+    logging.info("%d of %d pre-prints have a refereed version"
+                 % (len(refereed), len(preprints)))
+    if len(looked_up) < len(preprints):
+        logging.warning("%d pre-prints could not be checked and will be"
+                        " retried" % (len(preprints) - len(looked_up)))
+
+
+def find_refereed(arxiv_ids, prefs, jobs=4):
+    """Look for the refereed version of the pre-prints `arxiv_ids`.
+
+    With an `ads_token`, the identifiers are searched for in batches and
+    the refereed entries exported in bulk; without, each pre-print is
+    resolved on its own through its ADS page.
+
+    :return: a dict of arXiv identifier -> :class:`BibTex` of the refereed
+        version, for the pre-prints that have one, and the set of the
+        identifiers that were looked up successfully (searched, and
+        exported or resolved when they have a refereed version)
+    """
+    if not arxiv_ids:
+        return {}, set()
+    if prefs['ads_token']:
+        search = ADSSearch(prefs['ads_search_url'], prefs['ads_token'],
+                           prefs['ads_search_limit'])
+        bibcodes = search.refereed(arxiv_ids)
+        exporter = ADSExporter(prefs['ads_export_url'], prefs['ads_token'],
+                               prefs['ads_export_limit'])
+        entries = exporter.export(list(bibcodes.values()))
+        refereed = dict((arxiv_id, entries[bibcode])
+                        for arxiv_id, bibcode in bibcodes.items()
+                        if bibcode in entries)
+        looked_up = set(arxiv_id for arxiv_id in search.searched
+                        if arxiv_id not in bibcodes or arxiv_id in refereed)
+        return refereed, looked_up
+    logging.warning("No ads_token set: checking %d pre-prints one by one"
+                    % len(arxiv_ids))
+    refereed = {}
+    looked_up = set()
+    tokens = ['arXiv:' + arxiv_id for arxiv_id in arxiv_ids]
+    for result in resolve_tokens(tokens, prefs, jobs=jobs):
+        arxiv_id = result.token[len('arXiv:'):]
+        if not result.ok:
+            logging.warning('%s failed - %s' % (result.token, result.error))
+            continue
+        looked_up.add(arxiv_id)
+        if not ARXIV_BIBCODE_RE.match(result.entry.bibcode):
+            refereed[arxiv_id] = result.entry
+    return refereed, looked_up
+
+
+# arXiv e-print bibcodes, 2014arXiv1406.7420N or 1998astro.ph..5201S
+ARXIV_BIBCODE_RE = re.compile(
+    r'^(\d{4})(?:arXiv(\d{4})\.?(\d{4,5})|[a-z\-]{5}\.?[a-z]{0,2}\.*\d{4,7})')
+
+
+def bibtex_arxiv_id(key, fields):
+    """:return: the arXiv identifier of an entry that is only an arXiv
+    pre-print (an arXiv "e-prints" journal, or no journal and an arXiv
+    bibcode as key), or `None`"""
+    fields = dict((name.lower(), value) for name, value in fields.items())
+    journal = bibtex_text(fields.get('journal', '')).lower()
+    match = ARXIV_BIBCODE_RE.match(key)
+    if journal:
+        # an updated entry keeps its arXiv key but not its journal
+        if not ('arxiv' in journal and 'e-print' in journal):
+            return None
+    elif not match:
+        return None
+    kind, value = classify_token(bibtex_text(fields.get('eprint', '')))
+    if kind == 'arxiv':
+        return value
+    if match and match.group(2):
+        return '%s.%s' % (match.group(2), match.group(3))
+    return None
+
+
+def bibtex_month(fields):
+    """:return: (year, month) of an entry, month 1 if it has none"""
+    fields = dict((name.lower(), value) for name, value in fields.items())
+    try:
+        year = int(bibtex_text(fields.get('year', '0')))
+    except ValueError:
+        year = 0
+    month = bibtex_text(fields.get('month', '')).lower()[:3]
+    if month.isdigit():
+        return year, int(month)
+    return year, MONTHS.index(month) + 1 if month in MONTHS else 1
+
+
+def _month_stamp(date, default):
+    """:return: (year, month) of a MM/YY date, or `default`"""
+    if not date:
+        return default
+    parsed = time.strptime(date, '%m/%y')
+    return parsed.tm_year, parsed.tm_mon
+
+
+def updated_entry(key, fields, entry):
+    """:return: the text of the refereed :class:`BibTex` `entry` replacing
+    a pre-print entry, under the pre-print's citation `key` so documents
+    citing it still build, and keeping the fields (``file``, notes...)
+    the refereed entry does not have"""
+    info = collections.OrderedDict(entry.info)
+    names = set(name.lower() for name in info)
+    for name, value in fields.items():
+        if name.lower() not in names:
+            info[name] = value
+    width = max(len(name) for name in info)
+    return '@%s{%s,\n%s\n}' % (entry.type, key, ',\n'.join(
+        '%s = %s' % (name.rjust(width + 1), value)
+        for name, value in info.items()))
+
+
+def scan_pdfs(paths, recursive=False):
+    """Iterate over the PDF files in the directories `paths` (and their
+    subdirectories with `recursive`), as they are found; files given
+    in `paths` are passed through."""
+    pending = list(reversed(paths))
+    top = set(paths)
+    while pending:
+        path = pending.pop()
+        if not os.path.isdir(path):
+            if path in top and os.path.isfile(path):
+                yield path
+            continue
+        if path not in top and not recursive:
+            continue
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError as err:
+            logging.warning("Cannot read %s: %s" % (path, err))
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.lower().endswith('.pdf') and entry.is_file():
+                yield entry.path
+        pending.extend(reversed(subdirs))
+
+
+def pdf_process_pool(processes):
+    """:return: a process pool for :func:`identify_pdfs`.
+
+    Its workers are started from a fork server (or spawned where there is
+    none) rather than forked: they are created as batches are submitted,
+    from whichever thread does so, and forking a threaded process can
+    leave locks held in the child.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    method = 'forkserver' if 'forkserver' in \
+        multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=processes,
+                               mp_context=multiprocessing.get_context(method))
+
+
+def identify_pdfs(pdfs, executor, processes, batch_size=32):
+    """Look for the identifier of each PDF of the iterable `pdfs` with
+    :func:`pdf_identifier`, in batches spread over the `processes`
+    workers of `executor` (see :func:`pdf_process_pool`), with a bounded
+    number of batches in flight.
+
+    Yields
+    ------
+    (path, token) : tuple
+        Each PDF and its DOI or arXiv identifier (`None` if none was
+        found), in the order of `pdfs`.
+    """
+    import itertools
+    pdfs = iter(pdfs)
+    futures = collections.deque()
+    while True:
+        while len(futures) < 2 * processes:
+            batch = list(itertools.islice(pdfs, batch_size))
+            if not batch:
+                break
+            futures.append(executor.submit(_identify_batch, batch))
+        if not futures:
+            break
+        for item in futures.popleft().result():
+            yield item
+
+
+def _identify_batch(paths):
+    # run in a worker process by identify_pdfs()
+    return [(path, pdf_identifier(path)) for path in paths]
+
+
+# bytes of a PDF searched for an identifier: the first pages are usually
+# at the start, the document information dictionary often at the end
+PDF_HEAD_SIZE = 2 ** 17
+PDF_TAIL_SIZE = 2 ** 14
+PDF_STREAM_RE = re.compile(rb'stream\r?\n')
+# compressed bytes of each stream decoded, and the most text kept; the
+# input is bounded too, as zlib copies whatever it leaves unconsumed
+PDF_STREAM_SIZE = 2 ** 16
+PDF_STREAM_TEXT_SIZE = 2 ** 18
+# a DOI in the XMP metadata or the document information dictionary
+PDF_META_DOI_RE = re.compile(
+    rb'(?:(?:prism|pdfx):doi\s*[>=]\s*"?|dc:identifier>\s*(?:doi:)?'
+    rb'|/doi\s*\()(10\.\d{4,9}/[^\s<>"()\[\]{}]+)', re.I)
+PDF_ARXIV_RE = re.compile(
+    rb'arXiv:\s*(\d{4}\.\d{4,5}|[a-z][a-z\-]+(?:\.[A-Z]{2})?/\d{7})')
+PDF_DOI_RE = re.compile(rb'(10\.\d{4,9}/[^\s<>"()\[\]{}]+)')
+# the heading of the reference list, whose DOIs are not the article's
+PDF_REFERENCES_RE = re.compile(
+    rb'\b(?:References|REFERENCES|Bibliography|BIBLIOGRAPHY)\b')
+# joins the pieces of kerned text, "[(arXiv:1406.)-250(7420)]TJ"
+PDF_KERN_RE = re.compile(rb'\)\s*-?[\d.]*\s*\(')
+
+
+def pdf_identifier(path):
+    """:return: the DOI or arXiv identifier of the PDF at `path`, or
+    `None`.
+
+    The file name is tried first (arXiv downloads are named after their
+    identifier), then the document metadata, the arXiv stamp on the first
+    page and the first DOI before the reference list, in the first
+    :data:`PDF_HEAD_SIZE` and last :data:`PDF_TAIL_SIZE` bytes of the
+    file, with the (FlateDecode) streams found there decompressed.
+    """
+    name = os.path.basename(path)[:-len('.pdf')]
+    match = ARXIV_ID_RE.match(name.replace('_', '/'))
+    if match:
+        return match.group(1)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(PDF_HEAD_SIZE)
+            f.seek(0, os.SEEK_END)
+            if f.tell() > PDF_HEAD_SIZE:
+                f.seek(max(PDF_HEAD_SIZE, f.tell() - PDF_TAIL_SIZE))
+                data += b'\n' + f.read()
+    except (IOError, OSError) as err:
+        logging.debug("Cannot read %s: %s" % (path, err))
+        return None
+    texts = [data]
+    view = memoryview(data)
+    for match in PDF_STREAM_RE.finditer(data):
+        start = match.end()
+        decompressor = zlib.decompressobj()
+        try:
+            # a stream cut off at the end of `data` still decodes in part
+            text = decompressor.decompress(
+                view[start:start + PDF_STREAM_SIZE], PDF_STREAM_TEXT_SIZE)
+        except zlib.error:
+            continue
+        texts.append(PDF_KERN_RE.sub(b'', text))
+    # a substring test first spares most texts the slower regexp
+    for regexp, hints in ((PDF_META_DOI_RE, (b'doi', b'DOI', b'identifier')),
+                          (PDF_ARXIV_RE, (b'arXiv:',))):
+        for text in texts:
+            if not any(hint in text for hint in hints):
+                continue
+            match = regexp.search(text)
+            if match:
+                return match.group(1).decode('latin-1').rstrip('.,;')
+    # any DOI, but not from the reference list: the page streams go
+    # before the raw bytes (where the links to the references are), and
+    # nothing after a references heading counts
+    for text in texts[1:] + texts[:1]:
+        heading = PDF_REFERENCES_RE.search(text)
+        end = heading.start() if heading else len(text)
+        if b'10.' in text:
+            match = PDF_DOI_RE.search(text, 0, end)
+            if match:
+                return match.group(1).decode('latin-1').rstrip('.,;')
+        if heading:
+            break
+    return None
+
+
+def bibtex_file_field(path):
+    """:return: the BibTeX ``file`` field (JabRef syntax) linking `path`"""
+    path = os.path.abspath(path).replace('\\', '\\\\').replace(':', '\\:')
+    return '{:%s:PDF}' % path
+
+
+class Journal(object):
+    """Append-only record of the outcome of each token of a batch run,
+    one JSON line per token: ``token``, ``status`` (``ok`` or
+    ``error``), ``bibcode``, ``output`` (where the entry was written) and
+    ``bibtex`` or ``error`` (see `--journal` and `--resume`).
+
+    Each line is appended with a single ``write`` to a file opened in
+    append mode, and the file is synced to disk every `sync_every`
+    records or `sync_interval` seconds, whichever comes first; a line
+    torn by a crash is dropped when the journal is opened again. The
+    latest record of a token wins. :meth:`close` can compact the
+    journal, leaving one line per token.
+    """
+    def __init__(self, path, resume=False, sync_every=64, sync_interval=1.):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.records = self._load() if resume else {}
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not resume:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0o644)
+        self._unsynced = 0
+        self._synced = time.time()
+
+    def _load(self):
+        import json
+        records = {}
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return records
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            logging.warning("Dropping an incomplete record at the end of %s"
+                            % self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logging.warning("Skipping a bad record in %s" % self.path)
+                continue
+            records[record['token']] = record
+        return records
+
+    def completed(self):
+        """:return: a dict of the records of the tokens resolved, by token"""
+        return dict((token, record) for token, record in self.records.items()
+                    if record['status'] == 'ok')
+
+    def record(self, result, output='-'):
+        """Append the outcome of a :class:`TokenResult`"""
+        import json
+        record = {'token': result.token,
+                  'status': 'ok' if result.ok else 'error',
+                  'bibcode': result.entry.bibcode if result.ok else None,
+                  'output': output}
+        if result.ok:
+            record['bibtex'] = result.bibtex
+        else:
+            record['error'] = str(result.error)
+        os.write(self._fd, (json.dumps(record, ensure_ascii=False)
+                            + '\n').encode('utf-8'))
+        self.records[result.token] = record
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every \
+                or time.time() - self._synced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced:
+            os.fsync(self._fd)
+        self._unsynced = 0
+        self._synced = time.time()
+
+    def close(self, compact=False):
+        """Sync and close the journal; with `compact`, rewrite it with
+        the latest record of each token only"""
+        import json
+        self.sync()
+        os.close(self._fd)
+        if not compact:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def open_journal(options):
+    """:return: the :class:`Journal` asked for by `--journal` or
+    `--resume`, or `None`"""
+    if not options.journal:
+        return None
+    return Journal(options.journal, resume=bool(options.resume))
+
+
+class TokenResult(object):
+    """Outcome of resolving a single article token.
+
+    ``parser`` is the :class:`ADSHTMLParser` holding the article
+    information, ``entry`` its :class:`BibTex` entry (the only one set
+    for results from a daemon) and ``bibtex`` the BibTeX string; on
+    failure they are `None` and ``error`` describes what went wrong.
+    ``timings`` is only filled by :func:`stream_tokens`.
+    """
+    def __init__(self, index, token, parser=None, error=None, elapsed=0.,
+                 entry=None):
+        self.index = index
+        self.token = token
+        self.parser = parser
+        self.error = error
+        self.elapsed = elapsed
+        self.entry = parser.bibtex if parser is not None else entry
+        self.bibtex = None
+        self.pdf = None
+        self.timings = {}
+        if self.entry is not None:
+            self.bibtex = str(self.entry)
 
-    #bibdesk.app.dealloc()
+    @property
+    def ok(self):
+        return self.error is None and self.entry is not None
+
+    def __repr__(self):
+        return '<TokenResult %s %s>' % (
+            self.token, 'ok' if self.ok else 'failed')
 
 
-# FIXME this function needs to be refactored
-def process_token(article_token, prefs, bibdesk=None):
-    """Process a single article token from the user, copying it
-    to the clipboard.
+def resolve_tokens(article_tokens, prefs, jobs=4, pdf=False, bulk=False):
+    """Resolve article tokens concurrently with at most `jobs` workers.
 
     Parameters
     ----------
-    article_token : str
-        Any user-supplied `str` token.
+    article_tokens : list
+        User-supplied `str` tokens.
     prefs : :class:`Preferences`
         A `Preferences` instance.
-    bibdesk : :class:`BibDesk`
-        A `BibDesk` AppKit hook instance.
+    jobs : int
+        Maximum number of tokens resolved at the same time.
+    pdf : bool
+        Also fetch the PDF of each article (see `ADSHTMLParser.get_pdf`).
+    bulk : bool
+        Fetch the BibTeX of bibcode tokens at once with
+        :func:`bulk_export`; the others are resolved one by one.
+
+    Tokens the :class:`PaperIndex` knows are looked up all at once first,
+    and are not resolved again. ArXiv identifiers ADS has no page for are
+    fetched from the arXiv API together (see :class:`ArXivBatch`).
+
+    Yields
+    ------
+    result : :class:`TokenResult`
+        One result per token, in the same order as `article_tokens`.
     """
+    from concurrent.futures import ThreadPoolExecutor
+    index = get_paper_index()
+    known = index.get_many(article_tokens) \
+        if index is not None and not pdf else {}
+    exported = bulk_export([t for t in article_tokens if t not in known],
+                           prefs) if bulk and not pdf else {}
+    if index is not None and exported:
+        index.add_many((entry, [token]) for token, entry in exported.items())
+    exported.update(known)
+    arxiv_ids = []
+    for article_token in article_tokens:
+        if article_token not in exported:
+            kind, value = classify_token(article_token, prefs.adsmirrors)
+            if kind == 'arxiv':
+                arxiv_ids.append(value)
+    arxiv_batch = ArXivBatch(arxiv_ids) if len(arxiv_ids) > 1 else None
+
+    def work(index, article_token):
+        return resolve_one(index, article_token, prefs, pdf=pdf,
+                           exported=exported, arxiv_batch=arxiv_batch)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(jobs))) as executor:
+        futures = [executor.submit(work, i, t)
+                   for i, t in enumerate(article_tokens)]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # when stopped early (Ctrl-C), do not wait for the rest
+            for future in futures:
+                future.cancel()
+
+
+def stream_tokens(article_tokens, prefs, jobs=4, window=None):
+    """Resolve tokens from an iterable read lazily, as they come, with at
+    most `window` (twice `jobs` by default) of them in flight or waiting
+    to be consumed, so memory does not grow with the input.
+
+    Yields
+    ------
+    results : list
+        The :class:`TokenResult` objects finished since the previous
+        batch, in completion order rather than input order (``index`` is
+        the position of the token in the input). Each has the time spent
+        in every stage in ``timings`` when a tracer is configured.
+    """
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    jobs = max(1, int(jobs))
+    window = window or 2 * jobs
+    tracer = get_tracer()
+    slots = threading.Semaphore(window)
+    finished = queue.Queue()
+    stop = threading.Event()
+
+    def work(index, article_token):
+        if tracer is None:
+            return resolve_one(index, article_token, prefs)
+        with tracer.timings() as timings:
+            result = resolve_one(index, article_token, prefs)
+        result.timings = timings
+        return result
+
+    def feed():
+        # a thread of its own: a slow producer on stdin must not hold
+        # back results that are already done
+        count = 0
+        try:
+            for index, article_token in enumerate(article_tokens):
+                slots.acquire()
+                if stop.is_set():
+                    break
+                executor.submit(work, index, article_token) \
+                    .add_done_callback(finished.put)
+                count += 1
+        except Exception as err:
+            finished.put(err)
+        finished.put(count)
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    feeder = threading.Thread(target=feed, name='stream-feeder',
+                              daemon=True)
+    feeder.start()
+    submitted, received = None, 0
+    try:
+        while submitted is None or received < submitted:
+            batch = []
+            item = finished.get()
+            while True:
+                if isinstance(item, Exception):
+                    raise item
+                elif isinstance(item, int):
+                    submitted = item
+                else:
+                    batch.append(item.result())
+                try:
+                    item = finished.get_nowait()
+                except queue.Empty:
+                    break
+            received += len(batch)
+            if batch:
+                yield batch
+            for _ in batch:
+                slots.release()
+    finally:
+        stop.set()
+        slots.release()  # in case the feeder waits for a slot
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def resolve_one(index, article_token, prefs, pdf=False, exported=None,
+                arxiv_batch=None):
+    """Resolve the `index`-th token into a :class:`TokenResult`; errors
+    are reported in the result rather than raised.
+
+    `exported` maps tokens to BibTeX entries already fetched by
+    :func:`bulk_export`; `arxiv_batch` is handed to :func:`resolve_token`.
+    """
+    with trace_span('token', token=article_token):
+        start = time.time()
+        if exported and article_token in exported:
+            ads_parser = ADSHTMLParser(prefs=prefs)
+            ads_parser.bibtex = exported[article_token]
+            return TokenResult(index, article_token, parser=ads_parser,
+                               elapsed=time.time() - start)
+        try:
+            ads_parser = resolve_token(article_token, prefs,
+                                       use_index=not pdf,
+                                       arxiv_batch=arxiv_batch)
+        except Exception as err:
+            # one bad token must not take down the whole batch
+            logging.debug('%s raised' % article_token, exc_info=True)
+            return TokenResult(index, article_token, error=err,
+                               elapsed=time.time() - start)
+        if ads_parser is None:
+            return TokenResult(index, article_token,
+                               error=ADSException('no ADS or arXiv match'),
+                               elapsed=time.time() - start)
+        result = TokenResult(index, article_token, parser=ads_parser)
+        if pdf:
+            with trace_span('pdf'):
+                result.pdf = ads_parser.get_pdf()
+        result.elapsed = time.time() - start
+        return result
+
+
+def resolve_token(article_token, prefs, use_index=True, arxiv_batch=None):
+    """Resolve a single article token into an :class:`ADSHTMLParser`
+    holding the article information and its BibTeX entry.
+
+    A paper already in the :class:`PaperIndex` is taken from it, without
+    any network access, unless `use_index` is false (the parser then
+    only has the BibTeX entry); papers resolved are added to the index.
+    `arxiv_batch` is handed to :class:`ADSConnector`.
+
+    :return: the parser, or `None` if the token could not be resolved
+    """
+    index = get_paper_index()
+    if index is not None and use_index:
+        with trace_span('index'):
+            entry = index.get(article_token)
+        if entry is not None:
+            ads_parser = ADSHTMLParser(prefs=prefs)
+            ads_parser.bibtex = entry
+            return ads_parser
+
     # Determine what we're dealing with
     # The goal is to get a URL into ADS
-    logging.debug("process_token found article token %s", article_token)
-    connector = ADSConnector(article_token, prefs)
+    logging.debug("resolve_token found article token %s", article_token)
+    with trace_span('connect') as span:
+        connector = ADSConnector(article_token, prefs,
+                                 arxiv_batch=arxiv_batch)
+        span.set(kind=connector.kind)
     ads_parser = ADSHTMLParser(prefs=prefs)
 
-    if isinstance(connector.ads_read, str):
+    if isinstance(connector.ads_read, URLStream):
         # parse the ADS HTML file
-        ads_parser.parse(connector.ads_read)
+        with trace_span('parse'):
+            ads_parser.parse(connector.ads_read)
 
     elif connector.ads_read and getattr(connector, 'bibtex') is not None:
         # parsed from arXiv - dummy ads info
@@ -248,12 +1358,14 @@ def process_token(article_token, prefs, bibdesk=None):
                     if l.get('title') == 'pdf'][0]
             ads_parser.links = {'preprint': link}
         except IndexError:
-            logging.debug("process_token could not find preprint PDF link")
+            logging.debug("resolve_token could not find preprint PDF link")
             pass
+        # from here on treat it like a BibTeX entry from ADS
+        ads_parser.bibtex = ads_parser.bibtex.to_bibtex()
 
     elif connector.ads_read is None:
-        logging.debug("process_token skipping %s", article_token)
-        return False
+        logging.debug("resolve_token skipping %s", article_token)
+        return None
 
     # get PDF first
     #pdf = ads_parser.get_pdf()
@@ -265,28 +1377,187 @@ def process_token(article_token, prefs, bibdesk=None):
     xabs=ads_parser.abstract
 
     # updates bibtex field to include abstract
-    ads_parser.bibtex.info.update({'abstract': '"' + xabs + '"'})
-
-    # this is a string with all the bibtex info
-    # ready to be imported into jabref or other software.
-    # Converts into proper encoding to avoid problems with 
-    # the copy/paste below
-    xbibtex=str(ads_parser.bibtex.__str__(), 'utf-8')
-
-    # copies text to the clipboard for easy importing into
-    # whatever program you have
-    pyperclip.copy(xbibtex)
-    pyperclip.paste()    
-    
-    print(xbibtex)
-    
-
-
+    if xabs:
+        ads_parser.bibtex.info.update({'abstract': bibtex_quoted(xabs)})
 
+    if index is not None:
+        index.add(ads_parser.bibtex, [article_token])
+    return ads_parser
 
 
+class DaemonException(Exception):
+    pass
 
 
+def connect_daemon(path):
+    """:return: a socket connected to the daemon listening at `path`, or
+    `None` if no daemon is running"""
+    import socket
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def daemon_request(sock, request):
+    """Send `request` (a JSON-serializable dict) to the daemon and
+    iterate over its JSON replies"""
+    import json
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    for line in sock.makefile('rb'):
+        reply = json.loads(line.decode('utf-8'))
+        yield reply
+        if reply.get('done'):
+            break
+
+
+def daemon_results(sock, article_tokens, jobs=4, bulk=False):
+    """Have the daemon resolve `article_tokens`, like
+    :func:`resolve_tokens` does in this process.
+
+    Yields
+    ------
+    result : :class:`TokenResult`
+        One result per token, in the same order as `article_tokens`.
+
+    Raises
+    ------
+    DaemonException
+        If the daemon goes away before every token has its result.
+    """
+    index = 0
+    try:
+        with sock:
+            replies = daemon_request(sock, {'tokens': list(article_tokens),
+                                            'jobs': jobs, 'bulk': bulk})
+            for reply in replies:
+                if reply.get('done'):
+                    break
+                if 'error' in reply:
+                    result = TokenResult(
+                        index, reply['token'],
+                        error=DaemonException(reply['error']))
+                else:
+                    entry = next(BibTex.iter_entries(reply['bibtex']), None)
+                    result = TokenResult(index, reply['token'], entry=entry)
+                result.elapsed = reply.get('elapsed', 0.)
+                index += 1
+                if index == len(article_tokens):
+                    # read the final {"done": true} before handing over
+                    # the last result: callers need not exhaust the
+                    # generator
+                    next(replies, None)
+                yield result
+    except (OSError, ValueError) as err:
+        # connection reset, or a reply cut short
+        if index < len(article_tokens):
+            raise DaemonException(err)
+        return
+    if index < len(article_tokens):
+        raise DaemonException('the daemon stopped answering')
+
+
+def serve_daemon(path, prefs):
+    """Resident mode: resolve the tokens sent by clients to the Unix
+    socket at `path`, keeping connections, caches and mirror state warm
+    between invocations.
+
+    Each request is a JSON line ``{"tokens": [...], "jobs": 4, "bulk":
+    false}``, answered by one JSON line per token (``bibtex`` or
+    ``error``), in order, and a final ``{"done": true}``. The commands
+    ``{"command": "ping"}`` and ``{"command": "stop"}`` are also
+    understood.
+    """
+    import json
+    import signal
+    import socketserver
+    import threading
+
+    if os.path.exists(path):
+        sock = connect_daemon(path)
+        if sock is not None:
+            sock.close()
+            raise DaemonException('a daemon is already listening on %s'
+                                  % path)
+        # left over by a daemon that did not exit cleanly
+        os.remove(path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                self.serve_requests()
+            except ConnectionError:
+                # the client went away (Ctrl-C, or it stopped reading)
+                logging.debug("Daemon client disconnected")
+
+        def serve_requests(self):
+            import contextlib
+            for line in self.rfile:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('command') == 'stop':
+                    self.reply({'done': True, 'stopped': True})
+                    threading.Thread(target=server.shutdown).start()
+                    return
+                if request.get('command') == 'ping':
+                    self.reply({'done': True, 'version': VERSION})
+                    continue
+                # edits to ~/.adsbibdesk apply from the next request
+                prefs.reload()
+                tokens = request.get('tokens', [])
+                logging.info("Daemon resolving %d token(s)", len(tokens))
+                results = resolve_tokens(tokens, prefs,
+                                         jobs=request.get('jobs', 4),
+                                         bulk=request.get('bulk', False))
+                # closed at once if the client goes away
+                with contextlib.closing(results):
+                    for result in results:
+                        reply = {'token': result.token,
+                                 'elapsed': result.elapsed}
+                        if result.ok:
+                            reply['bibtex'] = result.bibtex
+                        else:
+                            reply['error'] = str(result.error)
+                        self.reply(reply)
+                self.reply({'done': True})
+
+        def reply(self, reply):
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    umask = os.umask(0o077)  # the socket is for this user only
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info("Daemon listening on %s", path)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        logging.info("Daemon stopped")
+
+
+def stop_daemon(path):
+    """Ask the daemon listening at `path` to exit"""
+    sock = connect_daemon(path)
+    if sock is None:
+        logging.info("No daemon is running")
+        return False
+    with sock:
+        for reply in daemon_request(sock, {'command': 'stop'}):
+            pass
+    return True
 
 
 def notify(title, subtitle, desc, sticky=False):
@@ -343,107 +1614,1822 @@ def growl_notify(title, desc, sticky=False):
 
 
 def has_annotationss(f):
+    import subprocess as sp
     return sp.Popen(
         "strings %s | grep  -E 'Contents[ ]{0,1}\('" % f,
         shell=True, stdout=sp.PIPE,
-        stderr=open('/dev/null', 'w')).stdout.read() != ''
+        stderr=open('/dev/null', 'w')).stdout.read() != b''
+
+
+def get_redirect(url, max_redirects=10):
+    """Utility function to intercept final URL of HTTP redirection.
+
+    Redirects are followed one hop at a time with HEAD requests, so no
+    body is downloaded (GET is only used for servers refusing HEAD).
+    """
+    client = get_http_client()
+    method = 'HEAD'
+    with trace_span('get_redirect', url=url):
+        for _ in range(max_redirects + 1):
+            try:
+                response = client.request(method, url,
+                                          follow_redirects=False)
+            except urllib.error.HTTPError as err:
+                if method == 'HEAD' and err.code in (405, 501):
+                    method = 'GET'
+                    continue
+                return err.filename
+            except urllib.error.URLError:
+                return url
+            if method == 'HEAD':
+                response.read()
+            else:
+                response.close()
+            location = response.headers.get('Location')
+            if location is None or \
+                    response.status not in client.redirect_codes:
+                return url
+            url = urllib.parse.urljoin(url, location)
+        return url
+
 
+class ArXivMirrors(object):
+    """Remembers which arXiv mirror each ADS host sends preprint links to.
 
-def get_redirect(url):
-    """Utility function to intercept final URL of HTTP redirection"""
+    The mirror is resolved with :func:`get_redirect` for the first
+    article of an ADS host, then kept for `ttl` seconds, in memory and in
+    the response cache (key ``arxiv-mirror:<host>``) for later runs.
+    """
+    def __init__(self, ttl=86400):
+        import threading
+        self.ttl = ttl
+        self._mirrors = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def mirror_for(self, preprint_url):
+        """:return: the arXiv mirror (host name) `preprint_url`, an ADS
+        preprint link, redirects to"""
+        import threading
+        host = urllib.parse.urlsplit(preprint_url).netloc
+        with self._lock:
+            lock = self._locks.setdefault(host, threading.Lock())
+        # one resolution per host, even with many articles in flight
+        with lock:
+            mirror = self._lookup(host)
+            if mirror is not None:
+                return mirror
+            mirror = urllib.parse.urlsplit(get_redirect(preprint_url)).netloc
+            if mirror and mirror != host:
+                self._store(host, mirror)
+            return mirror
+
+    def _lookup(self, host):
+        import json
+        now = time.time()
+        if host in self._mirrors:
+            mirror, resolved = self._mirrors[host]
+            if now - resolved < self.ttl:
+                return mirror
+        data = cache_lookup(None, key='arxiv-mirror:' + host)
+        if data is None:
+            return None
+        try:
+            record = json.loads(data.decode('utf-8'))
+            mirror, resolved = record['mirror'], float(record['resolved'])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if now - resolved >= self.ttl:
+            return None
+        self._mirrors[host] = (mirror, resolved)
+        return mirror
+
+    def _store(self, host, mirror):
+        import json
+        resolved = time.time()
+        self._mirrors[host] = (mirror, resolved)
+        cache = get_response_cache()
+        if cache is not None:
+            cache.put('arxiv-mirror:' + host, json.dumps(
+                {'mirror': mirror, 'resolved': resolved}).encode('utf-8'))
+
+
+# the process-wide arXiv mirror memo, see get_arxiv_mirrors()
+_arxiv_mirrors = None
+
+
+def configure_arxiv_mirrors(prefs):
+    """Set up the arXiv mirror memo; `arxiv_mirror_ttl` is in hours"""
+    global _arxiv_mirrors
+    _arxiv_mirrors = ArXivMirrors(
+        ttl=float(prefs['arxiv_mirror_ttl']) * 3600)
+    return _arxiv_mirrors
+
+
+def get_arxiv_mirrors():
+    """:return: the shared :class:`ArXivMirrors`"""
+    global _arxiv_mirrors
+    if _arxiv_mirrors is None:
+        _arxiv_mirrors = ArXivMirrors()
+    return _arxiv_mirrors
+
+
+def is_pdf(filename):
+    """Test if `filename` holds a complete PDF document: the ``%PDF-``
+    magic bytes near the start and an ``%%EOF`` marker near the end.
+    """
     try:
-        out = urllib.request.urlopen(url)
-    except urllib.error.URLError as out:
+        with open(filename, 'rb') as f:
+            if b'%PDF-' not in f.read(1024):
+                return False
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 2048))
+            return b'%%EOF' in f.read()
+    except (IOError, OSError):
+        return False
+
+
+def download_pdf(url, filename, resume=True, retries=2, chunk_size=65536,
+                 cancel=None):
+    """Stream `url` into `filename` without holding it in memory.
+
+    If the transfer is interrupted it is resumed with an HTTP Range
+    request (up to `retries` times), as is an incomplete `filename` left
+    over from an earlier attempt when `resume` is True. Setting the
+    `cancel` event (a `threading.Event`) stops the download.
+
+    :return: True if `filename` ends up holding a complete PDF
+    """
+    import http.client
+    for attempt in range(retries + 1):
+        offset = 0
+        if resume and os.path.exists(filename) and not is_pdf(filename):
+            offset = os.path.getsize(filename)
+        # compressed transfers cannot be resumed by byte offset
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        try:
+            response = get_http_client().request('GET', url, headers=headers)
+        except urllib.error.HTTPError as err:
+            if err.code == 416 and offset:
+                # nothing left to fetch
+                return is_pdf(filename)
+            logging.debug('%s failed: %s' % (url, err))
+            return False
+        except urllib.error.URLError as err:
+            logging.debug('%s failed: %s' % (url, err))
+            continue
+
+        with response:
+            # the server may ignore the Range header
+            mode = 'ab' if offset and response.status == 206 else 'wb'
+            try:
+                with open(filename, mode) as f:
+                    for chunk in response.iter_content(chunk_size):
+                        if cancel is not None and cancel.is_set():
+                            return False
+                        f.write(chunk)
+            except (http.client.HTTPException, OSError) as err:
+                logging.debug('%s interrupted at attempt %d: %s'
+                              % (url, attempt + 1, err))
+                if not resume:
+                    return False
+                continue
+        return is_pdf(filename)
+    return is_pdf(filename)
+
+
+def is_processing(filename):
+    """Test for arXiv's placeholder page for a PDF still being built"""
+    try:
+        with open(filename, 'rb') as f:
+            return b'...processing...' in f.read(65536)
+    except (IOError, OSError):
+        return False
+
+
+class PendingPDFs(object):
+    """Background re-checks of arXiv PDFs that are still being generated.
+
+    arXiv answers with a "...processing..." page while it builds a PDF.
+    Instead of sleeping on it, such downloads are handed to this scheduler,
+    whose thread re-checks them with exponential backoff and jitter. Each
+    check is a HEAD request, conditional on the ETag/Last-Modified seen
+    before; the PDF itself is only downloaded again once it looks ready.
+    """
+    def __init__(self, base_delay=15, max_delay=600, max_wait=3600):
+        import threading
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.done = {}  # label -> PDF path
+        self.failed = {}  # label -> URL
+        self._queue = []  # heap of (due time, sequence, item)
+        self._count = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, url, filename, label=None):
+        """Schedule `url` to be downloaded into `filename` once ready"""
+        import heapq
+        import threading
+        item = {'url': url, 'filename': filename, 'label': label or url,
+                'attempt': 0, 'added': time.time(), 'etag': None,
+                'modified': None}
+        logging.debug('PDF %s is being generated, retrying in background'
+                      % item['label'])
+        with self._cond:
+            self._count += 1
+            heapq.heappush(self._queue,
+                           (self._next_due(item), self._count, item))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='PendingPDFs')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def pending(self):
+        """:return: labels of the PDFs not settled yet"""
+        with self._cond:
+            return [item['label'] for _, _, item in sorted(self._queue)]
+
+    def wait(self, timeout=None):
+        """Block until every PDF is settled or `timeout` seconds pass.
+
+        :return: True if nothing is pending anymore
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._queue:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self._cond.wait(remaining)
+            return not self._queue
+
+    def _next_due(self, item):
+        import random
+        delay = min(self.max_delay, self.base_delay * 2 ** item['attempt'])
+        return time.time() + random.uniform(delay / 2., delay)
+
+    def _run(self):
+        import heapq
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.time():
+                    timeout = None
+                    if self._queue:
+                        timeout = self._queue[0][0] - time.time()
+                    self._cond.wait(timeout)
+                due, seq, item = heapq.heappop(self._queue)
+                # keep it visible to pending() while being checked
+                heapq.heappush(self._queue, (float('inf'), seq, item))
+            settled = self._check(item)
+            with self._cond:
+                self._queue = [e for e in self._queue if e[1] != seq]
+                heapq.heapify(self._queue)
+                if not settled:
+                    item['attempt'] += 1
+                    heapq.heappush(self._queue,
+                                   (self._next_due(item), seq, item))
+                self._cond.notify_all()
+
+    def _check(self, item):
+        """:return: True once the PDF is downloaded or given up on"""
+        headers = {}
+        if item['etag']:
+            headers['If-None-Match'] = item['etag']
+        if item['modified']:
+            headers['If-Modified-Since'] = item['modified']
+        ready = True
+        try:
+            response = get_http_client().request('HEAD', item['url'],
+                                                 headers=headers)
+            response.close()
+            if response.status == 304:
+                ready = False
+            else:
+                item['etag'] = response.headers.get('ETag')
+                item['modified'] = response.headers.get('Last-Modified')
+                content_type = response.headers.get('Content-Type') or ''
+                ready = 'html' not in content_type
+        except urllib.error.URLError as err:
+            logging.debug('HEAD %s failed: %s' % (item['url'], err))
+
+        if ready:
+            download_pdf(item['url'], item['filename'], resume=False)
+            if is_pdf(item['filename']):
+                logging.info('PDF for %s is ready: %s'
+                             % (item['label'], item['filename']))
+                self.done[item['label']] = item['filename']
+                return True
+        if time.time() - item['added'] > self.max_wait:
+            logging.info('Giving up on PDF for %s' % item['label'])
+            self.failed[item['label']] = item['url']
+            return True
+        return False
+
+
+# the process-wide scheduler for PDFs arXiv is still generating
+_pdf_scheduler = None
+
+
+def get_pdf_scheduler():
+    """:return: the shared :class:`PendingPDFs` scheduler"""
+    global _pdf_scheduler
+    if _pdf_scheduler is None:
+        _pdf_scheduler = PendingPDFs()
+    return _pdf_scheduler
+
+
+USER_AGENT = 'adspaste/%s (+https://github.com/rsnemmen/adspaste)' % VERSION
+
+
+class Span(object):
+    """A timed stage recorded by a :class:`Tracer`.
+
+    Used as a context manager, a span becomes the parent of the spans
+    opened inside it in the same thread; spans outliving a block (like
+    an HTTP response body read later) are finished with :meth:`end`.
+    """
+    __slots__ = ('tracer', 'id', 'parent', 'name', 'attrs', 'thread',
+                 'start', 'duration')
+
+    def __init__(self, tracer, name, attrs, parent=None):
+        import threading
+        self.tracer = tracer
+        self.id = next(tracer._ids)
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.duration = None
+        self.start = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, **attrs):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.start
+        self.attrs.update(attrs)
+        self.tracer._finish(self)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.end()
+
+
+class _NullSpan(object):
+    """What :func:`trace_span` returns when tracing is off"""
+    def set(self, **attrs):
+        pass
+
+    def end(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
         pass
-    return out.geturl()
 
 
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Collects timing spans and counters (HTTP bytes, cache hits and
+    misses) and exports them as a JSON trace, a Chrome trace-event file
+    or a Prometheus text snapshot.
+
+    Without `keep_spans` finished spans are not kept, only added up by
+    :meth:`timings`, so memory stays flat over long runs.
+    """
+    def __init__(self, keep_spans=True):
+        import itertools
+        import threading
+        self.keep_spans = keep_spans
+        self.spans = []
+        self.counters = {}
+        self.origin = time.perf_counter()
+        self.started = time.time()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def span(self, name, **attrs):
+        """:return: a new :class:`Span`, child of the innermost open
+        span of this thread"""
+        stack = getattr(self._local, 'stack', None)
+        return Span(self, name, attrs, stack[-1].id if stack else None)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def _push(self, span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def _pop(self):
+        self._local.stack.pop()
+
+    def _finish(self, span):
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings[span.name] = timings.get(span.name, 0.) + span.duration
+        if self.keep_spans:
+            with self._lock:
+                self.spans.append(span)
+
+    def timings(self):
+        """:return: a context manager yielding a dict that adds up, by
+        stage name, the duration of the spans this thread finishes inside
+        the block"""
+        import contextlib
+
+        @contextlib.contextmanager
+        def collect():
+            timings = self._local.timings = {}
+            try:
+                yield timings
+            finally:
+                self._local.timings = None
+        return collect()
+
+    def to_json(self):
+        """:return: the trace as a JSON-serializable dict, span times in
+        seconds since the tracer was created"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+            counters = sorted(self.counters.items())
+        return {'started': self.started,
+                'spans': [{'id': span.id, 'parent': span.parent,
+                           'name': span.name, 'thread': span.thread,
+                           'start': span.start - self.origin,
+                           'duration': span.duration,
+                           'attrs': span.attrs} for span in spans],
+                'counters': [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for (name, labels), value in counters]}
+
+    def to_chrome(self):
+        """:return: the trace in the Chrome trace-event format"""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        return {'displayTimeUnit': 'ms',
+                'traceEvents': [{'name': span.name, 'cat': 'adspaste',
+                                 'ph': 'X', 'pid': pid, 'tid': span.thread,
+                                 'ts': (span.start - self.origin) * 1e6,
+                                 'dur': span.duration * 1e6,
+                                 'args': span.attrs} for span in spans]}
+
+    def to_prometheus(self):
+        """:return: span durations (as summaries) and counters in the
+        Prometheus text exposition format"""
+        with self._lock:
+            spans = list(self.spans)
+            counters = sorted(self.counters.items())
+        totals = {}
+        for span in spans:
+            count, total, longest = totals.get(span.name, (0, 0., 0.))
+            totals[span.name] = (count + 1, total + span.duration,
+                                 max(longest, span.duration))
+        lines = ['# HELP adspaste_span_seconds Time spent in each stage.',
+                 '# TYPE adspaste_span_seconds summary']
+        for name, (count, total, longest) in sorted(totals.items()):
+            lines.append('adspaste_span_seconds_count{span="%s"} %d'
+                         % (name, count))
+            lines.append('adspaste_span_seconds_sum{span="%s"} %.6f'
+                         % (name, total))
+        lines += ['# HELP adspaste_span_seconds_max Longest span per stage.',
+                  '# TYPE adspaste_span_seconds_max gauge']
+        for name, (count, total, longest) in sorted(totals.items()):
+            lines.append('adspaste_span_seconds_max{span="%s"} %.6f'
+                         % (name, longest))
+        typed = set()
+        for (name, labels), value in counters:
+            metric = 'adspaste_%s_total' % name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s counter' % metric)
+            labels = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                              for k, v in labels)
+            lines.append('%s%s %s' % (metric, '{%s}' % labels if labels
+                                      else '', value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, fmt='json'):
+        """Write the trace to `path` in one of :data:`TRACE_FORMATS`"""
+        import json
+        with open(path, 'w') as f:
+            if fmt == 'prometheus':
+                f.write(self.to_prometheus())
+            else:
+                json.dump(getattr(self, TRACE_FORMATS[fmt])(), f)
+
+
+TRACE_FORMATS = {'json': 'to_json',
+                 'chrome': 'to_chrome',
+                 'prometheus': 'to_prometheus'}
+
+# the process-wide tracer, None when tracing is off
+_tracer = None
+
+
+def configure_tracing(prefs):
+    """Turn tracing on if `--trace` was given; `--stream` only needs the
+    time of each stage, see :meth:`Tracer.timings`"""
+    global _tracer
+    options = prefs['options'] if 'options' in prefs else {}
+    if options.get('trace'):
+        _tracer = Tracer()
+    elif options.get('stream'):
+        _tracer = Tracer(keep_spans=False)
+    else:
+        _tracer = None
+    return _tracer
+
+
+def get_tracer():
+    """:return: the active :class:`Tracer`, or `None`"""
+    return _tracer
+
+
+def trace_span(name, **attrs):
+    """:return: a span timing the stage `name` (use in a `with`
+    statement); a shared no-op span when tracing is off"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **attrs)
+
+
+def trace_count(name, value=1, **labels):
+    """Add `value` to the counter `name` when tracing"""
+    if _tracer is not None:
+        _tracer.count(name, value, **labels)
+
+
+class HTTPResponse(object):
+    """A response returned by :class:`HTTPClient`.
+
+    The body is decoded (gzip/deflate) as it is read, either all at once
+    with :meth:`read` or in pieces with :meth:`iter_content`. Once the body
+    is consumed the connection goes back to the client's pool; closing a
+    response early discards its connection instead.
+    """
+    def __init__(self, client, pool_key, conn, raw, url):
+        self._client = client
+        self._pool_key = pool_key
+        self._conn = conn
+        self._raw = raw
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        # bytes received for the body, and the trace span of the request
+        self.bytes_read = 0
+        self._span = None
+        # decoded body kept for the client's fixture recorder
+        self._record = [] if client.recorder is not None else None
+        encoding = (raw.getheader('Content-Encoding') or '').lower()
+        self._decoder = None
+        if encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = _DeflateDecoder()
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        """Read up to `amt` decoded bytes (everything if `amt` is None)"""
+        if self._raw is None:
+            return b''
+        if amt is None:
+            raw = self._raw.read()
+            self.bytes_read += len(raw)
+            data = self._decode(raw, final=True)
+            self._release()
+            return data
+        while True:
+            raw = self._raw.read(amt)
+            self.bytes_read += len(raw)
+            if not raw:
+                data = self._decode(b'', final=True)
+                self._release()
+                return data
+            data = self._decode(raw)
+            if data:
+                return data
+
+    def iter_content(self, chunk_size=16384):
+        """Iterate over the decoded body in chunks"""
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _decode(self, data, final=False):
+        if self._decoder is not None:
+            data = self._decoder.decompress(data)
+            if final:
+                data += self._decoder.flush()
+        if self._record is not None:
+            self._record.append(data)
+        return data
+
+    def _release(self):
+        """Body fully read: hand the connection back for reuse"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            raw.close()
+            if self._record is not None:
+                self._client.recorder(self.url, self.status, self.headers,
+                                      b''.join(self._record))
+            if raw.will_close:
+                self._conn.close()
+            else:
+                self._client._release(self._pool_key, self._conn)
+            self._end_span()
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            # unread body: the connection cannot be reused
+            raw.close()
+            self._conn.close()
+            self._end_span()
+
+    def _end_span(self):
+        if self._span is not None:
+            self._span.end(status=self.status, bytes=self.bytes_read)
+            trace_count('http_bytes', self.bytes_read, host=self._pool_key[1])
+            self._span = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _DeflateDecoder(object):
+    """Servers disagree on whether "deflate" means zlib or raw deflate"""
+    def __init__(self):
+        self._obj = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first and data:
+            self._first = False
+            try:
+                return self._obj.decompress(data)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class HTTPClient(object):
+    """Keep-alive HTTP client shared by every fetch in adspaste.
+
+    Connections are pooled per scheme and host, responses are transparently
+    decompressed, every request carries the adspaste User-Agent and a
+    timeout. Errors are raised as `urllib.error.HTTPError` (status >= 400)
+    or `urllib.error.URLError` (network failures), like `urlopen` does.
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout=30, max_idle=8, user_agent=USER_AGENT):
+        import threading
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.user_agent = user_agent
+        # optional callable(url, status, headers, body) seeing every body
+        self.recorder = None
+        self._pool = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, headers=None, body=None, timeout=None,
+                follow_redirects=True, max_redirects=10):
+        """Send a request and return an :class:`HTTPResponse` whose body
+        has not been read yet.
+        """
+        span = None
+        if _tracer is not None:
+            span = _tracer.span('http', method=method, url=url)
+        try:
+            response = self._follow(method, url, headers, body, timeout,
+                                    follow_redirects, max_redirects)
+        except urllib.error.URLError as err:
+            if span is not None:
+                span.end(status=getattr(err, 'code', None),
+                         error=type(err).__name__)
+            raise
+        if span is not None:
+            # ended once the body is read, see HTTPResponse._end_span
+            response._span = span
+            if method == 'HEAD':
+                response._end_span()
+        return response
+
+    def _follow(self, method, url, headers, body, timeout, follow_redirects,
+                max_redirects):
+        for _ in range(max_redirects + 1):
+            response = self._request(method, url, headers, body, timeout)
+            location = response.headers.get('Location')
+            if not follow_redirects or location is None \
+                    or response.status not in self.redirect_codes:
+                break
+            response.read()  # drain so the connection can be reused
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303 or (
+                    response.status in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+        else:
+            raise urllib.error.URLError('too many redirects: %s' % url)
+
+        if response.status >= 400:
+            response.close()
+            raise urllib.error.HTTPError(url, response.status,
+                                         response.reason, response.headers,
+                                         None)
+        return response
+
+    def get(self, url, **kwargs):
+        """:return: the decoded body of `url`"""
+        with self.request('GET', url, **kwargs) as response:
+            return response.read()
+
+    def _request(self, method, url, headers, body, timeout):
+        import http.client
+        parts = urllib.parse.urlsplit(url)
+        pool_key = (parts.scheme or 'http', parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        all_headers = {'User-Agent': self.user_agent,
+                       'Accept-Encoding': 'gzip, deflate'}
+        all_headers.update(headers or {})
+        if timeout is None:
+            timeout = self.timeout
+
+        # a pooled connection may have been closed by the server in the
+        # meantime; retry once on a fresh one
+        for attempt in (0, 1):
+            conn, reused = self._connection(pool_key, timeout)
+            try:
+                conn.request(method, path, body=body, headers=all_headers)
+                raw = conn.getresponse()
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                if reused and attempt == 0 and isinstance(
+                        err, (http.client.RemoteDisconnected,
+                              ConnectionResetError, BrokenPipeError)):
+                    continue
+                raise urllib.error.URLError(err)
+            break
+        if method == 'HEAD':
+            raw.read()
+        return HTTPResponse(self, pool_key, conn, raw, url)
+
+    def _connection(self, pool_key, timeout):
+        """:return: (connection, reused) for `pool_key`"""
+        import http.client
+        with self._lock:
+            idle = self._pool.get(pool_key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, netloc = pool_key
+        if scheme == 'https':
+            import ssl
+            conn = http.client.HTTPSConnection(
+                netloc, timeout=timeout,
+                context=ssl.create_default_context())
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=timeout)
+        return conn, False
+
+    def _release(self, pool_key, conn):
+        with self._lock:
+            idle = self._pool.setdefault(pool_key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            pool, self._pool = self._pool, {}
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+
+
+# the process-wide HTTP client, see get_http_client()
+_http_client = None
+
+
+def configure_http(prefs):
+    """Set up the shared HTTP client from the preferences"""
+    global _http_client
+    _http_client = HTTPClient(timeout=float(prefs['timeout']))
+    return _http_client
+
+
+def get_http_client():
+    """:return: the shared :class:`HTTPClient`"""
+    global _http_client
+    if _http_client is None:
+        _http_client = HTTPClient()
+    return _http_client
+
+
+class ResponseCache(object):
+    """Persistent cache of HTTP response bodies in a single SQLite file.
+
+    Entries are keyed by article identity (see :func:`cache_key`) rather
+    than by URL, so the same paper fetched through different ADS mirrors
+    is stored once. Entries older than `ttl` seconds are discarded on
+    read, and the least recently used entries are evicted once the store
+    grows beyond `max_size` bytes.
+
+    With ``refresh=True`` cached entries are never returned, but fresh
+    responses are still stored.
+    """
+    def __init__(self, path, ttl=7 * 86400, max_size=100 * 2 ** 20,
+                 refresh=False):
+        import sqlite3
+        import threading
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, url TEXT, data BLOB, size INTEGER, '
+            'created REAL, accessed REAL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed '
+            'ON responses (accessed)')
+        self._db.commit()
+
+    def get(self, key):
+        """:return: the cached body for `key`, or `None` on a miss"""
+        if self.refresh:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data, created FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?',
+                                 (key,))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? '
+                             'WHERE key = ?', (now, key))
+            self._db.commit()
+        logging.debug('ResponseCache hit %s', key)
+        return bytes(row[0])
+
+    def get_many(self, keys, chunk_size=500):
+        """Like :meth:`get` for many keys, in one transaction.
+
+        :return: dict of key -> cached body, for the keys cached
+        """
+        found = {}
+        if self.refresh:
+            return found
+        keys = list(keys)
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                rows = self._db.execute(
+                    'SELECT key, data, created FROM responses WHERE key IN '
+                    '(%s)' % ','.join('?' * len(chunk)), chunk).fetchall()
+                for key, data, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = bytes(data)
+            expired = [key for key in keys if key not in found]
+            self._db.executemany('DELETE FROM responses WHERE key = ?',
+                                 [(key,) for key in expired])
+            self._db.executemany('UPDATE responses SET accessed = ? '
+                                 'WHERE key = ?',
+                                 [(now, key) for key in found])
+            self._db.commit()
+        return found
+
+    def put_many(self, items):
+        """Like :meth:`put` for an iterable of (key, data, url), in one
+        transaction"""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                [(key, url, data, len(data), now, now)
+                 for key, data, url in items])
+            self._evict()
+            self._db.commit()
+
+    def put(self, key, data, url=None):
+        """Store `data` under `key`, evicting old entries if needed"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, url, data, len(data), now, now))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until under `max_size`"""
+        if not self.max_size:
+            return
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._db.execute(
+            'SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# the process-wide response cache, set up by configure_cache()
+_response_cache = None
+
+
+def configure_cache(prefs):
+    """Open the response cache described by the preferences.
+
+    The cache is disabled with the `--no-cache` option (or
+    ``cache=False`` in ~/.adsbibdesk); `--refresh` bypasses cached
+    entries while still storing new ones.
+    """
+    global _response_cache
+    options = prefs['options'] if 'options' in prefs else {}
+    if options.get('no_cache') or not prefs['cache']:
+        _response_cache = None
+        return None
+    try:
+        _response_cache = ResponseCache(
+            os.path.expanduser(prefs['cache_path']),
+            ttl=float(prefs['cache_ttl']) * 86400,
+            max_size=float(prefs['cache_size']) * 2 ** 20,
+            refresh=bool(options.get('refresh')))
+    except Exception as err:
+        # never let a broken cache file stop us from fetching
+        logging.debug('Response cache disabled: %s', err)
+        _response_cache = None
+    return _response_cache
+
+
+def get_response_cache():
+    """:return: the configured :class:`ResponseCache`, or `None`"""
+    return _response_cache
+
+
+class PaperIndex(object):
+    """Persistent index of the papers resolved, in a single SQLite file.
+
+    Each paper is stored once, as its final BibTeX entry, under all of
+    its identifiers: bibcode, DOI, arXiv identifier and the tokens it was
+    asked for as. Identifiers are normalized with :func:`index_key`, so
+    an ADS URL on any mirror, an arXiv URL or a bare identifier all find
+    the same paper. Titles, authors and abstracts are indexed for
+    :meth:`search` (with FTS5 when SQLite has it).
+
+    Pre-prints are only returned for `preprint_ttl` seconds, so that a
+    refereed version gets picked up; other entries do not expire. A
+    pre-print is replaced by its refereed version once that is stored. With
+    ``refresh=True`` nothing is returned, but papers are still stored.
+    """
+    def __init__(self, path, preprint_ttl=7 * 86400, refresh=False):
+        import sqlite3
+        import threading
+        self.path = path
+        self.preprint_ttl = preprint_ttl
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS papers ('
+            'id INTEGER PRIMARY KEY, bibcode TEXT UNIQUE, bibtex TEXT, '
+            'title TEXT, author TEXT, preprint INTEGER, updated REAL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS identifiers ('
+            'identifier TEXT PRIMARY KEY, paper INTEGER)')
+        try:
+            self._db.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS papers_text '
+                'USING fts5(title, author, abstract)')
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: search with LIKE instead
+            self.fts = False
+        self._db.commit()
+
+    def get(self, token):
+        """:return: the :class:`BibTex` entry of the paper `token`
+        identifies, or `None`"""
+        return self.get_many([token]).get(token)
+
+    def get_many(self, tokens, chunk_size=500):
+        """Like :meth:`get` for many tokens, in one transaction.
+
+        :return: dict of token -> :class:`BibTex`, for the tokens known
+        """
+        found = {}
+        if self.refresh:
+            return found
+        keys = {}
+        for token in tokens:
+            keys.setdefault(index_key(token), []).append(token)
+        identifiers = list(keys)
+        expired = time.time() - self.preprint_ttl
+        with self._lock:
+            for start in range(0, len(identifiers), chunk_size):
+                chunk = identifiers[start:start + chunk_size]
+                rows = self._db.execute(
+                    'SELECT identifier, bibtex, preprint, updated '
+                    'FROM identifiers JOIN papers ON paper = papers.id '
+                    'WHERE identifier IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk).fetchall()
+                for identifier, bibtex, preprint, updated in rows:
+                    if preprint and updated < expired:
+                        continue
+                    for token in keys[identifier]:
+                        found[token] = next(BibTex.iter_entries(bibtex))
+        if found:
+            trace_count('index_lookups', len(found), result='hit')
+        return found
+
+    def add(self, entry, tokens=()):
+        """Store the :class:`BibTex` `entry` under its identifiers and the
+        article `tokens` that resolved to it"""
+        self.add_many([(entry, tokens)])
+
+    def add_many(self, items):
+        """Like :meth:`add` for an iterable of (entry, tokens), in one
+        transaction"""
+        import sqlite3
+        now = time.time()
+        try:
+            with self._lock:
+                for entry, tokens in items:
+                    self._add(entry, tokens, now)
+                self._db.commit()
+        except sqlite3.Error as err:
+            # never let a broken index stop a run
+            logging.debug('Could not index papers: %s', err)
+
+    def _add(self, entry, tokens, now):
+        fields = dict((name.lower(), value)
+                      for name, value in entry.info.items())
+        title = bibtex_text(fields.get('title', ''))
+        author = bibtex_text(fields.get('author', ''))
+        preprint = bibtex_arxiv_id(entry.bibcode, entry.info) is not None
+        self._db.execute(
+            'INSERT INTO papers (bibcode, bibtex, title, author, preprint, '
+            'updated) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (bibcode) DO '
+            'UPDATE SET bibtex = excluded.bibtex, title = excluded.title, '
+            'author = excluded.author, preprint = excluded.preprint, '
+            'updated = excluded.updated',
+            (entry.bibcode, str(entry), title, author, preprint, now))
+        paper = self._db.execute('SELECT id FROM papers WHERE bibcode = ?',
+                                 (entry.bibcode,)).fetchone()[0]
+        identifiers = paper_identifiers(entry) + [index_key(t)
+                                                  for t in tokens]
+        previous = self._db.execute(
+            'SELECT DISTINCT paper, preprint FROM identifiers '
+            'JOIN papers ON paper = papers.id '
+            'WHERE identifier IN (%s) AND paper != ?'
+            % ','.join('?' * len(identifiers)),
+            identifiers + [paper]).fetchall()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO identifiers VALUES (?, ?)',
+            [(identifier, paper) for identifier in identifiers])
+        for old, old_preprint in previous:
+            if old_preprint and not preprint:
+                # the refereed version of a pre-print: the pre-print's
+                # own bibcode now finds it too
+                self._db.execute(
+                    'UPDATE identifiers SET paper = ? WHERE paper = ?',
+                    (paper, old))
+            if self._db.execute(
+                    'SELECT 1 FROM identifiers WHERE paper = ? LIMIT 1',
+                    (old,)).fetchone() is None:
+                # no identifier left: do not let search return it
+                self._db.execute('DELETE FROM papers WHERE id = ?', (old,))
+                if self.fts:
+                    self._db.execute(
+                        'DELETE FROM papers_text WHERE rowid = ?', (old,))
+        if self.fts:
+            self._db.execute('DELETE FROM papers_text WHERE rowid = ?',
+                             (paper,))
+            self._db.execute(
+                'INSERT INTO papers_text (rowid, title, author, abstract) '
+                'VALUES (?, ?, ?, ?)',
+                (paper, title, author,
+                 bibtex_text(fields.get('abstract', ''))))
+
+    def search(self, query, limit=20):
+        """:return: the :class:`BibTex` entries whose title, authors or
+        abstract match `query` (FTS5 syntax, e.g. ``author:nemmen jet*``),
+        best matches first"""
+        with self._lock:
+            if self.fts:
+                rows = self._db.execute(
+                    'SELECT bibtex FROM papers_text JOIN papers '
+                    'ON papers.id = papers_text.rowid '
+                    'WHERE papers_text MATCH ? ORDER BY rank LIMIT ?',
+                    (query, limit)).fetchall()
+            else:
+                pattern = '%' + query + '%'
+                rows = self._db.execute(
+                    'SELECT bibtex FROM papers WHERE title LIKE ? '
+                    'OR author LIKE ? ORDER BY updated DESC LIMIT ?',
+                    (pattern, pattern, limit)).fetchall()
+        return [next(BibTex.iter_entries(bibtex)) for bibtex, in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def index_key(token):
+    """:return: the normalized identifier a :class:`PaperIndex` stores
+    the article `token` under, e.g. ``bibcode:1998ApJ...500..525S``,
+    ``doi:10.1093/mnras/stv260`` or ``arxiv:1406.7420``"""
+    kind, value = classify_token(token)
+    if kind == 'doi':
+        value = value.lower()
+    return '%s:%s' % (kind, value)
+
+
+def paper_identifiers(entry):
+    """:return: the :func:`index_key` identifiers of a :class:`BibTex`
+    entry: its bibcode, DOI and arXiv identifier"""
+    fields = dict((name.lower(), value) for name, value in entry.info.items())
+    identifiers = ['bibcode:' + entry.bibcode]
+    doi = bibtex_text(fields.get('doi', ''))
+    if doi:
+        identifiers.append(index_key(doi))
+    kind, value = classify_token(bibtex_text(fields.get('eprint', '')))
+    if kind == 'arxiv':
+        identifiers.append('arxiv:' + value)
+    return identifiers
+
+
+# the process-wide paper index, set up by configure_index()
+_paper_index = None
+
+
+def configure_index(prefs):
+    """Open the paper index described by the preferences.
+
+    The index is disabled with `--no-cache` (or ``index=False`` in
+    ~/.adsbibdesk); with `--refresh` every token is resolved again.
+    Pre-prints are re-checked after `cache_ttl` days.
+    """
+    global _paper_index
+    options = prefs['options'] if 'options' in prefs else {}
+    if options.get('no_cache') or not prefs['index']:
+        _paper_index = None
+        return None
+    try:
+        _paper_index = PaperIndex(
+            os.path.expanduser(prefs['index_path']),
+            preprint_ttl=float(prefs['cache_ttl']) * 86400,
+            refresh=bool(options.get('refresh')))
+    except Exception as err:
+        logging.debug('Paper index disabled: %s', err)
+        _paper_index = None
+    return _paper_index
+
+
+def get_paper_index():
+    """:return: the configured :class:`PaperIndex`, or `None`"""
+    return _paper_index
+
+
+def search_index(query, prefs, limit=20, output=None, fmt='bibtex'):
+    """Workflow for `--search`: write the indexed papers matching `query`
+    (see :meth:`PaperIndex.search`) to `output`, no network involved"""
+    import sqlite3
+    index = get_paper_index()
+    if index is None:
+        logging.error("The paper index is disabled")
+        return []
+    try:
+        entries = index.search(query, limit=limit)
+    except sqlite3.OperationalError as err:
+        logging.error("Bad search %r: %s" % (query, err))
+        return []
+    writer = open_writer(fmt, output)
+    try:
+        for entry in entries:
+            writer.write(entry)
+    finally:
+        writer.close()
+    logging.info("%d indexed papers match %r" % (len(entries), query))
+    return entries
+
+
+# cache key prefix of a body that was only read in part
+PARTIAL_PREFIX = 'partial:'
+
+
+def cache_key(url):
+    """Canonical cache key for an ADS or arXiv URL.
+
+    Responses are keyed by the article they are about: ADS abstract
+    pages by the :func:`index_key` of their bibcode, DOI or arXiv
+    identifier (``/abs/``, ``/doi/`` and ``bib_query?arXiv:`` URLs on
+    any mirror, with or without a version suffix), BibTeX exports by
+    bibcode and arXiv API queries by arXiv identifier. Other ADS pages
+    are keyed by path, the mirror host being dropped so that all
+    mirrors share entries.
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query)
+    if 'bibcode' in query and \
+            query.get('data_type', [''])[0].upper() == 'BIBTEX':
+        return 'bibtex:' + query['bibcode'][0]
+    if 'id_list' in query:
+        return 'arxiv:' + query['id_list'][0]
+    path = urllib.parse.unquote(parts.path)
+    if path.startswith('/abs/'):
+        token = path[len('/abs/'):].split('/')[0]
+    elif path.startswith('/doi/'):
+        token = path[len('/doi/'):]
+    elif path == '/cgi-bin/bib_query' and \
+            parts.query.lower().startswith('arxiv:'):
+        token = urllib.parse.unquote(parts.query)
+    else:
+        token = None
+    if token is not None:
+        key = index_key(token)
+        if key.split(':', 1)[0] in ('bibcode', 'doi', 'arxiv'):
+            return 'ads:' + key
+    key = 'ads:' + parts.path.lstrip('/')
+    if parts.query:
+        key += '?' + parts.query
+    return key
+
+
+def cache_lookup(url, key=None, partial=False):
+    """:return: the cached body of `url`, or `None` if not cached. With
+    `partial`, the prefix cached by a reader that stopped early (see
+    :class:`URLStream`) will do when the whole body is not cached."""
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    key = key or cache_key(url)
+    data = cache.get(key)
+    if data is None and partial:
+        data = cache.get(PARTIAL_PREFIX + key)
+    return data
+
+
+def fetch_url(url, key=None):
+    """Read the body of `url`, going through the response cache.
+
+    :param key: cache key, derived from `url` with :func:`cache_key`
+        when not given
+    :return: the response body as bytes
+    """
+    with open_url(url, key) as stream:
+        return stream.read()
+
+
+def open_url(url, key=None, partial=False):
+    """Like :func:`fetch_url`, but the body is left unread so that it can
+    be consumed piece by piece. With `partial`, the caller only reads
+    as far as it needs, and a cached prefix will do (see
+    :func:`cache_lookup`).
+
+    :return: a :class:`URLStream`
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        key = key or cache_key(url)
+        data = cache_lookup(url, key, partial)
+        trace_count('cache_requests', result='miss' if data is None
+                    else 'hit')
+        if data is not None:
+            return URLStream(url, data=data)
+    return URLStream(url, response=get_http_client().request('GET', url),
+                     cache=cache, key=key)
+
+
+class URLStream(object):
+    """The body of a URL, either cached `data` or an unread `response`.
+
+    Iterating yields the body in chunks of bytes. On :meth:`close`, the
+    part that was read goes to the response cache: a reader that stops
+    early (like :class:`ADSHTMLParser`) only caches the prefix it needed,
+    under a key of its own (with `PARTIAL_PREFIX`) so that it is never
+    taken for the whole body, and the connection is dropped instead of
+    downloading the rest.
+    """
+    chunk_size = 16384
+
+    def __init__(self, url, data=None, response=None, cache=None, key=None):
+        self.url = url
+        self._data = data
+        self._response = response
+        self._cache = cache
+        self._key = key
+        self._parts = []
+        self.complete = data is not None
+
+    def __iter__(self):
+        if self._data is not None:
+            yield self._data
+            return
+        for chunk in self._response.iter_content(self.chunk_size):
+            self._parts.append(chunk)
+            yield chunk
+        self.complete = True
+
+    def read(self):
+        """:return: the whole body"""
+        if self._data is None and self._response is not None:
+            self._parts.append(self._response.read())
+            self.complete = True
+            self._data = b''.join(self._parts)
+            self.close()
+        return self._data
+
+    def close(self, cache=True):
+        """Stop reading; with `cache`, store what was read so far"""
+        response, self._response = self._response, None
+        if response is None:
+            return
+        if not self.complete:
+            response.close()
+        if cache and self._cache is not None and self._parts:
+            key = self._key if self.complete else PARTIAL_PREFIX + self._key
+            self._cache.put(key, b''.join(self._parts), self.url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cache=exc_type is None)
+
+
+class MirrorManager(object):
+    """Chooses the ADS mirror to send requests to.
+
+    A moving average of the latency and error rate of each mirror is kept
+    (and saved in `state_path` between runs). Requests go to the preferred
+    mirror while it is healthy, or, with ``auto=True``, to the fastest
+    healthy mirror; on network errors or server failures
+    :meth:`open` fails over to the next mirror in line.
+    """
+    # weight of the newest sample in the moving averages
+    alpha = 0.3
+    # mirrors failing more often than this are skipped...
+    max_error_rate = 0.5
+    # ...until this many seconds after their last error
+    retry_after = 600
+
+    def __init__(self, mirrors, preferred=None, auto=False, state_path=None,
+                 scheme='http', max_failover=3):
+        import threading
+        self.mirrors = list(mirrors)
+        self.preferred = preferred or self.mirrors[0]
+        if self.preferred not in self.mirrors:
+            self.mirrors.insert(0, self.preferred)
+        self.auto = auto
+        self.state_path = state_path
+        self.scheme = scheme
+        self.max_failover = max_failover
+        self.stats = {}
+        self._lock = threading.Lock()
+        if state_path:
+            self.load()
+
+    def load(self):
+        """Read mirror statistics from `state_path`, if any"""
+        import json
+        try:
+            with open(self.state_path) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        with self._lock:
+            self.stats.update((m, s) for m, s in stats.items()
+                              if m in self.mirrors)
+
+    def save(self):
+        """Write mirror statistics to `state_path`"""
+        import json
+        if not self.state_path:
+            return
+        with self._lock:
+            stats = dict(self.stats)
+        tmp = self.state_path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(stats, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.state_path)
+        except (IOError, OSError) as err:
+            logging.debug("Could not save mirror state: %s", err)
+
+    def record(self, mirror, latency=None, error=False):
+        """Add a sample for `mirror`: a request latency or an error"""
+        now = time.time()
+        with self._lock:
+            stats = self.stats.setdefault(
+                mirror, {'latency': None, 'error_rate': 0., 'last_error': 0,
+                         'updated': 0})
+            stats['error_rate'] = (self.alpha * bool(error) +
+                                   (1 - self.alpha) * stats['error_rate'])
+            if error:
+                stats['last_error'] = now
+            elif latency is not None:
+                if stats['latency'] is None:
+                    stats['latency'] = latency
+                else:
+                    stats['latency'] = (self.alpha * latency +
+                                        (1 - self.alpha) * stats['latency'])
+            stats['updated'] = now
+
+    def healthy(self, mirror):
+        stats = self.stats.get(mirror)
+        return stats is None or stats['error_rate'] < self.max_error_rate \
+            or time.time() - stats['last_error'] > self.retry_after
+
+    def ranked(self):
+        """:return: all mirrors, in the order they should be tried"""
+        def latency(mirror):
+            stats = self.stats.get(mirror) or {}
+            if stats.get('latency') is None:
+                return float('inf')
+            return stats['latency']
+
+        with self._lock:
+            healthy = [m for m in self.mirrors if self.healthy(m)]
+            sick = sorted(
+                (m for m in self.mirrors if m not in healthy),
+                key=lambda m: self.stats[m]['error_rate'])
+            if self.auto:
+                healthy.sort(key=latency)
+            elif self.preferred in healthy:
+                healthy.remove(self.preferred)
+                healthy = [self.preferred] + sorted(healthy, key=latency)
+            else:
+                healthy.sort(key=latency)
+        return healthy + sick
+
+    def best(self):
+        """:return: the mirror requests should go to now"""
+        return self.ranked()[0]
+
+    def probe(self, timeout=5, jobs=None):
+        """Measure the latency of every mirror concurrently"""
+        from concurrent.futures import ThreadPoolExecutor
+        client = get_http_client()
+
+        def ping(mirror):
+            start = time.time()
+            try:
+                client.request('HEAD', '%s://%s/' % (self.scheme, mirror),
+                               timeout=timeout,
+                               follow_redirects=False).close()
+            except urllib.error.HTTPError as err:
+                # any answer but a server failure means the mirror is up
+                self.record(mirror, time.time() - start,
+                            error=err.code >= 500)
+            except urllib.error.URLError:
+                self.record(mirror, error=True)
+            else:
+                self.record(mirror, time.time() - start)
+
+        with ThreadPoolExecutor(max_workers=jobs or len(self.mirrors)) as ex:
+            list(ex.map(ping, self.mirrors))
+        logging.debug("Mirrors ranked after probe: %s", self.ranked())
+
+    def stale(self, max_age=86400):
+        """:return: True if no mirror was measured in `max_age` seconds"""
+        updated = [s['updated'] for s in self.stats.values()]
+        return not updated or time.time() - max(updated) > max_age
+
+    def open(self, url, partial=False):
+        """Open an ADS `url` on the best mirror, failing over to the next
+        ones on network errors and server failures. The body is left
+        unread: failing over only happens until a mirror answers.
+        `partial` is passed on to :func:`open_url`.
+
+        :return: a :class:`URLStream` whose `url` is the one actually
+            fetched
+        """
+        data = cache_lookup(url, partial=partial)
+        if data is not None:
+            return URLStream(url, data=data)
+        parts = urllib.parse.urlsplit(url)
+        candidates = self.ranked()[:self.max_failover]
+        error = None
+        for mirror in candidates:
+            mirror_url = urllib.parse.urlunsplit(
+                (self.scheme, mirror) + tuple(parts[2:]))
+            start = time.time()
+            try:
+                stream = open_url(mirror_url, partial=partial)
+            except urllib.error.HTTPError as err:
+                if err.code < 500 and err.code != 429:
+                    # a genuine answer, e.g. 404 for an unknown bibcode
+                    self.record(mirror, time.time() - start)
+                    raise
+                self.record(mirror, error=True)
+                error = err
+            except urllib.error.URLError as err:
+                self.record(mirror, error=True)
+                error = err
+            else:
+                self.record(mirror, time.time() - start)
+                return stream
+            logging.debug("ADS mirror %s failed (%s), failing over",
+                          mirror, error)
+        raise error
+
+
+# the process-wide mirror manager, set up by configure_mirrors()
+_mirror_manager = None
+
+
+def configure_mirrors(prefs):
+    """Set up the ADS mirror manager from the preferences, probing the
+    mirrors when automatic selection is on and the statistics are old.
+    """
+    global _mirror_manager
+    options = prefs['options'] if 'options' in prefs else {}
+    auto = bool(prefs['auto_mirror'] or options.get('auto_mirror'))
+    _mirror_manager = MirrorManager(
+        prefs.adsmirrors, preferred=prefs['ads_mirror'], auto=auto,
+        state_path=os.path.expanduser(prefs['mirror_state_path']))
+    if options.get('probe_mirrors') or (auto and _mirror_manager.stale()):
+        _mirror_manager.probe()
+        _mirror_manager.save()
+    return _mirror_manager
+
+
+def get_mirror_manager():
+    """:return: the configured :class:`MirrorManager`, or `None`"""
+    return _mirror_manager
+
 
+def fetch_ads_url(url):
+    """Like :func:`fetch_url`, but URLs on ADS mirrors fail over to
+    other mirrors.
+
+    :return: (body, the URL actually fetched)
+    """
+    with open_ads_url(url) as stream:
+        return stream.read(), stream.url
+
+
+def open_ads_url(url, partial=False):
+    """Like :func:`open_url`, failing over to other ADS mirrors
+
+    :return: a :class:`URLStream`
+    """
+    manager = get_mirror_manager()
+    if manager is None or urllib.parse.urlsplit(url).netloc \
+            not in manager.mirrors:
+        return open_url(url, partial=partial)
+    return manager.open(url, partial=partial)
+
+
+ADS_MIRRORS = ('adsabs.harvard.edu',
+               'cdsads.u-strasbg.fr',
+               'ukads.nottingham.ac.uk',
+               'esoads.eso.org',
+               'ads.ari.uni-heidelberg.de',
+               'ads.inasan.ru',
+               'ads.mao.kiev.ua',
+               'ads.astro.puc.cl',
+               'ads.on.br',
+               'ads.nao.ac.jp',
+               'ads.bao.ac.cn',
+               'ads.iucaa.ernet.in',
+               'www.ads.lipi.go.id')
+
+ARXIV_HOSTS = ('arxiv.org', 'export.arxiv.org', 'xxx.lanl.gov')
+
+# YYYYJJJJJVVVVMPPPPA, e.g. 1998ApJ...500..525S or 2014arXiv1406.7420N
+BIBCODE_RE = re.compile(r'^\d{4}[A-Za-z&][\w&.]{4}[\w.]{4}[\w.:][\w.]{4}'
+                        r'[A-Za-z.]$')
+DOI_RE = re.compile(r'^(?:doi:\s*)?(10\.\d{4,9}/\S+)$', re.I)
+# new style (YYMM.NNNNN) and old style (astro-ph/YYMMNNN) arXiv identifiers
+ARXIV_ID_RE = re.compile(
+    r'^(?:arxiv:)?(\d{4}\.\d{4,5}|[a-z][a-z\-]+(?:\.[a-z]{2})?/\d{7})'
+    r'(?:v\d+)?$', re.I)
+# arXiv identifiers embedded anywhere in a token
+ARXIV_SEARCH_RE = re.compile(r'(\d{4,6}\.\d{4,6}|astro\-ph/\d{7})')
+ARXIV_PATH_RE = re.compile(
+    r'^/(?:abs|pdf|ps)/(\d{4}\.\d{4,5}|[a-z][a-z\-]+(?:\.[a-z]{2})?/\d{7})'
+    r'(?:v\d+)?(?:\.pdf)?/?$', re.I)
+ADS_ABS_PATH_RE = re.compile(r'^/(?:abs|full)/([^/]{19})(?:/.*)?$')
+URL_LIKE_RE = re.compile(r'^(?:https?://)?[\w\-]+(?:\.[\w\-]+)+(?::\d+)?/',
+                         re.I)
+
+
+def classify_token(token, mirrors=ADS_MIRRORS):
+    """Classify an article token without any network access.
+
+    :param mirrors: ADS mirror hosts whose URLs are recognised
+    :return: a ``(kind, value)`` tuple where kind is one of
+
+        - ``'arxiv'``: value is the arXiv identifier (no version)
+        - ``'bibcode'``: value is the ADS bibcode
+        - ``'doi'``: value is the DOI
+        - ``'ads_url'``: another ADS page; value is the URL
+        - ``'url'``: a URL on an unknown host; value is the URL
+        - ``'unknown'``: none of the above; value is the token
+    """
+    token = token.strip()
+    match = ARXIV_ID_RE.match(token)
+    if match:
+        return 'arxiv', match.group(1)
+    if len(token) == 19 and BIBCODE_RE.match(token):
+        return 'bibcode', token
+    match = DOI_RE.match(token)
+    if match:
+        return 'doi', match.group(1)
+
+    if URL_LIKE_RE.match(token):
+        url = token if '://' in token else 'http://' + token
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname or ''
+        if host in mirrors or host.endswith('adsabs.harvard.edu'):
+            match = ADS_ABS_PATH_RE.match(
+                urllib.parse.unquote(parts.path))
+            if match and BIBCODE_RE.match(match.group(1)):
+                return 'bibcode', match.group(1)
+            if parts.path.startswith('/doi/'):
+                return 'doi', urllib.parse.unquote(parts.path[5:])
+            query = urllib.parse.parse_qs(parts.query)
+            if 'bibcode' in query and BIBCODE_RE.match(query['bibcode'][0]):
+                return 'bibcode', query['bibcode'][0]
+            return 'ads_url', url
+        if host in ARXIV_HOSTS or host.endswith('.arxiv.org'):
+            match = ARXIV_PATH_RE.match(parts.path)
+            if match:
+                return 'arxiv', match.group(1)
+        if host in ('doi.org', 'dx.doi.org'):
+            match = DOI_RE.match(urllib.parse.unquote(parts.path[1:]))
+            if match:
+                return 'doi', match.group(1)
+        arxiv_matches = ARXIV_SEARCH_RE.findall(token)
+        if len(arxiv_matches) == 1:
+            return 'arxiv', arxiv_matches[0]
+        return 'url', url
+
+    arxiv_matches = ARXIV_SEARCH_RE.findall(token)
+    if len(arxiv_matches) == 1:
+        return 'arxiv', arxiv_matches[0]
+    return 'unknown', token
 
 
 class ADSConnector(object):
     """Receives input (token), derives an ADS url, and attempts to connect
-    to the corresponding ADS abstract page with urllib2.urlopen().
+    to the corresponding ADS abstract page with the shared HTTPClient.
 
-    Tokens are tested in order of:
+    Tokens are classified locally by :func:`classify_token` so that only
+    the matching ADS endpoint is requested:
 
-    - arxiv identifiers
+    - arxiv identifiers and arxiv urls
     - bibcodes / digital object identifier (DOI)
     - ADS urls
-    - arxiv urls
+
+    When ADS has no page for an arXiv identifier, the arXiv API is asked
+    instead, through `arxiv_batch` (an :class:`ArXivBatch`) if given.
     """
-    def __init__(self, token, prefs):
+    def __init__(self, token, prefs, arxiv_batch=None):
         super(ADSConnector, self).__init__()
         self.token = str(token)
         self.prefs = prefs
         self.ads_url = None  # string URL to ADS
-        self.ads_read = None  # a urllib2.urlopen connection to ADS
-        self.url_parts = urllib.parse.urlsplit(token)  # supposing it is a URL
+        self.ads_read = None  # the ADS abstract page, as a URLStream
+        self.arxiv_id = None
+        self.kind, value = classify_token(self.token, self.prefs.adsmirrors)
 
         # An arXiv identifier or URL?
-        if self._is_arxiv():
-            logging.debug("ADSConnector found arXiv ID %s", self.token)
+        if self.kind == 'arxiv':
+            self.arxiv_id = value
+            logging.debug("ADSConnector found arXiv ID %s", self.arxiv_id)
+            self.ads_url = urllib.parse.urlunsplit((
+                'http',
+                self.prefs['ads_mirror'],
+                'cgi-bin/bib_query',
+                'arXiv:%s' % self.arxiv_id, ''))
             # Try to open the ADS page
-            if not self._read(self.ads_url):
+            if self._read(self.ads_url):
+                if arxiv_batch is not None:
+                    arxiv_batch.resolved(self.arxiv_id)
+            else:
                 # parse arxiv instead:
                 logging.debug('ADS page (%s) not found for %s' %
                               (self.ads_url, self.token))
                 notify('ADS page not found', self.token,
                        'Parsing the arXiv page...')
-                arxiv_bib = ArXivParser()
-                try:
-                    arxiv_bib.parse_at_id(self.arxiv_id)
-                    logging.debug(
-                        "arXiv page (%s) parsed for %s"
-                        % (arxiv_bib.url, self.token))
-                except ArXivException as err:
-                    logging.debug("ADS and arXiv failed, you're in trouble...")
-                    raise ADSException(err)
+                arxiv_bib = arxiv_batch.get(self.arxiv_id) \
+                    if arxiv_batch is not None else None
+                if arxiv_bib is None:
+                    arxiv_bib = ArXivParser()
+                    try:
+                        arxiv_bib.parse_at_id(self.arxiv_id)
+                    except ArXivException as err:
+                        logging.debug(
+                            "ADS and arXiv failed, you're in trouble...")
+                        raise ADSException(err)
+                logging.debug("arXiv page (%s) parsed for %s"
+                              % (arxiv_bib.url, self.token))
 
                 # dummy ads_read and bibtex
                 self.ads_read = True
                 self.bibtex = arxiv_bib
 
-        # A bibcode from ADS?
-        elif not self.url_parts.scheme and self._is_bibcode():
-            logging.debug("ADSConnector found bibcode/DOI %s", self.token)
-        else:
-            # If the path lacks http://, tack it on because
-            # the token *must* be a URL now
-            if not self.token.startswith("http://"):
-                self.token = 'http://' + self.token
-            # supposing it is a URL
-            self.url_parts = urllib.parse.urlsplit(self.token)
-
-            # An abstract page at any ADS mirror site?
-            if self.url_parts.netloc in self.prefs.adsmirrors \
-                    and self._is_ads_page():
-                logging.debug("ADSConnector found ADS page %s", self.token)
-
-    def _is_arxiv(self):
-        """Try to classify the token as an arxiv article, either:
-
-        - new style (YYMM.NNNN), or
-        - old style (astro-ph/YYMMNNN)
-
-        :return: True if ADS page is recovered
-        """
-        arxiv_pattern = re.compile('(\d{4,6}\.\d{4,6}|astro\-ph/\d{7})')
-        arxiv_matches = arxiv_pattern.findall(self.token)
-        if len(arxiv_matches) == 1:
-            self.arxiv_id = arxiv_matches[0]
+        # A bibcode or DOI, possibly from an ADS URL?
+        elif self.kind in ('bibcode', 'doi'):
+            logging.debug("ADSConnector found %s %s", self.kind, value)
             self.ads_url = urllib.parse.urlunsplit((
-                'http',
-                self.prefs['ads_mirror'],
-                'cgi-bin/bib_query',
-                'arXiv:%s' % self.arxiv_id, ''))
-            return True
+                'http', self.prefs['ads_mirror'],
+                '%s/%s' % ('doi' if self.kind == 'doi' else 'abs', value),
+                '', ''))
+            self._read(self.ads_url)
+
+        # Any other abstract page at an ADS mirror site?
+        elif self.kind == 'ads_url':
+            logging.debug("ADSConnector found ADS page %s", value)
+            self.url_parts = urllib.parse.urlsplit(value)
+            self._is_ads_page()
+
+        # Unrecognised: let ADS decide whether it is a bibcode or a DOI
+        elif self.kind == 'unknown':
+            logging.debug("ADSConnector probing ADS for %s", self.token)
+            self._is_bibcode()
+
         else:
-            self.arxiv_id = None
-            return False
+            logging.debug("ADSConnector cannot handle URL %s", value)
 
     def _is_bibcode(self):
-        """Test if the token corresponds to an ADS bibcode or DOI"""
+        """Test if the token corresponds to an ADS bibcode or DOI by
+        probing both ADS endpoints. Only used for tokens that
+        :func:`classify_token` does not recognise.
+        """
+        with trace_span('is_bibcode'):
+            return self._probe_bibcode()
+
+    def _probe_bibcode(self):
         self.ads_url = urllib.parse.urlunsplit((
             'http', self.prefs['ads_mirror'],
             'doi/%s' % self.token, '', ''))
@@ -468,64 +3454,92 @@ class ADSConnector(object):
         return self._read(self.ads_url)
 
     def _read(self, ads_url):
-        """Attempt a connection to ads_url, saving the read to
+        """Attempt a connection to ads_url, saving the unread page to
         self.ads_read.
 
         :return: True if successful, False otherwise
         """
         try:
-            # remove <head>...</head> - often broken HTML
-            self.ads_read = re.sub(
-                r'<head>[\s\S]*</head>', '',
-                urllib.request.urlopen(ads_url).read())
-            return True
+            with trace_span('abstract', url=ads_url):
+                stream = open_ads_url(ads_url, partial=True)
         except urllib.error.HTTPError:
             return False
+        # the body is read by ADSHTMLParser.parse, only as far as needed
+        self.ads_url = stream.url
+        self.ads_read = stream
+        return True
 
 
-class Preferences(object):
-    """Manages the preferences on disk and in memory. Preferences are accessed
-    with by a dictionary-like interface.
+def parse_pref_value(value):
+    """:return: a preference value as read from ~/.adsbibdesk, the
+    environment or the command line: empty and ``none`` are None,
+    ``true``/``yes`` and ``false``/``no`` are booleans, anything else is
+    kept as a string
     """
+    if not value:
+        return None
+    elif value.strip().lower() in ('true', 'yes'):
+        return True
+    elif value.strip().lower() in ('false', 'no'):
+        return False
+    elif value.strip().lower() == 'none':
+        return None
+    return value
+
+
+def parse_pref_overrides(settings):
+    """:return: a dict of preferences from ``KEY=VALUE`` strings (`--set`)"""
+    overrides = {}
+    for setting in settings or ():
+        if '=' not in setting:
+            raise ValueError("expected KEY=VALUE, got %r" % setting)
+        key, value = setting.split('=', 1)
+        overrides[key.strip()] = parse_pref_value(value.strip())
+    return overrides
+
+
+class PreferencesStore(object):
+    """Process-wide cache of parsed preference files.
+
+    Each file is read once and kept as a read-only snapshot, with the
+    ``ADSPASTE_<KEY>`` environment variables applied on top; it is read
+    again (environment included) only when its modification time or size
+    changes. Snapshots are shared by every :class:`Preferences`, in every
+    thread, so building one costs a ``stat`` call.
+    """
+    env_prefix = 'ADSPASTE_'
 
     def __init__(self):
-        self.prefs_path = os.path.expanduser('~/.adsbibdesk')
-        self._adsmirrors = ['adsabs.harvard.edu',
-                            'cdsads.u-strasbg.fr',
-                            'ukads.nottingham.ac.uk',
-                            'esoads.eso.org',
-                            'ads.ari.uni-heidelberg.de',
-                            'ads.inasan.ru',
-                            'ads.mao.kiev.ua',
-                            'ads.astro.puc.cl',
-                            'ads.on.br',
-                            'ads.nao.ac.jp',
-                            'ads.bao.ac.cn',
-                            'ads.iucaa.ernet.in',
-                            'www.ads.lipi.go.id']
-
-        self.prefs = self._get_default_prefs()  # Hard coded defaults dict
-        new_prefs = self._get_prefs()  # load user prefs from disk
-        self.prefs.update(new_prefs)  # override defaults with user prefs
-        self._keys = list(self.prefs.keys())
-        self._iter_index = -1
-
-    def __getitem__(self, key):
-        return self.prefs[key]
-
-    def __setitem__(self, key, value):
-        self.prefs[key] = value
-        self._keys = list(self.prefs.keys())
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self._iter_index == len(self._keys) - 1:
-            self._iter_index = -1
-            raise StopIteration
-        self._iter_index += 1
-        return self._keys[self._iter_index]
+        import threading
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self, path):
+        """:return: the read-only mapping of preferences in `path`"""
+        import types
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # create a default preference file if non existing
+                self._write_default_prefs(path)
+                stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            cached = self._snapshots.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            prefs = self._get_default_prefs()  # Hard coded defaults dict
+            prefs.update(self._get_prefs(path))  # override with user prefs
+            for key, value in os.environ.items():
+                # ADSPASTE_ADS_MIRROR overrides ads_mirror, and so on
+                if key.startswith(self.env_prefix) and key != 'ADSPASTE_PREFS':
+                    prefs[key[len(self.env_prefix):].lower()] = \
+                        parse_pref_value(value)
+            snapshot = types.MappingProxyType(prefs)
+            if cached is not None:
+                logging.debug("Reloaded preferences from %s" % path)
+            self._snapshots[path] = (version, snapshot)
+            return snapshot
 
     def _get_default_prefs(self):
         """:return: a dictionary of the full set of default preferences. This
@@ -538,40 +3552,50 @@ class Preferences(object):
                 "ssh_user": None,
                 "ssh_server": None,
                 "debug": False,
-                "log_path": os.path.expanduser("~/.adsbibdesk.log")}
-
-    def _get_prefs(self):
-        """Read preferences files from `self.prefs_path`, creates one
-        otherwise.
-        """
+                "log_path": os.path.expanduser("~/.adsbibdesk.log"),
+                "cache": True,
+                "cache_path": os.path.expanduser("~/.adsbibdesk.cache"),
+                "cache_ttl": 7,
+                "cache_size": 100,
+                "index": True,
+                "index_path": os.path.expanduser("~/.adsbibdesk.index"),
+                "timeout": 30,
+                "auto_mirror": False,
+                "mirror_state_path": os.path.expanduser(
+                    "~/.adsbibdesk.mirrors"),
+                "pdf_race": True,
+                "pdf_race_grace": 0,
+                "pdf_pending_wait": 600,
+                "ads_export_url": ADS_EXPORT_URL,
+                "ads_export_limit": 2000,
+                "ads_token": None,
+                "arxiv_mirror_ttl": 24,
+                "ads_search_url": ADS_SEARCH_URL,
+                "ads_search_limit": 200,
+                "arxiv_update_state": os.path.expanduser(
+                    "~/.adsbibdesk.arxiv"),
+                "arxiv_update_interval": 7,
+                "daemon_socket": os.path.expanduser("~/.adsbibdesk.sock")}
+
+    def _get_prefs(self, path):
+        """Read the preferences file at `path`"""
         prefs = {}
-        # create a default preference file if non existing
-        if not os.path.exists(self.prefs_path):
-            self._write_default_prefs()
-
-        for l in open(self.prefs_path):
-            if l.strip() and not l.strip().startswith('#'):
-                if '=' not in l:
-                    # badly formed setting
-                    continue
-                k, v = l.strip().split('=')
-                if not v:
-                    v = None
-                elif v.strip().lower() in ('true', 'yes'):
-                    v = True
-                elif v.strip().lower() in ('false', 'no'):
-                    v = False
-                elif v.strip().lower() == 'none':
-                    v = None
-                prefs[k] = v
-
+        with open(path) as f:
+            for l in f:
+                if l.strip() and not l.strip().startswith('#'):
+                    if '=' not in l:
+                        # badly formed setting
+                        continue
+                    k, v = l.strip().split('=', 1)
+                    prefs[k] = parse_pref_value(v)
         return prefs
 
-    def _write_default_prefs(self):
+    def _write_default_prefs(self, path):
         """
         Set a default preferences file (~/.adsbibdesk)
         """
-        prefs = open(self.prefs_path, 'w')
+        defaults = self._get_default_prefs()
+        prefs = open(path, 'w')
         print("""# ADS mirror
 ads_mirror=%s
 
@@ -585,60 +3609,586 @@ download_pdf=%s
 # set these to use your account on a remote machine for fetching
 # (refereed) PDF's you have no access locally
 ssh_user=%s
-ssh_server=%s""" % (self.prefs['ads_mirror'], self.prefs['arxiv_mirror'],
-                    self.prefs['download_pdf'], self.prefs['ssh_user'],
-                    self.prefs['ssh_server']), file=prefs)
+ssh_server=%s
+
+# cache ADS/arXiv responses locally?
+# (entries expire after cache_ttl days; cache_size is in MB)
+cache=%s
+cache_ttl=%s
+cache_size=%s
+
+# ADS API token, used by --bulk to export many bibcodes at once
+# (see https://ui.adsabs.harvard.edu/user/settings/token)
+ads_token=%s""" % (defaults['ads_mirror'], defaults['arxiv_mirror'],
+                   defaults['download_pdf'], defaults['ssh_user'],
+                   defaults['ssh_server'], defaults['cache'],
+                   defaults['cache_ttl'], defaults['cache_size'],
+                   defaults['ads_token']),
+              file=prefs)
 
         prefs.close()
 
+
+# the parsed preference files, shared by every Preferences
+_prefs_store = PreferencesStore()
+
+
+class Preferences(object):
+    """Manages the preferences on disk and in memory. Preferences are accessed
+    with by a dictionary-like interface.
+
+    The defaults, ~/.adsbibdesk (or the file named by ``ADSPASTE_PREFS``)
+    and the ``ADSPASTE_<KEY>`` environment variables make up a read-only
+    snapshot shared by the whole process (see :class:`PreferencesStore`).
+    `overrides` (the `--set` options) and values assigned to an instance
+    are layered on top of it, for that instance only.
+    """
+
+    def __init__(self, overrides=None):
+        self.prefs_path = os.environ.get(
+            'ADSPASTE_PREFS', os.path.expanduser('~/.adsbibdesk'))
+        self._adsmirrors = list(ADS_MIRRORS)
+        self._overrides = dict(overrides or {})
+        self._snapshot = _prefs_store.snapshot(self.prefs_path)
+
+    def reload(self):
+        """Pick up changes to the preferences file, keeping the overrides"""
+        self._snapshot = _prefs_store.snapshot(self.prefs_path)
+        return self
+
+    @property
+    def prefs(self):
+        """Read-only view of the current preferences"""
+        import types
+        return types.MappingProxyType(
+            collections.ChainMap(self._overrides, self._snapshot))
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            return self._overrides[key]
+        return self._snapshot[key]
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+
+    def __contains__(self, key):
+        return key in self._overrides or key in self._snapshot
+
+    def __iter__(self):
+        return iter(self.prefs)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
     @property
     def adsmirrors(self):
         return self._adsmirrors
 
 
+BIBTEX_ENTRY_RE = re.compile(r'@\s*(\w+)\s*([{(])\s*')
+BIBTEX_KEY_RE = re.compile(r'([^,\s{}()]*)\s*')
+BIBTEX_NAME_RE = re.compile(r'[\s,]*([^\s=,{}()"#]+)\s*=\s*')
+BIBTEX_SPECIAL_RE = re.compile(r'[{}",)]')
+BIBTEX_BLOCK_RE = re.compile(r'[{}()]')
+BIBTEX_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+class BibTexException(Exception):
+    pass
+
+
+def _scan_bibtex_value(text, pos, close):
+    """:return: the index of the `,` or `close` that ends the field
+    value starting at `pos`, skipping over braces and quotes.
+    """
+    depth = 0
+    quoted = False
+    search = BIBTEX_SPECIAL_RE.search
+    while True:
+        match = search(text, pos)
+        if match is None:
+            raise BibTexException('unterminated entry')
+        char = match.group()
+        pos = match.end()
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            if depth == 0:
+                if close == '}' and not quoted:
+                    return match.start()
+                raise BibTexException('unbalanced braces')
+            depth -= 1
+        elif depth == 0:
+            if char == '"':
+                quoted = not quoted
+            elif not quoted and (char == ',' or char == close):
+                return match.start()
+
+
+def _skip_bibtex_block(text, pos, close):
+    """:return: the index just after the `close` ending an entry body"""
+    depth = 0
+    for match in BIBTEX_BLOCK_RE.finditer(text, pos):
+        char = match.group()
+        if char in '{(':
+            depth += 1
+        elif depth == 0 and char == close:
+            return match.end()
+        elif char in '})':
+            depth -= 1
+    return len(text)
+
+
+def parse_bibtex(text, spans=False):
+    """Tokenize BibTeX `text` in a single pass.
+
+    Field values are kept verbatim, including their braces or quotes, so
+    an entry can be written back unchanged. ``@comment``, ``@preamble``
+    and ``@string`` blocks are skipped.
+
+    :return: iterator of ``(type, key, fields)`` tuples, `fields` being a
+        dict in the order the fields appear; with `spans`, ``(type, key,
+        fields, start, end)`` tuples, the entry being ``text[start:end]``
+    """
+    pos = 0
+    while True:
+        pos = text.find('@', pos)
+        if pos < 0:
+            return
+        start = pos
+        match = BIBTEX_ENTRY_RE.match(text, pos)
+        if match is None:
+            pos += 1
+            continue
+        entry_type, opening = match.groups()
+        close = '}' if opening == '{' else ')'
+        pos = match.end()
+        if entry_type.lower() in ('comment', 'preamble', 'string'):
+            pos = _skip_bibtex_block(text, pos, close)
+            continue
+
+        match = BIBTEX_KEY_RE.match(text, pos)
+        key = match.group(1)
+        pos = match.end()
+        fields = {}
+        while True:
+            match = BIBTEX_NAME_RE.match(text, pos)
+            if match is None:
+                # end of the entry, possibly after a trailing comma
+                end = BIBTEX_SEPARATOR_RE.match(text, pos).end()
+                if text[end:end + 1] != close:
+                    raise BibTexException(
+                        'malformed field in entry %s at offset %d'
+                        % (key, pos))
+                pos = end + 1
+                break
+            value_start = match.end()
+            value_end = _scan_bibtex_value(text, value_start, close)
+            fields[match.group(1)] = text[value_start:value_end].strip()
+            pos = value_end
+        if spans:
+            yield entry_type, key, fields, start, pos
+        else:
+            yield entry_type, key, fields
+
+
 class BibTex(object):
 
     def __init__(self, url):
         """
         Create BibTex instance from ADS BibTex URL
         """
-        bibtex = urllib.request.urlopen(url).readlines()
+        with trace_span('bibtex', url=url):
+            bibtex = fetch_ads_url(url)[0].decode('utf-8').splitlines()
         bibtex = ' '.join([l.strip() for l in bibtex]).strip()
-        bibtex = bibtex[re.search('@[A-Z]+\{', bibtex).start():]
         self.type, self.bibcode, self.info = self.parsebib(bibtex)
 
+    @classmethod
+    def from_fields(cls, entry_type, bibcode, info):
+        """Create BibTex instance from already parsed fields"""
+        bibtex = cls.__new__(cls)
+        bibtex.type, bibtex.bibcode, bibtex.info = entry_type, bibcode, info
+        return bibtex
+
+    @classmethod
+    def iter_entries(cls, text):
+        """:return: iterator of BibTex instances, one per entry in `text`"""
+        for entry in parse_bibtex(text):
+            yield cls.from_fields(*entry)
+
     def __str__(self):
-        return (','.join(
+        return ','.join(
             ['@' + self.type + '{' + self.bibcode] +
-            ['%s=%s' % (i, j) for i, j in list(self.info.items())]) + '}').\
-            encode('utf-8')
+            ['%s=%s' % (i, j) for i, j in list(self.info.items())]) + '}'
 
-    def parsebib(self, bibtex):
+    @staticmethod
+    def parsebib(bibtex):
         """
         Parse bibtex code into dictionary
         """
-        r = re.search(
-            '(?<=^@)(?P<type>[A-Z]+){(?P<bibcode>\S+)(?P<info>,.+)}$',
-            bibtex)
-        s = re.split('(,\s\w+\s=\s)', r.group('info'))
-        info = dict(
-            [(i[1:].replace('=', '').strip(), j.strip())
-                for i, j in zip(s[1::2], s[2::2])])
-        return r.group('type'), r.group('bibcode'), info
+        for entry in parse_bibtex(bibtex):
+            return entry
+        raise BibTexException('no BibTeX entry found')
+
+
+ADS_EXPORT_URL = 'https://api.adsabs.harvard.edu/v1/export/bibtex'
 
 
+class ADSExporter(object):
+    """Fetches the BibTeX of many bibcodes at once from an ADS-style
+    export endpoint: bibcodes are POSTed as ``{"bibcode": [...]}``, at
+    most `limit` per request, and the answer is either JSON with the
+    entries in ``export`` or plain BibTeX.
+
+    Entries are cached one by one under the same keys as single BibTeX
+    fetches, so only bibcodes not seen before are requested.
+    """
+    def __init__(self, url=ADS_EXPORT_URL, token=None, limit=2000):
+        self.url = url
+        self.token = token
+        self.limit = max(1, int(limit))
+
+    def export(self, bibcodes):
+        """:return: dict of bibcode -> :class:`BibTex` for the bibcodes
+        the endpoint knows"""
+        entries = {}
+        bibcodes = list(collections.OrderedDict.fromkeys(bibcodes))
+        cache = get_response_cache()
+        cached = {}
+        if cache is not None:
+            cached = cache.get_many('bibtex:' + bibcode
+                                    for bibcode in bibcodes)
+        missing = []
+        for bibcode in bibcodes:
+            data = cached.get('bibtex:' + bibcode)
+            if data is None:
+                missing.append(bibcode)
+                continue
+            for entry in BibTex.iter_entries(data.decode('utf-8')):
+                entries[bibcode] = entry
+        for start in range(0, len(missing), self.limit):
+            chunk = missing[start:start + self.limit]
+            try:
+                with trace_span('export', bibcodes=len(chunk)):
+                    text = self._post(chunk)
+            except (urllib.error.URLError, ValueError, KeyError) as err:
+                logging.warning("Bulk export of %d bibcodes failed: %s"
+                                % (len(chunk), err))
+                continue
+            found = list(BibTex.iter_entries(text))
+            for entry in found:
+                entries[entry.bibcode] = entry
+            if cache is not None:
+                cache.put_many(('bibtex:' + entry.bibcode,
+                                str(entry).encode('utf-8'), self.url)
+                               for entry in found)
+        return entries
+
+    def _post(self, bibcodes):
+        """:return: the BibTeX text exported for `bibcodes`"""
+        import json
+        headers = {'Content-Type': 'application/json',
+                   'Accept': 'application/json, text/plain'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        body = json.dumps({'bibcode': bibcodes}).encode('utf-8')
+        with get_http_client().request('POST', self.url, headers=headers,
+                                       body=body) as response:
+            data = response.read().decode('utf-8')
+            if 'json' in response.headers.get('Content-Type', ''):
+                return json.loads(data)['export']
+        return data
+
+
+ADS_SEARCH_URL = 'https://api.adsabs.harvard.edu/v1/search/query'
+
+
+class ADSSearch(object):
+    """Looks up many arXiv identifiers at once with an ADS-style search
+    endpoint, at most `limit` per query, to find the refereed bibcode
+    each pre-print was published under.
+
+    After :meth:`refereed`, ``searched`` holds the identifiers whose
+    query succeeded.
+    """
+    def __init__(self, url=ADS_SEARCH_URL, token=None, limit=200):
+        self.url = url
+        self.token = token
+        self.limit = max(1, int(limit))
+        self.searched = set()
+
+    def refereed(self, arxiv_ids):
+        """:return: dict of arXiv identifier -> refereed bibcode, for the
+        pre-prints that have one"""
+        bibcodes = {}
+        self.searched = set()
+        arxiv_ids = list(collections.OrderedDict.fromkeys(arxiv_ids))
+        for start in range(0, len(arxiv_ids), self.limit):
+            chunk = arxiv_ids[start:start + self.limit]
+            try:
+                with trace_span('search', identifiers=len(chunk)):
+                    docs = self._query(chunk)
+            except (urllib.error.URLError, ValueError, KeyError) as err:
+                logging.warning("Search for %d arXiv identifiers failed: %s"
+                                % (len(chunk), err))
+                continue
+            wanted = set(chunk)
+            self.searched.update(chunk)
+            for doc in docs:
+                if 'REFEREED' not in doc.get('property', []):
+                    continue
+                for identifier in doc.get('identifier', []):
+                    kind, value = classify_token(identifier)
+                    if kind == 'arxiv' and value in wanted:
+                        bibcodes[value] = doc['bibcode']
+        return bibcodes
+
+    def _query(self, arxiv_ids):
+        """:return: the documents found for `arxiv_ids`"""
+        import json
+        query = urllib.parse.urlencode({
+            'q': 'identifier:(%s)' % ' OR '.join(
+                '"arXiv:%s"' % arxiv_id for arxiv_id in arxiv_ids),
+            'fl': 'bibcode,identifier,property',
+            'rows': 2 * len(arxiv_ids)})
+        headers = {'Accept': 'application/json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        with get_http_client().request('GET', self.url + '?' + query,
+                                       headers=headers) as response:
+            if response.status != 200:
+                raise ValueError('HTTP status %d' % response.status)
+            return json.loads(response.read().decode('utf-8'))[
+                'response']['docs']
+
+
+def bulk_export(article_tokens, prefs):
+    """Export the BibTeX of the bibcodes among `article_tokens` with an
+    :class:`ADSExporter` set up from the preferences.
+
+    :return: dict of token -> :class:`BibTex`, for the tokens exported
+    """
+    bibcodes = {}
+    for token in article_tokens:
+        kind, value = classify_token(token)
+        if kind == 'bibcode':
+            bibcodes[token] = value
+    if not bibcodes:
+        return {}
+    exporter = ADSExporter(prefs['ads_export_url'], prefs['ads_token'],
+                           prefs['ads_export_limit'])
+    entries = exporter.export(list(bibcodes.values()))
+    logging.info("Bulk export found %d of %d bibcodes"
+                 % (len(set(bibcodes.values()) & set(entries)),
+                    len(set(bibcodes.values()))))
+    return dict((token, entries[bibcode])
+                for token, bibcode in bibcodes.items() if bibcode in entries)
+
+
+# common AAS journal macros used in ADS BibTeX exports
+JOURNAL_MACROS = {'\\aj': 'AJ', '\\apj': 'ApJ', '\\apjl': 'ApJL',
+                  '\\apjs': 'ApJS', '\\aap': 'A&A', '\\aaps': 'A&AS',
+                  '\\mnras': 'MNRAS', '\\nat': 'Nature',
+                  '\\araa': 'ARA&A', '\\pasp': 'PASP', '\\pasj': 'PASJ',
+                  '\\prd': 'Phys. Rev. D', '\\prl': 'Phys. Rev. Lett.',
+                  '\\physrep': 'Phys. Rep.', '\\ssr': 'Space Sci. Rev.'}
+
+MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+          'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+
+CSL_TYPES = {'article': 'article-journal', 'inproceedings': 'paper-conference',
+             'proceedings': 'book', 'book': 'book', 'inbook': 'chapter',
+             'incollection': 'chapter', 'phdthesis': 'thesis',
+             'mastersthesis': 'thesis', 'techreport': 'report',
+             'misc': 'article', 'abstract': 'article'}
+
+
+def bibtex_text(value):
+    """Plain text of a raw BibTeX field value: no delimiters or braces"""
+    value = value.strip()
+    if value[:1] in '{"' and value[-1:] in '}"':
+        value = value[1:-1]
+    value = value.replace('{', '').replace('}', '').replace('~', ' ')
+    return ' '.join(value.split())
+
+
+def bibtex_quoted(text):
+    """:return: `text` as a quoted BibTeX field value that parses back:
+    braces that do not pair up are dropped and double quotes are braced
+    (``{"}``)"""
+    chars = list(text)
+    opened = []
+    for i, char in enumerate(chars):
+        if char == '{':
+            opened.append(i)
+        elif char == '}':
+            if opened:
+                opened.pop()
+            else:
+                chars[i] = ''
+    for i in opened:
+        chars[i] = ''
+    return '"%s"' % ''.join(chars).replace('"', '{"}')
+
+
+class BibliographyWriter(object):
+    """Streams :class:`BibTex` entries to a text file object, one at a
+    time, so a bibliography never has to be held in memory.
+    """
+    def __init__(self, stream, close_stream=False):
+        self.stream = stream
+        self.close_stream = close_stream
+        self.count = 0
+        # show entries as they arrive on a terminal
+        self.flush = hasattr(stream, 'isatty') and stream.isatty()
+
+    def write(self, bibtex):
+        self.stream.write(self.format(bibtex))
+        self.count += 1
+        if self.flush:
+            self.stream.flush()
+
+    def format(self, bibtex):
+        raise NotImplementedError
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class BibTexWriter(BibliographyWriter):
+    """Entries as BibTeX, one per line"""
+    def format(self, bibtex):
+        return str(bibtex) + '\n'
+
+
+class JSONLinesWriter(BibliographyWriter):
+    """One JSON object per line with the entry type, key and fields"""
+    def format(self, bibtex):
+        import json
+        return json.dumps({'type': bibtex.type.lower(),
+                           'key': bibtex.bibcode,
+                           'fields': dict((k.lower(), bibtex_text(v))
+                                          for k, v in bibtex.info.items())},
+                          ensure_ascii=False) + '\n'
+
+
+class CSLJSONWriter(BibliographyWriter):
+    """A CSL-JSON array, written element by element"""
+    def write(self, bibtex):
+        import json
+        self.stream.write('[\n' if self.count == 0 else ',\n')
+        self.stream.write(json.dumps(self.csl(bibtex), ensure_ascii=False))
+        self.count += 1
+        if self.flush:
+            self.stream.flush()
+
+    def close(self):
+        self.stream.write('[]\n' if self.count == 0 else '\n]\n')
+        BibliographyWriter.close(self)
+
+    @staticmethod
+    def csl(bibtex):
+        """:return: the CSL-JSON dict for a :class:`BibTex` entry"""
+        fields = dict((k.lower(), v) for k, v in bibtex.info.items())
+        item = {'id': bibtex.bibcode,
+                'type': CSL_TYPES.get(bibtex.type.lower(), 'article')}
+        if 'author' in fields:
+            authors = []
+            for name in re.split(r'\s+and\s+',
+                                 bibtex_text(fields['author'])):
+                family, _, given = name.partition(',')
+                author = {'family': family.strip()}
+                if given.strip():
+                    author['given'] = given.strip()
+                authors.append(author)
+            item['author'] = authors
+        year = bibtex_text(fields.get('year', ''))
+        if year.isdigit():
+            date = [int(year)]
+            month = bibtex_text(fields.get('month', '')).lower()[:3]
+            if month in MONTHS:
+                date.append(MONTHS.index(month) + 1)
+            item['issued'] = {'date-parts': [date]}
+        elif year:
+            # "in press", "2015--2016"...
+            item['issued'] = {'literal': year}
+        if 'journal' in fields:
+            journal = bibtex_text(fields['journal'])
+            item['container-title'] = JOURNAL_MACROS.get(journal, journal)
+        for field, key in (('title', 'title'), ('volume', 'volume'),
+                           ('number', 'issue'), ('pages', 'page'),
+                           ('doi', 'DOI'), ('abstract', 'abstract'),
+                           ('adsurl', 'URL'), ('keywords', 'keyword'),
+                           ('publisher', 'publisher')):
+            if field in fields:
+                item[key] = bibtex_text(fields[field])
+        return item
+
+
+class ClipboardSink(object):
+    """Collects BibTeX entries and copies them to the clipboard on close"""
+    def __init__(self):
+        self.entries = []
+
+    def write(self, bibtex):
+        self.entries.append(str(bibtex))
+
+    def close(self):
+        if self.entries:
+            with trace_span('clipboard'):
+                import pyperclip
+                try:
+                    pyperclip.copy('\n\n'.join(self.entries))
+                except pyperclip.PyperclipException as err:
+                    logging.warning("Could not copy to the clipboard: %s"
+                                    % err)
+
+
+WRITERS = {'bibtex': BibTexWriter,
+           'jsonl': JSONLinesWriter,
+           'csl-json': CSLJSONWriter}
+
+
+def open_writer(fmt='bibtex', path=None):
+    """Open a :class:`BibliographyWriter` for format `fmt` (a key of
+    `WRITERS`) on `path`, or on standard output if `path` is None.
+    """
+    if path is None or path == '-':
+        return WRITERS[fmt](sys.stdout)
+    stream = open(path, 'w', encoding='utf-8', buffering=2 ** 20)
+    return WRITERS[fmt](stream, close_stream=True)
 
 
 class ADSException(Exception):
     pass
 
 
+class _ParseComplete(Exception):
+    """Raised by :class:`ADSHTMLParser` to stop reading a page early"""
+    pass
+
+
+# arXiv identifier quoted on ADS abstract pages
+ADS_ARXIV_RE = re.compile(r'arXiv:(\d{4,6}.\d{4,6}|astro\-ph/\d{7})')
+
+
 class ADSHTMLParser(HTMLParser):
+    """Parses an ADS abstract page for the links (BibTeX, article,
+    preprint...), comment, arXiv identifier and abstract.
+
+    Only the BibTeX link may come after the abstract, so :meth:`parse`
+    stops reading once it has both, skipping the rest of long pages.
+    """
 
     def __init__(self, *args, **kwargs):
         HTMLParser.__init__(self)
         self.links = {}
-        self.tag = ''
+        # text of the abstract or comment being read
+        self.tag = []
+        self.in_head = False
         self.get_abs = False
         # None = not seen yet, False = seen but do not store yet, True = store
         self.get_comment = None
@@ -651,16 +4201,24 @@ class ADSHTMLParser(HTMLParser):
         self.author = []
         self.arxivid = None
 
-        self.prefs = kwargs.get('prefs', Preferences()).prefs
+        prefs = kwargs.get('prefs')
+        self.prefs = prefs if prefs is not None else Preferences()
+
+    # the MathML entity table, shared by all parsers once fetched
+    _mathml_entities = None
 
     def mathml(self):
         """
         Generate dictionary with MathML -> unicode conversion from
         http://www.w3.org/Math/characters/byalpha.html
         """
+        if ADSHTMLParser._mathml_entities is not None:
+            return ADSHTMLParser._mathml_entities
         w3 = 'http://www.w3.org/Math/characters/byalpha.html'
-        mathml = re.search('(?<=<pre>).+(?=</pre>)',
-                           urllib.request.urlopen(w3).read(), re.DOTALL).group()
+        with trace_span('mathml', url=w3):
+            mathml = re.search('(?<=<pre>).+(?=</pre>)',
+                               get_http_client().get(w3).decode('utf-8'),
+                               re.DOTALL).group()
         entities = {}
         for l in mathml[:-1].splitlines():
             s = l.split(',')
@@ -668,12 +4226,13 @@ class ADSHTMLParser(HTMLParser):
             if '-' not in s[1]:
                 # hexadecimal -> int values, for unichr
                 entities[s[0].strip()] = int(s[1].strip()[1:], 16)
+        ADSHTMLParser._mathml_entities = entities
         return entities
 
     def parse_at_url(self, url):
         """Helper method to read data from URL, and passes on to parse()."""
         try:
-            html_data = urllib.request.urlopen(url).read()
+            html_data = open_url(url, partial=True)
         except urllib.error.URLError as err:
             logging.debug("ADSHTMLParser timed out on URL: %s", url)
             raise ADSException(err)
@@ -683,21 +4242,41 @@ class ADSHTMLParser(HTMLParser):
         """
         Feed url into our own HTMLParser and parse found bibtex
 
-        html_data is a string containing HTML data from ADS page.
+        html_data is the HTML of an ADS page, either a string or a
+        :class:`URLStream` fed to the parser chunk by chunk as it arrives.
         """
-        self.feed(html_data)
-
-        logging.debug("ADSHTMLParser found links: %s",
-                      pprint.pformat(self.links))
+        if isinstance(html_data, str):
+            html_data = [html_data]
+            stream = None
+        else:
+            stream = html_data
+            decoder = codecs.getincrementaldecoder('utf-8')('replace')
+            html_data = (decoder.decode(chunk) for chunk in stream)
+        try:
+            for chunk in html_data:
+                self.feed(chunk)
+        except _ParseComplete:
+            logging.debug("ADSHTMLParser has all it needs, stops reading")
+        except Exception:
+            if stream is not None:
+                stream.close(cache=False)
+            raise
+        if stream is not None:
+            stream.close()
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            import pprint
+            logging.debug("ADSHTMLParser found links: %s",
+                          pprint.pformat(self.links))
 
         if 'bibtex' in self.links:
             self.bibtex = BibTex(self.links['bibtex'])
             self.title = re.search(
                 '(?<={).+(?=})',
                 self.bibtex.info['title']).group()\
-                .replace('{', '').replace('}', '').encode('utf-8')
+                .replace('{', '').replace('}', '')
             self.author = [
-                a.strip().encode('utf-8') for a in
+                a.strip() for a in
                 re.search('(?<={).+(?=})', self.bibtex.info['author'])
                 .group().split(' and ')]
             # bibtex do not have the comment from ADS
@@ -706,76 +4285,80 @@ class ADSHTMLParser(HTMLParser):
                     {'adscomment': '"' + self.comment.replace('"', "'") + '"'})
             # construct ArXivURL from arXiv identifier
             if self.arxivid:
-                if 'arxiv_mirror' not in self.prefs \
-                        or not self.prefs['arxiv_mirror']:
-                    # test HTTP redirect to get the arXiv mirror used by ADS
-                    try:
-                        mirror = urllib.parse.urlsplit(
-                            get_redirect(self.links['preprint'])).netloc
-                    except KeyError:
-                        mirror = 'arxiv.org'  # this should not happen
-                else:
-                    mirror = self.prefs['arxiv_mirror']
                 url = urllib.parse.urlunsplit((
-                    'http', mirror,
+                    'http', self._arxiv_mirror(),
                     'abs/' + self.arxivid, None, None))
                 self.bibtex.info.update({'arxivurl': '"' + url + '"'})
 
+    # HTMLParser hands over tag and attribute names in lower case
     def handle_starttag(self, tag, attrs):
-        if tag.lower() == 'hr' and self.get_abs:
-            # abstract
-            self.abstract = self.tag.strip().decode('utf-8')
-            self.get_abs = False
-            self.tag = ''
-        elif tag.lower() == 'img' and self.get_abs:
-            # handle old scanned articles abstracts
-            self.tag += dict(attrs)['src'].replace('&#38;', chr(38))
-        elif tag.lower() == 'a':
+        if tag == 'a':
             # links
-            if 'href' in dict(attrs):
-                href = dict(attrs)['href'].replace('&#38;', chr(38))
-                query = cgi.parse_qs(urllib.parse.urlsplit(href).query)
+            href = dict(attrs).get('href')
+            if href and 'bibcode=' in href:
+                href = href.replace('&#38;', chr(38))
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(href).query)
                 if 'bibcode' in query:
                     if 'link_type' in query:
                         self.links[query['link_type'][0].lower()] = href
                     elif 'data_type' in query:
                         self.links[query['data_type'][0].lower()] = href
-        elif tag.lower() == 'td' and self.get_comment is False \
+                    if self.abstract is not None and 'bibtex' in self.links:
+                        raise _ParseComplete()
+        elif tag == 'hr' and self.get_abs:
+            # abstract
+            self.abstract = ''.join(self.tag).strip()
+            self.get_abs = False
+            self.tag = []
+            if 'bibtex' in self.links:
+                raise _ParseComplete()
+        elif tag == 'img' and self.get_abs:
+            # handle old scanned articles abstracts
+            self.tag.append(dict(attrs)['src'].replace('&#38;', chr(38)))
+        elif tag == 'td' and self.get_comment is False \
                 and 'valign' in dict(attrs):
             # comment
             self.get_comment = True
+        elif tag == 'head':
+            # the <head> is often broken HTML
+            self.in_head = True
+        elif tag == 'body':
+            self.in_head = False
 
     def handle_endtag(self, tag):
-        if self.get_comment and tag.lower() == 'td':
-            self.comment = self.tag.strip().decode('utf-8')
+        if self.get_comment and tag == 'td':
+            self.comment = ''.join(self.tag).strip()
             self.get_comment = None
-            self.tag = ''
+            self.tag = []
+        elif tag == 'head':
+            self.in_head = False
 
     def handle_data(self, data):
+        if self.in_head:
+            return
         if self.get_abs:
-            self.tag += data.replace('\n', ' ')
+            self.tag.append(data.replace('\n', ' '))
         if self.get_comment:
-            self.tag += data
+            self.tag.append(data)
 
+        text = data.strip()
         # beginning of abstract found
-        if data.strip() == 'Abstract':
+        if text == 'Abstract':
             self.get_abs = True
-        if data.strip() == 'Comment:':
+        elif text == 'Comment:':
             self.get_comment = False
         # store arXiv identifier
-        # FIXME perhaps compile this regular expression as a global?
-        if re.search('arXiv:(\d{4,6}.\d{4,6}|astro\-ph/\d{7})', data) \
-                is not None:
-            self.arxivid = re.search(
-                'arXiv:(\d{4,6}.\d{4,6}|astro\-ph/\d{7})',
-                data).group(1)
+        if 'arXiv:' in data:
+            match = ADS_ARXIV_RE.search(data)
+            if match is not None:
+                self.arxivid = match.group(1)
 
     # handle html entities
     def handle_entityref(self, name):
         if self.get_abs:
             if name in name2codepoint:
                 c = name2codepoint[name]
-                self.tag += chr(c).encode('utf-8')
+                self.tag.append(chr(c))
             else:
                 # fetch mathml
                 if not self.entities:
@@ -783,15 +4366,15 @@ class ADSHTMLParser(HTMLParser):
                     self.entities = self.mathml()
                 if name in self.entities:
                     c = self.entities[name]
-                    self.tag += chr(c).encode('utf-8')
+                    self.tag.append(chr(c))
                 else:
                     # nothing worked, leave it as-is
-                    self.tag += '&' + name + ';'
+                    self.tag.append('&' + name + ';')
 
     # handle unicode chars in utf-8
     def handle_charref(self, name):
         if self.get_abs:
-            self.tag += chr(int(name)).encode('utf-8')
+            self.tag.append(chr(int(name)))
 
     def get_pdf(self):
         """
@@ -801,27 +4384,132 @@ class ADSHTMLParser(HTMLParser):
         - refereed article using another machine (set ssh_user & ssh_server)
         - arXiv preprint
         - electronic journal link
+
+        With the `pdf_race` preference (the default) the downloads are
+        started at the same time and the first valid PDF wins; when several
+        are ready, the order above decides. `pdf_race_grace` gives a
+        preferred source that many extra seconds to catch up with a
+        faster, less preferred one.
         """
         if not self.links:
             return 'failed'
         elif 'download_pdf' in self.prefs and not self.prefs['download_pdf']:
             return 'not downloaded'
 
-        def filetype(filename):
-            return sp.Popen('file %s' % filename, shell=True,
-                            stdout=sp.PIPE,
-                            stderr=sp.PIPE).stdout.read()
+        import threading
+        self._pdf_lock = threading.Lock()
+        self._article_pdf = None
+        self._arxiv_url = None
+        sources = self._pdf_sources()
+        if self.prefs.get('pdf_race', True) and len(sources) > 1:
+            pdf = self._race_pdf_sources(
+                sources, grace=float(self.prefs.get('pdf_race_grace') or 0))
+        else:
+            cancel = threading.Event()
+            pdf = None
+            for name, source in sources:
+                pdf = source(cancel)
+                if pdf:
+                    break
+        if pdf:
+            return pdf
+
+        # arXiv
+        if self._arxiv_url:
+            return self._arxiv_url
+
+        # electronic journal
+        if 'ejournal' in self.links:
+            return self.links['ejournal']
+
+        return 'failed'
 
-        # refereed
+    def _pdf_sources(self):
+        """:return: list of (name, source) in order of preference, where
+        source(cancel) returns the path of a valid PDF or `None`
+        """
+        sources = []
         if 'article' in self.links:
+            sources.append(('article', self._article_source))
+            # you need to set SSH public key authentication for this to work!
+            if 'ssh_user' in self.prefs and self.prefs['ssh_user'] \
+                    is not None:
+                sources.append(('ssh', self._ssh_source))
+        if 'preprint' in self.links:
+            sources.append(('arxiv', self._arxiv_source))
+        return sources
+
+    def _race_pdf_sources(self, sources, grace=0.):
+        """Run the PDF sources concurrently and keep the best valid PDF"""
+        import threading
+        from concurrent.futures import (ThreadPoolExecutor, wait,
+                                        FIRST_COMPLETED)
+
+        def discard(future):
+            try:
+                pdf = future.result()
+            except Exception:
+                return
+            if pdf and os.path.exists(pdf):
+                os.remove(pdf)
+
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(sources))
+        futures = dict((executor.submit(source, cancel), rank)
+                       for rank, (name, source) in enumerate(sources))
+        pending = set(futures)
+        ready = {}  # rank -> PDF path
+        deadline = None
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    pdf = future.result()
+                except Exception as err:
+                    logging.debug('PDF source %s failed: %s'
+                                  % (sources[futures[future]][0], err))
+                    continue
+                if pdf:
+                    ready[futures[future]] = pdf
+            if not ready:
+                continue
+            best = min(ready)
+            if deadline is None:
+                deadline = time.time() + grace
+            # done once nothing preferable is still running
+            if all(futures[f] > best for f in pending) \
+                    or time.time() >= deadline:
+                break
+
+        cancel.set()
+        for future in pending:
+            future.add_done_callback(discard)
+        executor.shutdown(wait=False)
+        if not ready:
+            return None
+        best = min(ready)
+        for rank, pdf in ready.items():
+            if rank != best:
+                os.remove(pdf)
+        logging.debug('PDF from %s wins' % sources[best][0])
+        return ready[best]
+
+    def _article_pdf_url(self):
+        """Resolve the refereed article link into the URL of its PDF"""
+        with self._pdf_lock:
+            if self._article_pdf is not None:
+                return self._article_pdf
             url = self.links['article']
             # Resolve URL
             resolved_url = get_redirect(url)
             logging.debug("Resolve article URL: %s" % resolved_url)
-            if "filetype=.pdf" in resolved_url:
-                # URL will directly resolve into a PDF
-                pdf_url = resolved_url
-            elif "MNRAS" in resolved_url:
+            pdf_url = resolved_url
+            if "filetype=.pdf" not in resolved_url \
+                    and "MNRAS" in resolved_url:
                 # Special case for MNRAS URLs to deal with iframe
                 parser = MNRASParser(self.prefs)
                 try:
@@ -830,126 +4518,178 @@ class ADSHTMLParser(HTMLParser):
                     # this probably means we have a PDF directly from ADS
                     # afterall just continue.
                     # NOTE this case may be deprecated by resolving the URL
-                    pdf_url = resolved_url
-                if parser.pdfURL is not None:
-                    pdf_url = parser.pdfURL
-                else:
-                    pdf_url = resolved_url
-            else:
-                pdf_url = resolved_url
+                    pass
+                if parser.pdf_url is not None:
+                    pdf_url = parser.pdf_url
+            self._article_pdf = pdf_url
+            return pdf_url
+
+    def _article_source(self, cancel):
+        """Refereed article, downloaded locally"""
+        import tempfile
+        pdf_url = self._article_pdf_url()
+        fd, pdf = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        # test for HTTP auth need
+        if download_pdf(pdf_url, pdf, cancel=cancel):
+            return pdf
+        os.remove(pdf)
+        return None
+
+    def _ssh_source(self, cancel):
+        """Refereed article, fetched through a remote server"""
+        import subprocess as sp
+        import tempfile
+        pdf_url = self._article_pdf_url()
+        fd, pdf = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        cmd = 'ssh %s@%s \"touch adsbibdesk.pdf; ' \
+            'wget -O adsbibdesk.pdf \\"%s\\"\"' % \
+            (self.prefs['ssh_user'], self.prefs['ssh_server'], pdf_url)
+        cmd2 = 'scp -q %s@%s:adsbibdesk.pdf %s' \
+            % (self.prefs['ssh_user'], self.prefs['ssh_server'], pdf)
+        for command in (cmd, cmd2):
+            proc = sp.Popen(command, shell=True,
+                            stdout=sp.PIPE, stderr=sp.PIPE)
+            while proc.poll() is None:
+                if cancel.wait(0.2):
+                    proc.kill()
+                    proc.communicate()
+                    os.remove(pdf)
+                    return None
+            proc.communicate()
+        if is_pdf(pdf):
+            return pdf
+        os.remove(pdf)
+        return None
+
+    def _arxiv_mirror(self):
+        """:return: the user defined arXiv mirror, or else the one the
+        ADS mirror redirects preprint links to"""
+        if 'arxiv_mirror' in self.prefs and self.prefs['arxiv_mirror']:
+            return self.prefs['arxiv_mirror']
+        if 'preprint' not in self.links:
+            return 'arxiv.org'  # this should not happen
+        return get_arxiv_mirrors().mirror_for(self.links['preprint'])
+
+    def _arxiv_source(self, cancel):
+        """arXiv preprint"""
+        # arXiv page
+        url = self.links['preprint']
+        mirror = None
+
+        # fetch PDF directly without parsing the arXiv page
+        if self.arxivid is not None:
+            mirror = self._arxiv_mirror()
+            url = urllib.parse.urlunsplit((
+                'http', mirror, 'pdf/' + self.arxivid, None, None))
+            logging.debug('arXiv PDF (%s)' % url)
 
-            # try locally
-            fd, pdf = tempfile.mkstemp(suffix='.pdf')
-            # test for HTTP auth need
-            try:
-                os.fdopen(fd, 'wb').write(urllib.request.urlopen(pdf_url).read())
-            except urllib.error.URLError as err:  # HTTPError derives from URLError
-                logging.debug('%s failed: %s' % (pdf_url, err))
-                # dummy file
-                open(pdf, 'w').write('dummy')
+        else:
+            # search for PDF link in the arXiv page
+            # this should be *deprecated*
+            for line in get_http_client().get(url).decode(
+                    'utf-8', 'replace').splitlines():
+                if '<h1><a href="/">' in line:
+                    mirror = re.search(
+                        '<h1><a href="/">(.*ar[xX]iv.org)',
+                        line)
+                elif 'dc:identifier' in line:
+                    begin = re.search('dc:identifier="', line).end()
+                    url = urllib.parse.urlsplit(
+                        line[begin:-2].replace('&#38;', chr(38)).
+                        lower())
+                    # use automatic mirror chosen by the ADS mirror
+                    if ('arxiv_mirror' not in self.prefs
+                            or not self.prefs['arxiv_mirror']) \
+                            and mirror is not None:
+                        url = urllib.parse.urlunsplit((
+                            url.scheme,
+                            mirror.group(1), url.path, url.query,
+                            url.fragment))
+                        break
+                    elif self.prefs['arxiv_mirror']:
+                        url = urllib.parse.urlunsplit((
+                            url.scheme,
+                            self.prefs['arxiv_mirror'],
+                            url.path, url.query,
+                            url.fragment))
+                        break
+            logging.debug(
+                'arXiv PDF url (*should be DEPRECATED!*): %s' % url)
+        self._arxiv_url = url
+
+        # get arXiv PDF
+        import tempfile
+        fd, pdf = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        if download_pdf(url.replace('abs', 'pdf'), pdf, cancel=cancel):
+            return pdf
+        # PDF was not yet generated in the mirror?
+        if is_processing(pdf) and not cancel.is_set():
+            notify('Waiting for arXiv...', '',
+                   'PDF is being generated, retrying in the background...')
+            get_pdf_scheduler().add(url.replace('abs', 'pdf'), pdf,
+                                    label=self.arxivid or url)
+            return None
+        os.remove(pdf)
+        return None
 
-            if 'PDF document' in filetype(pdf):
-                return pdf
 
-            # try in remote server
-            # you need to set SSH public key authentication for this to work!
-            elif 'ssh_user' in self.prefs and self.prefs['ssh_user'] \
-                    is not None:
-                fd, pdf = tempfile.mkstemp(suffix='.pdf')
-                cmd = 'ssh %s@%s \"touch adsbibdesk.pdf; ' \
-                    'wget -O adsbibdesk.pdf \\"%s\\"\"' % \
-                    (self.prefs['ssh_user'], self.prefs['ssh_server'], pdf_url)
-                cmd2 = 'scp -q %s@%s:adsbibdesk.pdf %s' \
-                    % (self.prefs['ssh_user'], self.prefs['ssh_server'], pdf)
-                sp.Popen(cmd, shell=True,
-                         stdout=sp.PIPE, stderr=sp.PIPE).communicate()
-                sp.Popen(cmd2, shell=True,
-                         stdout=sp.PIPE, stderr=sp.PIPE).communicate()
-                if 'PDF document' in filetype(pdf):
-                    return pdf
+class ArXivException(Exception):
+    pass
 
-        # arXiv
-        if 'preprint' in self.links:
-            # arXiv page
-            url = self.links['preprint']
-            mirror = None
-
-            # fetch PDF directly without parsing the arXiv page
-            if self.arxivid is not None:
-                # user defined mirror?
-                if 'arxiv_mirror' not in self.prefs \
-                        or not self.prefs['arxiv_mirror']:
-                    # test HTTP redirect to get the arXiv mirror used by ADS
-                    mirror = urllib.parse.urlsplit(get_redirect(url)).netloc
-                else:
-                    mirror = self.prefs['arxiv_mirror']
-                url = urllib.parse.urlunsplit((
-                    'http', mirror, 'pdf/' + self.arxivid, None, None))
-                logging.debug('arXiv PDF (%s)' % url)
 
-            else:
-                # search for PDF link in the arXiv page
-                # this should be *deprecated*
-                for line in urllib.request.urlopen(url):
-                    if '<h1><a href="/">' in line:
-                        mirror = re.search(
-                            '<h1><a href="/">(.*ar[xX]iv.org)',
-                            line)
-                    elif 'dc:identifier' in line:
-                        begin = re.search('dc:identifier="', line).end()
-                        url = urllib.parse.urlsplit(
-                            line[begin:-2].replace('&#38;', chr(38)).
-                            lower())
-                        # use automatic mirror chosen by the ADS mirror
-                        if ('arxiv_mirror' not in self.prefs
-                                or not self.prefs['arxiv_mirror']) \
-                                and mirror is not None:
-                            url = urllib.parse.urlunsplit((
-                                url.scheme,
-                                mirror.group(1), url.path, url.query,
-                                url.fragment))
-                            break
-                        elif self.prefs['arxiv_mirror']:
-                            url = urllib.parse.urlunsplit((
-                                url.scheme,
-                                self.prefs['arxiv_mirror'],
-                                url.path, url.query,
-                                url.fragment))
-                            break
-                logging.debug(
-                    'arXiv PDF url (*should be DEPRECATED!*): %s' % url)
-
-            # get arXiv PDF
-            fd, pdf = tempfile.mkstemp(suffix='.pdf')
-            os.fdopen(fd, 'wb').write(urllib.request.urlopen(
-                url.replace('abs', 'pdf')).read())
-            if 'PDF document' in filetype(pdf):
-                return pdf
-            # PDF was not yet generated in the mirror?
-            elif '...processing...' in open(pdf).read():
-                while '...processing...' in open(pdf).read():
-                    logging.debug('waiting 30s for PDF regeneration')
-                    notify('Waiting for arXiv...', '',
-                           'PDF is being generated, retrying in 30s...')
-                    time.sleep(30)
-                    open(pdf, 'wb').write(urllib.request.urlopen(
-                        url.replace('abs', 'pdf')).read())
-                if 'PDF document' in filetype(pdf):
-                    return pdf
-                else:
-                    return url
-            else:
-                return url
+ARXIV_API = 'http://export.arxiv.org/api/query'
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
 
-        # electronic journal
-        if 'ejournal' in self.links:
-            return self.links['ejournal']
 
-        return 'failed'
+def arxiv_key(arxiv_id):
+    """Normalise an arXiv identifier for matching: no version suffix"""
+    return re.sub(r'v\d+$', '', arxiv_id.strip())
 
 
-class ArXivException(Exception):
-    pass
+class ArXivBatch(object):
+    """The arXiv records of a batch of identifiers, fetched together with
+    :meth:`ArXivParser.parse_at_ids` when one of them is needed, so
+    pre-prints ADS does not know yet cost one arXiv API call per chunk
+    rather than one each.
+
+    Identifiers ADS did resolve are reported with :meth:`resolved` and
+    left out: a fetch only asks for those still unresolved and not asked
+    for yet.
+    """
+    def __init__(self, arxiv_ids):
+        import threading
+        self.arxiv_ids = list(collections.OrderedDict.fromkeys(
+            arxiv_key(arxiv_id) for arxiv_id in arxiv_ids))
+        self.records = {}
+        self._done = set()  # resolved by ADS, or already asked for
+        self._lock = threading.Lock()
+
+    def resolved(self, arxiv_id):
+        """Leave `arxiv_id`, which ADS knows, out of the fetches"""
+        with self._lock:
+            self._done.add(arxiv_key(arxiv_id))
+
+    def get(self, arxiv_id):
+        """:return: the :class:`ArXivParser` of `arxiv_id`, or `None` if
+        it is not in the batch or could not be fetched"""
+        key = arxiv_key(arxiv_id)
+        with self._lock:
+            if key in self.arxiv_ids and key not in self.records:
+                self._done.discard(key)
+                pending = [k for k in self.arxiv_ids if k not in self._done]
+                self._done.update(pending)
+                try:
+                    parsed = ArXivParser.parse_at_ids(pending)
+                except ArXivException as err:
+                    logging.debug("ArXivBatch failed: %s", err)
+                    parsed = []
+                self.records.update(
+                    (k, record) for k, record in zip(pending, parsed)
+                    if record is not None)
+        return self.records.get(key)
 
 
 class ArXivParser(object):
@@ -965,26 +4705,146 @@ class ArXivParser(object):
     def parse_at_id(self, arxiv_id):
         """Helper method to read data from URL, and passes on to parse()."""
         from xml.etree import ElementTree
-        self.url = 'http://export.arxiv.org/api/query?id_list=' + arxiv_id
+        self.url = ARXIV_API + '?id_list=' + arxiv_id
         try:
-            self.xml = ElementTree.fromstring(urllib.request.urlopen(self.url).read())
+            self.xml = ElementTree.fromstring(
+                fetch_url(self.url, 'arxiv:' + arxiv_key(arxiv_id)))
         except (urllib.error.HTTPError, urllib.error.URLError) as err:
             logging.debug("ArXivParser failed on URL: %s", self.url)
             raise ArXivException(err)
         self.info = self.parse(self.xml)
         self.bib = self.bibtex(self.info)  # FIXME looks like self.bib is None
 
+    @classmethod
+    def parse_at_ids(cls, arxiv_ids, chunk_size=100):
+        """Parse many arXiv identifiers with as few API calls as possible.
+
+        Identifiers are sent in chunks of `chunk_size` as a comma-separated
+        ``id_list`` and the Atom feed is parsed entry by entry as it
+        arrives.
+
+        :param arxiv_ids: list of arXiv identifiers
+        :return: list with one `ArXivParser` per identifier, in the same
+            order, or `None` where arXiv has no such article
+        """
+        cache = get_response_cache()
+        records = {}
+        missing = []
+        for arxiv_id in arxiv_ids:
+            key = arxiv_key(arxiv_id)
+            if key in records or key in missing:
+                continue
+            data = cache.get('arxiv:' + key) if cache is not None else None
+            if data is not None:
+                from xml.etree import ElementTree
+                record = cls()
+                record.url = ARXIV_API + '?id_list=' + key
+                record.parse_entry(cls._last_entry(
+                    ElementTree.fromstring(data)))
+                records[key] = record
+            else:
+                missing.append(key)
+
+        for i in range(0, len(missing), chunk_size):
+            records.update(cls._query_chunk(missing[i:i + chunk_size]))
+
+        return [records.get(arxiv_key(a)) for a in arxiv_ids]
+
+    @classmethod
+    def _query_chunk(cls, keys):
+        """Query `keys`, bisecting the chunk when arXiv rejects it, with an
+        error entry or a 4xx status (one malformed identifier spoils the
+        whole query).
+        """
+        found = cls._query(keys)
+        if found is None and len(keys) > 1:
+            half = len(keys) // 2
+            found = cls._query_chunk(keys[:half])
+            found.update(cls._query_chunk(keys[half:]))
+        return found or {}
+
+    @classmethod
+    def _query(cls, keys):
+        """Run one multi-ID API query, parsing entries as they stream in.
+
+        :return: dict of arXiv key -> `ArXivParser`, or `None` if arXiv
+            answered with an error entry or rejected the query (4xx status
+            other than a timeout or rate limit)
+        """
+        from xml.etree import ElementTree
+        url = ARXIV_API + '?' + urllib.parse.urlencode(
+            {'id_list': ','.join(keys), 'max_results': len(keys)},
+            safe=',/')
+        cache = get_response_cache()
+        parser = ElementTree.XMLPullParser(events=('end',))
+        records = {}
+        error = False
+        try:
+            # closed even when the feed does not parse
+            with get_http_client().request('GET', url) as response:
+                for chunk in response.iter_content():
+                    parser.feed(chunk)
+                    for event, elem in parser.read_events():
+                        if elem.tag != ATOM_NS + 'entry':
+                            continue
+                        entry_id = elem.findtext(ATOM_NS + 'id') or ''
+                        if 'abs/' not in entry_id:
+                            error = True
+                            continue
+                        key = arxiv_key(entry_id.split('abs/')[-1])
+                        record = cls()
+                        record.url = url
+                        record.parse_entry(elem)
+                        records[key] = record
+                        if cache is not None:
+                            cache.put('arxiv:' + key,
+                                      ElementTree.tostring(elem), url)
+                        # entries are not needed once parsed
+                        elem.clear()
+                parser.close()
+        except urllib.error.HTTPError as err:
+            if 400 <= err.code < 500 and err.code not in (408, 429):
+                logging.debug("ArXivParser query rejected (%d) at %s",
+                              err.code, url)
+                return None
+            logging.debug("ArXivParser failed on URL: %s", url)
+            raise ArXivException(err)
+        except (urllib.error.URLError, ElementTree.ParseError) as err:
+            logging.debug("ArXivParser failed on URL: %s", url)
+            raise ArXivException(err)
+        logging.debug("ArXivParser found %d of %d entries at %s",
+                      len(records), len(keys), url)
+        if error and not records:
+            return None
+        return records
+
+    @staticmethod
+    def _last_entry(xml):
+        """The article entry of a feed (or `xml` itself if an entry)"""
+        if xml.tag == ATOM_NS + 'entry':
+            return xml
+        return list(xml)[-1]  # last item is article
+
     def parse(self, xml):
+        """Parse the article info out of an arXiv API feed"""
+        return self._entry_info(self._last_entry(xml))
+
+    def parse_entry(self, entry):
+        """Parse a single Atom ``<entry>`` element into this record"""
+        self.info = self._entry_info(entry)
+        self.bib = self.bibtex(self.info)
+
+    def _entry_info(self, entry):
         # recursive xml -> list of (tag, info)
         getc = lambda e: [
-            (c.tag.split('}')[-1], c.getchildren() and
+            (c.tag.split('}')[-1], len(c) and
                 dict(getc(c)) or (c.text is not None and re.sub('\s+', ' ',
                                   c.text.strip()) or c.attrib))
-            for c in e.getchildren()]
+            for c in e]
 
         # article info
         info = {}
-        for k, v in getc(xml.getchildren()[-1]):  # last item is article
+        for k, v in getc(entry):
             if isinstance(v, dict):
                 info.setdefault(k, []).append(v)
             else:
@@ -1003,29 +4863,47 @@ class ArXivParser(object):
             ['{%s}, %s' % (a['name'].split()[-1],
                            '~'.join(a['name'].split()[:-1]))
              for a in info['author']
-             if len(a['name'].strip()) > 1]).encode('utf-8')
-        self.Title = info['title'].encode('utf-8')
-        self.Abstract = info['summary'].encode('utf-8')
-        self.AdsComment = info['comment'].replace('"', "'").encode('utf-8') \
+             if len(a['name'].strip()) > 1])
+        self.Title = info['title']
+        self.Abstract = info['summary']
+        self.AdsComment = info['comment'].replace('"', "'") \
             if 'comment' in info else ""
         self.Jornal = 'ArXiv e-prints'
         self.ArchivePrefix = 'arXiv'
         self.ArXivURL = info['id']
         self.Eprint = info['id'].split('abs/')[-1]
         self.PrimaryClass = info['primary_category'][0]['term']
+        import datetime
         self.Year, self.Month = datetime.datetime.strptime(
             info['published'],
             '%Y-%m-%dT%H:%M:%SZ').strftime('%Y %b').split()
 
+    def to_bibtex(self):
+        """:return: a :class:`BibTex` instance with the ADS-style fields"""
+        info = {'author': '{%s}' % self.Author,
+                'title': '"{%s}"' % self.Title,
+                'journal': '{%s}' % self.Jornal,
+                'archivePrefix': '"%s"' % self.ArchivePrefix,
+                'eprint': '{%s}' % self.Eprint,
+                'primaryClass': '"%s"' % self.PrimaryClass,
+                'year': self.Year,
+                'month': self.Month.lower()}
+        if getattr(self, 'AdsURL', None):
+            info['adsurl'] = '{%s}' % self.AdsURL
+        info['arxivurl'] = '"%s"' % self.ArXivURL
+        if self.AdsComment:
+            info['adscomment'] = '"%s"' % self.AdsComment
+        return BibTex.from_fields('ARTICLE', self.Eprint, info)
+
     def __str__(self):
         import string
         return '@article{%s,\n' % self.Eprint +\
             '\n'.join([
                 '%s = {%s},' % (k, v)
                 for k, v in
-                sorted([(k, v.decode('utf-8'))
+                sorted([(k, v)
                         for k, v in self.__dict__.items()
-                        if k[0] in string.uppercase])]) +\
+                        if k[0] in string.ascii_uppercase])]) +\
             '}'
 
 
@@ -1051,8 +4929,8 @@ class MNRASParser(HTMLParser):
         try:
             # Detect and decode page's charset
             logging.debug("Parsing MNRAS url %s" % url)
-            connection = urllib.request.urlopen(url)
-            encoding = connection.headers.getparam('charset')
+            connection = get_http_client().request('GET', url)
+            encoding = connection.headers.get_content_charset()
             if encoding is not None:
                 logging.debug("Detected MNRAS encoding %s" % encoding)
                 page = connection.read().decode(encoding)
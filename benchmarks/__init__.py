@@ -0,0 +1,5 @@
+"""
+Benchmarks of adspaste and the local ADS/arXiv stand-in server they
+replay fixtures from (see :mod:`benchmarks.suite` and
+:mod:`benchmarks.fixtures`). Not installed; run from a source checkout.
+"""
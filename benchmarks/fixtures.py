@@ -0,0 +1,608 @@
+"""
+Local stand-in for the ADS and arXiv servers, for the benchmarks and tests
+
+Run it in the foreground with::
+
+    python -m benchmarks.fixtures [HOST:]PORT [--fixtures FILE] [--fault ...]
+
+and point ``ads_mirror`` at it.
+"""
+import logging
+import re
+import time
+import urllib.parse
+import zlib
+
+import adspaste
+
+
+class FixtureRecorder(object):
+    """Appends HTTP responses to a JSON Lines fixture file that
+    :class:`FixtureServer` can replay (see ``adspaste --record-fixtures``).
+    """
+    def __init__(self, path):
+        import threading
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, url, status, headers, body):
+        import base64
+        import json
+        parts = urllib.parse.urlsplit(url)
+        target = parts.path + ('?' + parts.query if parts.query else '')
+        line = json.dumps({'host': parts.netloc, 'target': target,
+                           'status': status,
+                           'content_type': headers.get('Content-Type'),
+                           'body': base64.b64encode(body).decode('ascii')})
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+def load_fixtures(path):
+    """Read a fixture file written by :class:`FixtureRecorder`.
+
+    :return: dict of request target -> (status, headers, body)
+    """
+    import base64
+    import json
+    fixtures = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            headers = {'Content-Type': record.get('content_type') or
+                       'text/html'}
+            fixtures[record['target']] = (
+                record['status'], headers, base64.b64decode(record['body']))
+    return fixtures
+
+
+def fixture_bibcode(token):
+    """The bibcode the synthetic fixtures give to an article token"""
+    kind, value = adspaste.classify_token(token)
+    if kind == 'bibcode':
+        return value
+    import zlib
+    digest = zlib.crc32(value.encode('utf-8'))
+    if kind == 'arxiv':
+        return ('20%sarXiv%s' % (value[:2], value) + 'N')[:19].ljust(19, '.')
+    return '%04dApJ...%03d..%03dS' % (2000 + digest % 25, digest % 1000,
+                                       digest // 1000 % 1000)
+
+
+def latency_distribution(spec, rng=None):
+    """Parse a latency distribution (in milliseconds) such as
+    ``fixed:20``, ``uniform:10:100``, ``exponential:50`` or
+    ``lognormal:50:0.5`` (median and sigma).
+
+    :return: callable returning a delay in seconds
+    """
+    import math
+    import random
+    rng = rng or random.Random()
+    name, _, args = spec.partition(':')
+    try:
+        args = [float(a) for a in args.split(':')] if args else []
+        if name == 'fixed':
+            delay, = args
+            return lambda: delay / 1e3
+        if name == 'uniform':
+            low, high = args
+            return lambda: rng.uniform(low, high) / 1e3
+        if name == 'exponential':
+            mean, = args
+            return lambda: rng.expovariate(1. / mean) / 1e3
+        if name == 'lognormal':
+            median, sigma = args
+            return lambda: rng.lognormvariate(math.log(median), sigma) / 1e3
+    except ValueError:
+        pass
+    raise ValueError("invalid latency distribution %r" % spec)
+
+
+def parse_faults(faults):
+    """Turn `--fault NAME=VALUE` options into :class:`FixtureServer`
+    keyword arguments"""
+    kwargs = {}
+    for fault in faults or ():
+        name, _, value = fault.partition('=')
+        name = name.strip().replace('-', '_')
+        if name == 'latency':
+            kwargs['latency'] = value
+        elif name == 'rate_limit':
+            rate, _, burst = value.partition(':')
+            kwargs['rate_limit'] = float(rate)
+            if burst:
+                kwargs['burst'] = int(burst)
+        elif name == 'seed':
+            kwargs['seed'] = int(value)
+        elif name in ('not_found', 'error', 'timeout', 'redirect'):
+            kwargs[name + '_rate'] = float(value)
+        else:
+            raise ValueError("unknown fault %r" % fault)
+    return kwargs
+
+
+class FixtureServer(object):
+    """Local HTTP server standing in for ADS and arXiv.
+
+    Requests are answered from recorded `fixtures` (a dict of request
+    target -> (status, headers, body), see :func:`load_fixtures`) and
+    otherwise from synthetic fixtures generated for any bibcode, DOI or
+    arXiv identifier: ADS abstract pages, BibTeX exports, link gateway
+    redirects, arXiv API feeds, PDFs, bulk exports (``POST
+    /v1/export/bibtex``, at most `export_limit` bibcodes) and identifier
+    searches (``GET /v1/search/query``). Links in the bodies point back
+    to the server, which runs an asyncio loop in a background thread so
+    thousands of connections can be held open at once. The bibcodes in
+    `missing` are unknown: their pages answer 404 and exports leave
+    them out.
+
+    Faults can be injected for load tests: every request is delayed by
+    a `latency` distribution (see :func:`latency_distribution`), a
+    share of them answer 404 (`not_found_rate`) or 503 (`error_rate`),
+    hang and drop the connection (`timeout_rate`, after `hang` seconds)
+    or are redirected once (`redirect_rate`). With `rate_limit`,
+    requests beyond that many per second (with bursts up to `burst`)
+    get a 429 with a Retry-After header.
+    """
+    def __init__(self, fixtures=None, host='127.0.0.1', port=0,
+                 latency=None, not_found_rate=0., error_rate=0.,
+                 timeout_rate=0., redirect_rate=0., rate_limit=None,
+                 burst=None, hang=60., seed=None, export_limit=2000,
+                 missing=()):
+        import random
+        self.fixtures = fixtures or {}
+        self.missing = set(missing)
+        self.export_limit = export_limit
+        self.host = host
+        self.port = port
+        self._rng = random.Random(seed)
+        if isinstance(latency, str):
+            latency = latency_distribution(latency, self._rng)
+        self.latency = latency
+        self.not_found_rate = not_found_rate
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.redirect_rate = redirect_rate
+        self.rate_limit = rate_limit
+        self.burst = burst or max(1, int(rate_limit or 1))
+        self.hang = hang
+        self._tokens = self.burst
+        self._refilled = time.time()
+        # request counts per outcome, and open connections
+        self.stats = {}
+        self.connections = 0
+        self.max_connections = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def netloc(self):
+        return '%s:%d' % (self.host, self.port)
+
+    @property
+    def url(self):
+        return 'http://' + self.netloc
+
+    def start(self):
+        """Start serving in a background thread"""
+        import asyncio
+        import threading
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.host, self.port,
+                                         backlog=4096))
+                self.port = self._server.sockets[0].getsockname()[1]
+            except OSError as err:
+                errors.append(err)
+                return
+            finally:
+                started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='FixtureServer')
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            raise errors[0]
+        logging.debug("FixtureServer listening on %s", self.url)
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+
+        def shutdown():
+            self._server.close()
+            self._loop.stop()
+
+        import asyncio
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join()
+        # let open connections unwind
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+
+        async def unwind():
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self._loop.run_until_complete(unwind())
+        self._loop.close()
+        self._loop = None
+
+    def serve_forever(self):
+        """Serve (starting if needed) and block until interrupted"""
+        if self._loop is None:
+            self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    async def _handle(self, reader, writer):
+        """Serve the requests of one (keep-alive) connection"""
+        import asyncio
+        import http.client
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(
+                        int(headers['content-length']))
+                response = await self.respond(method, target, headers, body)
+                if response is None:
+                    # drop the connection without answering
+                    self._count('dropped')
+                    break
+                status, response_headers, payload = response
+                self._count(status)
+                keep_alive = version == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                head = ['HTTP/1.1 %d %s' % (
+                    status, http.client.responses.get(status, ''))]
+                response_headers = dict(response_headers)
+                response_headers['Content-Length'] = str(len(payload))
+                if not keep_alive:
+                    response_headers['Connection'] = 'close'
+                head += ['%s: %s' % item for item in response_headers.items()]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n')
+                             .encode('latin-1'))
+                if method != 'HEAD':
+                    writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+            try:
+                # collects a reset, which would otherwise be logged
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    def _count(self, outcome):
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def _take_token(self):
+        """:return: whether the request fits the rate limit"""
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def respond(self, method, target, headers, body):
+        """:return: (status, headers, body) for a request, after the
+        injected faults, or None to drop the connection"""
+        import asyncio
+        import math
+        html = {'Content-Type': 'text/html; charset=utf-8'}
+        # second leg of an injected redirect
+        redirected = target.startswith('/_hop/')
+        if redirected:
+            target = target[len('/_hop'):]
+        if self.rate_limit and not self._take_token():
+            retry_after = max(1, int(math.ceil(
+                (1 - self._tokens) / self.rate_limit)))
+            return 429, dict(html, **{'Retry-After': str(retry_after)}), \
+                b'<html><body>Too Many Requests</body></html>'
+        if self.latency is not None:
+            await asyncio.sleep(self.latency())
+        roll = self._rng.random()
+        for rate, fault in ((self.timeout_rate, 'timeout'),
+                            (self.error_rate, 'error'),
+                            (self.not_found_rate, 'not_found'),
+                            (self.redirect_rate, 'redirect')):
+            if roll < rate:
+                break
+            roll -= rate
+        else:
+            fault = None
+        if fault == 'timeout':
+            await asyncio.sleep(self.hang)
+            return None
+        if fault == 'error':
+            return 503, html, b'<html><body>Service Unavailable</body></html>'
+        if fault == 'not_found':
+            return 404, html, b'<html><body>Not Found</body></html>'
+        if fault == 'redirect' and not redirected:
+            return 302, {'Location': self.url + '/_hop' + target}, b''
+        return self.serve(method, target, body)
+
+    def serve(self, method, target, body=b''):
+        """:return: (status, headers, body) for a request, from the
+        recorded fixtures if there is one"""
+        if target in self.fixtures:
+            status, response_headers, payload = self.fixtures[target]
+            return status, response_headers, self._rehost(payload)
+        return self.synthetic_response(method, target, body)
+
+    def _rehost(self, payload):
+        """Point links in recorded bodies back to this server"""
+        for host in adspaste.ADS_MIRRORS + adspaste.ARXIV_HOSTS:
+            for scheme in (b'http://', b'https://'):
+                payload = payload.replace(scheme + host.encode('ascii'),
+                                          self.url.encode('ascii'))
+        return payload
+
+    def synthetic_response(self, method, target, body=b''):
+        """:return: (status, headers, body) generated for `target`"""
+        parts = urllib.parse.urlsplit(target)
+        path = urllib.parse.unquote(parts.path)
+        query = urllib.parse.parse_qs(parts.query)
+        html = {'Content-Type': 'text/html; charset=utf-8'}
+        if self.missing & set([path[5:]] + query.get('bibcode', [])):
+            return 404, html, b'<html><body>Not Found</body></html>'
+        if path.startswith('/abs/') or path.startswith('/doi/'):
+            token = path[5:]
+            return 200, html, self._abstract_page(token)
+        if path == '/cgi-bin/bib_query' and \
+                parts.query.lower().startswith('arxiv:'):
+            return 200, html, self._abstract_page(parts.query[6:])
+        if path == '/cgi-bin/nph-bib_query' and 'bibcode' in query:
+            return 200, {'Content-Type': 'text/plain; charset=utf-8'}, \
+                self._bibtex(query['bibcode'][0])
+        if path == '/cgi-bin/nph-data_query' and 'bibcode' in query:
+            link_type = query.get('link_type', [''])[0].upper()
+            bibcode = query['bibcode'][0]
+            if link_type == 'PREPRINT':
+                # a distinct host name for the arXiv "mirror"
+                location = 'http://localhost:%d/arxiv/abs/%s' % (
+                    self.port, bibcode[9:18].strip('.'))
+            else:
+                location = self.url + '/pdf/%s.pdf' % bibcode
+            return 302, {'Location': location}, b''
+        if path.startswith('/arxiv/abs/'):
+            return 200, html, b'<html><body>arXiv</body></html>'
+        if path.startswith('/pdf/') or path.startswith('/arxiv/pdf/'):
+            return 200, {'Content-Type': 'application/pdf'}, self._pdf(path)
+        if path.endswith('/api/query') and 'id_list' in query:
+            return 200, {'Content-Type': 'application/atom+xml'}, \
+                self._feed(query['id_list'][0].split(','))
+        if path.endswith('/export/bibtex') and method == 'POST':
+            return self._export(body)
+        if path.endswith('/search/query') and 'q' in query:
+            return self._search(query['q'][0])
+        return 404, html, b'<html><body>Not Found</body></html>'
+
+    def _abstract_page(self, token, references=200):
+        """A classic ADS abstract page, with a long reference list"""
+        bibcode = fixture_bibcode(token)
+        kind, value = adspaste.classify_token(token)
+        arxiv_id = value if kind == 'arxiv' else '1406.%05d' % (
+            zlib.crc32(bibcode.encode('ascii')) % 100000)
+        link = self.url + '/cgi-bin/nph-data_query?bibcode=%s&amp;' \
+            'link_type=%s&amp;db_key=AST&amp;high='
+        quoted = urllib.parse.quote(bibcode, safe='')
+        rows = ['<tr><td><a href="%s">%s</a></td></tr>'
+                % (link % (quoted, t), t) for t in ('ARTICLE', 'PREPRINT',
+                                                  'EJOURNAL', 'REFERENCES')]
+        rows.append('<tr><td><a href="%s/cgi-bin/nph-bib_query?bibcode=%s'
+                    '&amp;data_type=BIBTEX&amp;db_key=AST&amp;'
+                    'nocookieset=1">Bibtex entry for this abstract</a>'
+                    '</td></tr>' % (self.url, quoted))
+        refs = ['<tr><td><a href="%s">%04dApJ...%03d..%03dR</a> '
+                'Reference %d, with &alpha; and <i>markup</i></td></tr>'
+                % (link % ('%04dApJ...%03d..%03dR' % (1990 + i % 30, i % 1000,
+                                                      i % 1000), 'ABSTRACT'),
+                   1990 + i % 30, i % 1000, i % 1000, i)
+                for i in range(references)]
+        return ('<html><head><title>ADS %s</title>\n'
+                '<script>var broken = "<head>";</script></head><body>\n'
+                '<table>%s</table>\n'
+                '<table><tr><td align="left" valign="top"><b>Title:</b>'
+                '</td><td>On the efficiency of jet production</td></tr>\n'
+                '<tr><td align="left" valign="top"><b>Comment:</b></td>'
+                '<td align="left" valign="top">12 pages, 3 figures</td></tr>'
+                '\n<tr><td>Eprint:</td><td>arXiv:%s</td></tr></table>\n'
+                '<h3 align="center">Abstract</h3>\n'
+                'The mechanisms that produce and power relativistic jets are '
+                'fundamental open questions in black hole (BH) astrophysics. '
+                'We obtain &eta; &asymp; 100-300 per cent.\n<hr>\n'
+                '<h3>References</h3><table>%s</table>\n'
+                '</body></html>\n' % (bibcode, '\n'.join(rows), arxiv_id,
+                                      '\n'.join(refs))).encode('utf-8')
+
+    def _export(self, body):
+        """Answer a bulk export request like the ADS API does: unknown
+        bibcodes are left out"""
+        import json
+        try:
+            bibcodes = json.loads(body.decode('utf-8'))['bibcode']
+        except (ValueError, KeyError, TypeError):
+            return 400, {'Content-Type': 'application/json'}, \
+                b'{"error": "no bibcodes"}'
+        if len(bibcodes) > self.export_limit:
+            return 400, {'Content-Type': 'application/json'}, \
+                b'{"error": "too many bibcodes"}'
+        entries = [self._bibtex(bibcode, header=False).decode('utf-8')
+                   for bibcode in bibcodes
+                   if adspaste.BIBCODE_RE.match(bibcode)
+                   and bibcode not in self.missing]
+        return 200, {'Content-Type': 'application/json'}, json.dumps({
+            'msg': 'Retrieved %d abstracts, starting with number 1.'
+                   % len(entries),
+            'export': ''.join(entries)}).encode('utf-8')
+
+    def _search(self, q):
+        """Answer an identifier search like the ADS API does; half of the
+        pre-prints have been published, in a refereed journal"""
+        import json
+        docs = []
+        for arxiv_id in re.findall(r'arXiv:([^"\s)]+)', q):
+            digest = zlib.crc32(arxiv_id.encode('utf-8'))
+            preprint = fixture_bibcode('arXiv:' + arxiv_id)
+            if digest % 2:
+                docs.append({'bibcode': preprint,
+                             'identifier': [preprint, 'arXiv:' + arxiv_id],
+                             'property': ['EPRINT_OPENACCESS',
+                                          'NOT REFEREED']})
+            else:
+                docs.append({'bibcode': '%04dMNRAS.%03d..%03dP' % (
+                    2000 + digest % 25, digest % 1000,
+                    digest // 1000 % 1000),
+                    'identifier': [preprint, 'arXiv:' + arxiv_id],
+                    'property': ['ARTICLE', 'REFEREED']})
+        return 200, {'Content-Type': 'application/json'}, json.dumps({
+            'response': {'numFound': len(docs), 'docs': docs}}).encode(
+                'utf-8')
+
+    def _bibtex(self, bibcode, header=True):
+        return (('Query Results from the ADS Database\n\n\n'
+                 'Retrieved 1 abstracts, starting with number 1.  '
+                 'Total number selected: 1.\n\n' if header else '') +
+                '@ARTICLE{%s,\n'
+                '   author = {{Nemmen}, R.~S. and {Tchekhovskoy}, A.},\n'
+                '    title = "{On the efficiency of jet production in '
+                'radio galaxies}",\n'
+                '  journal = {\\mnras},\n'
+                'archivePrefix = "arXiv",\n'
+                '   eprint = {1406.7420},\n'
+                ' primaryClass = "astro-ph.HE",\n'
+                ' keywords = {accretion, accretion discs, black hole '
+                'physics},\n'
+                '     year = %s,\n'
+                '    month = may,\n'
+                '   volume = 449,\n'
+                '    pages = {316-327},\n'
+                '      doi = {10.1093/mnras/stv260},\n'
+                '   adsurl = {http://adsabs.harvard.edu/abs/%s},\n'
+                '  adsnote = {Provided by the SAO/NASA Astrophysics Data '
+                'System}\n}\n\n' % (bibcode, bibcode[:4], bibcode)
+                ).encode('utf-8')
+
+    def _feed(self, arxiv_ids):
+        entries = [
+            '<entry><id>http://arxiv.org/abs/%sv1</id>'
+            '<published>2014-06-28T14:11:22Z</published>'
+            '<title>On the efficiency of jet production</title>'
+            '<summary>The mechanisms that produce and power relativistic '
+            'jets.</summary>'
+            '<author><name>Rodrigo Nemmen</name></author>'
+            '<author><name>Alexander Tchekhovskoy</name></author>'
+            '<arxiv:comment>12 pages</arxiv:comment>'
+            '<link href="http://arxiv.org/abs/%sv1" rel="alternate"/>'
+            '<link title="pdf" href="%s/arxiv/pdf/%sv1" rel="related"/>'
+            '<arxiv:primary_category term="astro-ph.HE"/>'
+            '</entry>' % (i, i, self.url, i) for i in arxiv_ids]
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom" '
+                'xmlns:arxiv="http://arxiv.org/schemas/atom">'
+                '<title>arXiv Query</title>%s</feed>'
+                % ''.join(entries)).encode('utf-8')
+
+    def _pdf(self, path):
+        return (b'%PDF-1.4\n% adspaste fixture ' + path.encode('utf-8') +
+                b'\n' + b'0' * 4096 + b'\n%%EOF\n')
+
+
+def main(argv=None):
+    """Run a :class:`FixtureServer` in the foreground"""
+    import optparse
+    parser = optparse.OptionParser(
+        prog='python -m benchmarks.fixtures',
+        usage="%prog [options] [HOST:]PORT")
+    parser.add_option(
+        '--fixtures',
+        dest='fixtures', default=None, metavar='FILE',
+        help="Recorded responses to replay (see adspaste"
+             " --record-fixtures).")
+    parser.add_option(
+        '--fault',
+        dest='faults', default=[], action='append', metavar='NAME=VALUE',
+        help="Fault to inject, may be repeated:"
+             " latency=fixed:MS|uniform:MIN:MAX|exponential:MEAN"
+             "|lognormal:MEDIAN:SIGMA, not_found=RATE, error=RATE,"
+             " timeout=RATE, redirect=RATE, rate_limit=PER_SECOND[:BURST],"
+             " seed=N.")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('expected the [HOST:]PORT to listen on')
+    host, _, port = args[0].rpartition(':')
+    try:
+        faults = parse_faults(options.faults)
+    except ValueError as err:
+        parser.error('--fault: %s' % err)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        # allow as many concurrent connections as the system permits
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    fixtures = load_fixtures(options.fixtures) if options.fixtures else {}
+    server = FixtureServer(fixtures, host=host or '127.0.0.1',
+                           port=int(port), **faults)
+    server.start()
+    logging.info("Serving ADS and arXiv fixtures on %s (ads_mirror %s,"
+                 " arXiv API %s/api/query)", server.url, server.netloc,
+                 server.url)
+    try:
+        server.serve_forever()
+    finally:
+        logging.info("Served %s", ', '.join(
+            '%s: %d' % item for item in sorted(server.stats.items())))
+
+
+if __name__ == '__main__':
+    main()
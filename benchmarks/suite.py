@@ -0,0 +1,453 @@
+"""
+Benchmarks of adspaste, run from a source checkout with::
+
+    python -m benchmarks [options] NAME
+
+or ``adspaste --benchmark NAME [-- options]``. The results are printed
+as JSON; see ``python -m benchmarks --help`` for the options.
+"""
+import logging
+import os
+import sys
+import time
+
+import adspaste
+from benchmarks.fixtures import (FixtureServer, fixture_bibcode,
+                                 load_fixtures, parse_faults)
+
+
+def run_benchmark(name, options, prefs):
+    """Run the benchmark called `name` and print its results as JSON.
+
+    Results are also saved to `--output`, and compared with
+    the results in `--compare`: the exit status is 1 if any
+    stage got more than 20% slower, or if the benchmark itself did not
+    pass (like a start-up over budget).
+    """
+    import datetime
+    import json
+    logging.info("Running benchmark %s", name)
+    results = BENCHMARKS[name](options, prefs)
+    results.update({'benchmark': name, 'version': adspaste.VERSION,
+                    'python': sys.version.split()[0],
+                    'date': datetime.datetime.now().isoformat()})
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare_benchmarks(json.load(f), results)
+        if regressions:
+            sys.exit(1)
+    if results.get('passed') is False:
+        sys.exit(1)
+    return results
+
+
+def compare_benchmarks(old, new, tolerance=0.2):
+    """Log how the stages of two benchmark results compare.
+
+    Stages are compared on their median latency; a stage whose median
+    grew by more than `tolerance` is a regression.
+
+    :return: list of the regressed stage names
+    """
+    regressions = []
+    old_stages = old.get('stages', {})
+    for stage, stats in sorted(new.get('stages', {}).items()):
+        if stage not in old_stages or not old_stages[stage].get('p50'):
+            continue
+        ratio = stats['p50'] / old_stages[stage]['p50']
+        logging.info("%-20s p50 %9.3f ms -> %9.3f ms (x%.2f)"
+                     % (stage, old_stages[stage]['p50'] * 1e3,
+                        stats['p50'] * 1e3, ratio))
+        if ratio > 1 + tolerance:
+            logging.warning("Stage %s regressed (x%.2f)" % (stage, ratio))
+            regressions.append(stage)
+    return regressions
+
+
+def latency_stats(samples, elapsed=None):
+    """:return: count, mean and p50/p95/p99 of `samples` (in seconds),
+    and the throughput if the wall-clock `elapsed` time is given"""
+    import math
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(p):
+        # nearest rank
+        return samples[max(0, int(math.ceil(p / 100. * len(samples))) - 1)]
+
+    total = sum(samples)
+    if elapsed is None:
+        elapsed = total
+    return {'count': len(samples),
+            'mean': total / len(samples),
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'per_second': len(samples) / elapsed if elapsed else None}
+
+
+def _token_corpus(n, seed=0):
+    """:return: `n` synthetic (token, expected kind) pairs covering every
+    token form that :func:`classify_token` knows about"""
+    import random
+    rng = random.Random(seed)
+    journals = ['ApJ..', 'MNRAS', 'A&A..', 'AJ...', 'PhRvD', 'Natur']
+
+    def bibcode():
+        return '%04d%s%4s%s%4s%s' % (
+            rng.randint(1900, 2025), rng.choice(journals),
+            ('.' * 4 + str(rng.randint(1, 999)))[-4:], rng.choice('.L'),
+            ('.' * 4 + str(rng.randint(1, 9999)))[-4:],
+            rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+
+    def new_arxiv():
+        return '%02d%02d.%05d' % (rng.randint(7, 25), rng.randint(1, 12),
+                                  rng.randint(0, 99999))
+
+    def old_arxiv():
+        return 'astro-ph/%02d%02d%03d' % (rng.randint(92, 99),
+                                          rng.randint(1, 12),
+                                          rng.randint(0, 999))
+
+    def doi():
+        return '10.%d/%s.%d' % (rng.randint(1000, 99999),
+                                rng.choice(['mnras', 'apj', 'aa']),
+                                rng.randint(1, 10 ** 6))
+
+    forms = [
+        lambda: (bibcode(), 'bibcode'),
+        lambda: (new_arxiv(), 'arxiv'),
+        lambda: ('arXiv:' + new_arxiv() + 'v2', 'arxiv'),
+        lambda: (old_arxiv(), 'arxiv'),
+        lambda: (doi(), 'doi'),
+        lambda: ('https://doi.org/' + doi(), 'doi'),
+        lambda: ('http://%s/abs/%s' % (rng.choice(adspaste.ADS_MIRRORS),
+                                        bibcode()), 'bibcode'),
+        lambda: ('%s/doi/%s' % (rng.choice(adspaste.ADS_MIRRORS), doi()),
+                 'doi'),
+        lambda: ('http://%s/cgi-bin/nph-data_query?link_type=ABSTRACT'
+                 % rng.choice(adspaste.ADS_MIRRORS), 'ads_url'),
+        lambda: ('https://arxiv.org/abs/' + new_arxiv(), 'arxiv'),
+        lambda: ('http://arxiv.org/pdf/' + old_arxiv() + 'v1', 'arxiv'),
+        lambda: ('http://example.com/paper', 'url'),
+    ]
+    return [rng.choice(forms)() for _ in range(n)]
+
+
+def benchmark_classify(options, prefs):
+    """Throughput and accuracy of :func:`classify_token`"""
+    corpus = _token_corpus(options.size or 100000)
+    mirrors = prefs.adsmirrors
+    start = time.time()
+    kinds = [adspaste.classify_token(token, mirrors)[0]
+             for token, _ in corpus]
+    elapsed = time.time() - start
+    wrong = [token for (token, kind), got in zip(corpus, kinds)
+             if kind != got]
+    for token in wrong[:10]:
+        logging.warning("Misclassified token %s", token)
+    return {'tokens': len(corpus),
+            'seconds': elapsed,
+            'tokens_per_second': len(corpus) / elapsed if elapsed else None,
+            'misclassified': len(wrong)}
+
+
+def _bibtex_corpus(n, seed=0):
+    """:return: a synthetic ADS BibTeX export with `n` entries"""
+    import random
+    rng = random.Random(seed)
+    words = ('accretion', 'black', 'hole', 'jet', 'galaxies', 'spin',
+             'magnetic', 'flux', 'efficiency', 'the', 'of', 'and', 'we')
+    entries = []
+    for i in range(n):
+        abstract = ' '.join(rng.choice(words) for _ in range(300))
+        entries.append(
+            '@ARTICLE{%04dMNRAS.%03d..%03dN,\n'
+            '   author = {{Nemmen}, R.~S. and {Tchekhovskoy}, A.},\n'
+            '    title = "{On the efficiency of jet production, case = %d}",\n'
+            '  journal = {\\mnras},\n'
+            'archivePrefix = "arXiv",\n'
+            '   eprint = {1406.7420},\n'
+            '     year = %d,\n'
+            '    month = may,\n'
+            '   volume = 449,\n'
+            '    pages = {316-327},\n'
+            ' abstract = "{%s, see = {eq. 1}, with $\\eta \\approx 100$}",\n'
+            '   adsurl = {http://adsabs.harvard.edu/abs/2015MNRAS.449..316N},\n'
+            '  adsnote = {Provided by the SAO/NASA Astrophysics Data System}\n'
+            '}\n' % (2000 + i % 25, i % 1000, i % 1000, i, 2000 + i % 25,
+                     abstract))
+    return '\n'.join(entries)
+
+
+def benchmark_bibtex(options, prefs):
+    """Throughput of :func:`parse_bibtex` over a multi-megabyte export,
+    checking that every entry round-trips through `BibTex.__str__`"""
+    text = _bibtex_corpus(options.size or 5000)
+    start = time.time()
+    entries = list(adspaste.BibTex.iter_entries(text))
+    elapsed = time.time() - start
+    mismatched = sum(
+        1 for entry in entries
+        if list(adspaste.parse_bibtex(str(entry))) !=
+        [(entry.type, entry.bibcode, entry.info)])
+    megabytes = len(text.encode('utf-8')) / 2. ** 20
+    return {'entries': len(entries),
+            'megabytes': megabytes,
+            'seconds': elapsed,
+            'megabytes_per_second': megabytes / elapsed if elapsed else None,
+            'entries_per_second': len(entries) / elapsed if elapsed else None,
+            'round_trip_failures': mismatched}
+
+
+def _fixture_tokens(n, seed=0):
+    """:return: `n` article tokens (bibcodes, DOIs and arXiv identifiers)
+    that the synthetic fixtures of :class:`FixtureServer` answer"""
+    import random
+    rng = random.Random(seed)
+    tokens = []
+    for i in range(n):
+        form = rng.random()
+        if form < 0.5:
+            tokens.append('%04dMNRAS.%03d..%03dN' % (2000 + i % 25, i % 1000,
+                                                    i % 1000))
+        elif form < 0.75:
+            tokens.append('10.1093/mnras/stv%d' % i)
+        else:
+            tokens.append('14%02d.%05d' % (1 + i % 12, i))
+    return tokens
+
+
+_PIPELINE_STATE = ('_response_cache', '_mirror_manager', '_paper_index',
+                   'ARXIV_API')
+
+
+def benchmark_pipeline(options, prefs):
+    """Per-stage latency of resolve -> parse -> serialize, replaying
+    fixtures from a local :class:`FixtureServer` (no network access).
+
+    Single-token stages are timed one token at a time; the batch run
+    resolves all tokens with `--jobs` workers. The BibTeX and arXiv
+    parsers are also timed offline on the fixture bodies.
+    """
+    fixtures = load_fixtures(options.fixtures) if options.fixtures else {}
+    server = FixtureServer(fixtures, **parse_faults(options.faults))
+    server.start()
+    saved = dict((name, getattr(adspaste, name)) for name in _PIPELINE_STATE)
+    saved_mirror = prefs['ads_mirror']
+    # measure the network path, not the cache
+    adspaste._response_cache = adspaste._mirror_manager = \
+        adspaste._paper_index = None
+    adspaste.ARXIV_API = server.url + '/api/query'
+    prefs['ads_mirror'] = server.netloc
+    tokens = _fixture_tokens(options.size or 200)
+    stages = dict((stage, []) for stage in
+                  ('resolve', 'parse', 'serialize', 'token', 'parsebib',
+                   'arxiv_parse'))
+    try:
+        errors = 0
+        for token in tokens:
+            start = time.time()
+            try:
+                connector = adspaste.ADSConnector(token, prefs)
+                resolved = time.time()
+                if not isinstance(connector.ads_read, adspaste.URLStream):
+                    raise adspaste.ADSException('no ADS abstract page')
+                ads_parser = adspaste.ADSHTMLParser(prefs=prefs)
+                ads_parser.parse(connector.ads_read)
+            except Exception as err:
+                # injected faults
+                logging.debug("Token %s failed: %s", token, err)
+                errors += 1
+                continue
+            parsed = time.time()
+            str(ads_parser.bibtex)
+            done = time.time()
+            stages['resolve'].append(resolved - start)
+            stages['parse'].append(parsed - resolved)
+            stages['serialize'].append(done - parsed)
+            stages['token'].append(done - start)
+
+        # the parsers alone, on the bodies the server would send
+        for token in tokens:
+            status, headers, body = server.synthetic_response(
+                'GET', '/cgi-bin/nph-bib_query?bibcode=%s&data_type=BIBTEX'
+                % fixture_bibcode(token))
+            text = ' '.join(l.strip() for l in body.decode('utf-8')
+                            .splitlines())
+            start = time.time()
+            adspaste.BibTex.from_fields(*adspaste.BibTex.parsebib(text))
+            stages['parsebib'].append(time.time() - start)
+            if adspaste.classify_token(token)[0] == 'arxiv':
+                from xml.etree import ElementTree
+                status, headers, body = server.synthetic_response(
+                    'GET', '/api/query?id_list=' + token)
+                start = time.time()
+                adspaste.ArXivParser().parse(ElementTree.fromstring(body))
+                stages['arxiv_parse'].append(time.time() - start)
+
+        jobs = options.jobs
+        start = time.time()
+        results = list(adspaste.resolve_tokens(tokens, prefs, jobs=jobs))
+        batch_elapsed = time.time() - start
+    finally:
+        for name, value in saved.items():
+            setattr(adspaste, name, value)
+        prefs['ads_mirror'] = saved_mirror
+        server.stop()
+
+    failed = [r.token for r in results if not r.ok]
+    for token in failed[:10]:
+        logging.warning("Batch token %s failed", token)
+    stats = dict((stage, latency_stats(samples))
+                 for stage, samples in stages.items())
+    stats['batch'] = latency_stats([r.elapsed for r in results],
+                                   elapsed=batch_elapsed)
+    return {'tokens': len(tokens),
+            'jobs': jobs,
+            'fixtures': options.fixtures or 'synthetic',
+            'batch_seconds': batch_elapsed,
+            'failures': errors,
+            'batch_failures': len(failed),
+            'stages': stats}
+
+
+def import_times(output):
+    """Parse the report of ``python -X importtime``.
+
+    :return: dict of module -> (self, cumulative) import time in
+        microseconds
+    """
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times[fields[2].strip()] = (int(fields[0]), int(fields[1]))
+        except (IndexError, ValueError):
+            continue  # the header line
+    return times
+
+
+def benchmark_startup(options, prefs):
+    """Cold start cost, measured in a fresh interpreter for each run:
+    the import time of adspaste (from ``-X importtime``) and the wall
+    time of the whole process. Fails when the median import time is
+    over `--budget`; the slowest imports are listed to help.
+
+    The byte code is compiled once beforehand, into a temporary cache,
+    so that the runs time the imports rather than the compiler.
+    """
+    import subprocess
+    import tempfile
+    runs = options.size or 10
+    here = os.path.dirname(os.path.abspath(adspaste.__file__))
+    imports = []
+    processes = []
+    own_times = {}
+    with tempfile.TemporaryDirectory() as pycache:
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        for run in range(runs + 1):
+            start = time.time()
+            proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c',
+                 'import adspaste'],
+                cwd=here, env=env, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+            if not run:
+                continue  # compiled the byte code
+            processes.append(time.time() - start)
+            times = import_times(proc.stderr)
+            imports.append(times['adspaste'][1] / 1e6)
+            for module, (own, total) in times.items():
+                own_times[module] = own_times.get(module, 0) + own
+    stats = {'import': latency_stats(imports),
+             'process': latency_stats(processes)}
+    passed = stats['import']['p50'] * 1e3 <= options.startup_budget
+    if not passed:
+        logging.error("Importing adspaste takes %.1f ms, over the %.1f ms "
+                      "budget" % (stats['import']['p50'] * 1e3,
+                                  options.startup_budget))
+    slowest = sorted(own_times.items(), key=lambda item: -item[1])[:10]
+    return {'runs': runs,
+            'budget_ms': options.startup_budget,
+            'passed': passed,
+            'slowest_imports': [{'module': module,
+                                 'self_ms': total / runs / 1e3}
+                                for module, total in slowest],
+            'stages': stats}
+
+
+BENCHMARKS = {'classify': benchmark_classify,
+              'bibtex': benchmark_bibtex,
+              'pipeline': benchmark_pipeline,
+              'startup': benchmark_startup}
+
+
+def main(argv=None, prefs=None):
+    """Parse the benchmark options in `argv` and run the benchmark.
+
+    `prefs` are those of an ``adspaste --benchmark`` run; by default
+    they are read from ~/.adsbibdesk.
+    """
+    import optparse
+    parser = optparse.OptionParser(
+        prog='python -m benchmarks', usage="%prog [options] NAME",
+        description="Run a benchmark and print the results as JSON"
+                    " (NAME is one of: %s)." % ', '.join(sorted(BENCHMARKS)))
+    parser.add_option(
+        '--size',
+        dest='size', default=None, type='int', metavar='N',
+        help="Size of the benchmark corpus.")
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs', default=4, type='int', metavar='N',
+        help="Workers of the pipeline batch run (default 4).")
+    parser.add_option(
+        '--budget',
+        dest='startup_budget', default=60., type='float', metavar='MS',
+        help="Import time allowed by the startup benchmark before it fails"
+             " (default 60 ms).")
+    parser.add_option(
+        '--output',
+        dest='output', default=None, metavar='FILE',
+        help="Also write the results as JSON to FILE.")
+    parser.add_option(
+        '--compare',
+        dest='compare', default=None, metavar='FILE',
+        help="Compare with earlier results saved with --output;"
+             " exits with status 1 on a regression.")
+    parser.add_option(
+        '--fixtures',
+        dest='fixtures', default=None, metavar='FILE',
+        help="Recorded responses replayed by the pipeline benchmark"
+             " (see adspaste --record-fixtures).")
+    parser.add_option(
+        '--fault',
+        dest='faults', default=[], action='append', metavar='NAME=VALUE',
+        help="Fault injected by the stand-in server of the pipeline"
+             " benchmark, may be repeated (see python -m"
+             " benchmarks.fixtures --help).")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error('expected one benchmark NAME out of: %s'
+                     % ', '.join(sorted(BENCHMARKS)))
+    try:
+        parse_faults(options.faults)
+    except ValueError as err:
+        parser.error('--fault: %s' % err)
+    if prefs is None:
+        logging.basicConfig(level=logging.INFO)
+        prefs = adspaste.Preferences()
+    # also when called from ``python adspaste.py``, whose module is
+    # __main__ rather than adspaste
+    adspaste.configure_http(prefs)
+    adspaste.configure_arxiv_mirrors(prefs)
+    return run_benchmark(args[0], options, prefs)
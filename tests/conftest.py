@@ -0,0 +1,53 @@
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import adspaste  # noqa: E402
+from benchmarks.fixtures import FixtureServer  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    """A local ADS/arXiv stand-in, see :class:`FixtureServer`"""
+    server = FixtureServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def dead_netloc():
+    """host:port where nothing listens, so connections are refused"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    netloc = '127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return netloc
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """Start every test without the process-wide cache, mirrors, index
+    or HTTP client of an earlier one"""
+    for name in ('_response_cache', '_mirror_manager', '_paper_index',
+                 '_http_client'):
+        monkeypatch.setattr(adspaste, name, None)
+
+
+@pytest.fixture
+def prefs(server, tmp_path, monkeypatch):
+    """Default :class:`Preferences` pointing ADS at the `server`"""
+    monkeypatch.setenv('ADSPASTE_PREFS', str(tmp_path / 'adsbibdesk'))
+    for name in list(os.environ):
+        if name.startswith('ADSPASTE_') and name != 'ADSPASTE_PREFS':
+            monkeypatch.delenv(name)
+    return adspaste.Preferences({
+        'ads_mirror': server.netloc,
+        'ads_export_url': server.url + '/v1/export/bibtex',
+        'ads_search_url': server.url + '/v1/search/query',
+        'ads_token': 'test-token',
+        'download_pdf': False})
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+import adspaste
+
+ARXIV_IDS = ['1406.7420', '1501.00001', 'astro-ph/9901001']
+
+
+@pytest.fixture
+def arxiv_api(server, monkeypatch):
+    monkeypatch.setattr(adspaste, 'ARXIV_API', server.url + '/api/query')
+    return server
+
+
+def test_batch_only_fetches_unresolved_ids(arxiv_api, monkeypatch):
+    queries = []
+    parse_at_ids = adspaste.ArXivParser.parse_at_ids
+
+    def spy(arxiv_ids):
+        queries.append(list(arxiv_ids))
+        return parse_at_ids(arxiv_ids)
+
+    monkeypatch.setattr(adspaste.ArXivParser, 'parse_at_ids', spy)
+    batch = adspaste.ArXivBatch(ARXIV_IDS)
+    batch.resolved('1406.7420v2')
+    record = batch.get('1501.00001')
+    assert record is not None
+    assert adspaste.arxiv_key(record.Eprint) == '1501.00001'
+    assert batch.get('astro-ph/9901001') is not None
+    assert batch.get('0704.0001') is None
+    assert queries == [['1501.00001', 'astro-ph/9901001']]
+
+
+def test_query_closes_response_on_parse_error(arxiv_api):
+    arxiv_api.fixtures['/api/query?id_list=1406.7420&max_results=1'] = (
+        200, {'Content-Type': 'application/atom+xml'},
+        b'<feed><entry>' + b'x' * 100000 + b'</feed>' + b'x' * 100000)
+    with pytest.raises(adspaste.ArXivException):
+        adspaste.ArXivParser._query(['1406.7420'])
+    # the connection is dropped rather than left open
+    for _ in range(100):
+        if not arxiv_api.connections:
+            break
+        time.sleep(0.01)
+    assert arxiv_api.connections == 0
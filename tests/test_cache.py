@@ -0,0 +1,44 @@
+import pytest
+
+import adspaste
+
+BIBCODE = '2015MNRAS.449..316N'
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = adspaste.ResponseCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(adspaste, '_response_cache', cache)
+    return cache
+
+
+def test_prefix_is_cached_apart(server, cache):
+    url = '%s/abs/%s' % (server.url, BIBCODE)
+    with adspaste.open_url(url, partial=True) as stream:
+        prefix = next(iter(stream))
+    key = adspaste.cache_key(url)
+    assert cache.get(key) is None
+    assert cache.get(adspaste.PARTIAL_PREFIX + key) == prefix
+    assert adspaste.cache_lookup(url) is None
+    assert adspaste.cache_lookup(url, partial=True) == prefix
+
+    body = adspaste.fetch_url(url)
+    assert len(body) > len(prefix)
+    assert cache.get(key) == body
+    assert adspaste.cache_lookup(url, partial=True) == body
+
+
+@pytest.mark.parametrize('urls, key', [
+    (['http://adsabs.harvard.edu/abs/2015MNRAS.449..316N',
+      'http://cdsads.u-strasbg.fr/abs/2015MNRAS.449..316N/abstract',
+      'http://127.0.0.1:8080/abs/2015MNRAS.449..316N'],
+     'ads:bibcode:2015MNRAS.449..316N'),
+    (['http://adsabs.harvard.edu/doi/10.1093/mnras/stv260',
+      'http://esoads.eso.org/doi/10.1093/MNRAS/STV260'],
+     'ads:doi:10.1093/mnras/stv260'),
+    (['http://adsabs.harvard.edu/cgi-bin/bib_query?arXiv:1406.7420',
+      'http://ukads.nottingham.ac.uk/cgi-bin/bib_query?arXiv:1406.7420v2'],
+     'ads:arxiv:1406.7420'),
+])
+def test_cache_key_is_article_identity(urls, key):
+    assert [adspaste.cache_key(url) for url in urls] == [key] * len(urls)
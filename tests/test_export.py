@@ -0,0 +1,41 @@
+import pytest
+
+import adspaste
+
+BIBCODES = ['2015MNRAS.449..316N', '2014ApJ...796..120T',
+            '2001A&A...375..123K', '1998AJ....116.1009R',
+            '2011Natur.480...18P']
+
+
+def test_export_splits_batches_into_entries(server):
+    exporter = adspaste.ADSExporter(server.url + '/v1/export/bibtex',
+                                    limit=2)
+    entries = exporter.export(BIBCODES)
+    assert sorted(entries) == sorted(BIBCODES)
+    for bibcode, entry in entries.items():
+        assert entry.bibcode == bibcode
+        assert entry.info['year'] == bibcode[:4]
+    # five bibcodes, two per request
+    assert server.stats == {200: 3}
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_failed_export_falls_back_to_scraping(server, prefs, status):
+    server.fixtures['/v1/export/bibtex'] = (
+        status, {'Content-Type': 'text/plain'}, b'try again later')
+    results = list(adspaste.resolve_tokens(BIBCODES, prefs, bulk=True))
+    assert [r.token for r in results] == BIBCODES
+    assert all(r.ok for r in results)
+    assert [r.entry.bibcode for r in results] == BIBCODES
+    assert server.stats[status] == 1
+
+
+def test_missing_token_is_reported(server, prefs):
+    missing = BIBCODES[2]
+    server.missing.add(missing)
+    results = list(adspaste.resolve_tokens(BIBCODES, prefs, bulk=True))
+    assert [r.token for r in results] == BIBCODES
+    assert [r.ok for r in results] == [True, True, False, True, True]
+    assert results[2].error is not None
+    assert [r.entry.bibcode for r in results if r.ok] == \
+        [b for b in BIBCODES if b != missing]
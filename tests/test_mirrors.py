@@ -0,0 +1,43 @@
+import adspaste
+
+BIBCODE = '2015MNRAS.449..316N'
+
+
+def test_dead_primary_fails_over(server, dead_netloc):
+    manager = adspaste.MirrorManager([dead_netloc, server.netloc],
+                                     preferred=dead_netloc)
+    with manager.open('http://%s/abs/%s' % (dead_netloc, BIBCODE)) as stream:
+        body = stream.read()
+    assert stream.url.startswith('http://%s/' % server.netloc)
+    assert BIBCODE.encode('ascii') in body
+    assert manager.stats[dead_netloc]['last_error']
+    assert manager.stats[server.netloc]['latency'] is not None
+
+
+def test_health_state_persists(server, dead_netloc, tmp_path):
+    state_path = str(tmp_path / 'mirrors.json')
+    manager = adspaste.MirrorManager([dead_netloc, server.netloc],
+                                     preferred=dead_netloc,
+                                     state_path=state_path)
+    for _ in range(3):
+        manager.open('http://%s/abs/%s' % (dead_netloc, BIBCODE)).close()
+    manager.save()
+
+    reloaded = adspaste.MirrorManager([dead_netloc, server.netloc],
+                                      preferred=dead_netloc,
+                                      state_path=state_path)
+    assert reloaded.stats == manager.stats
+    assert not reloaded.healthy(dead_netloc)
+    assert reloaded.best() == server.netloc
+
+
+def test_cdsads_url_is_rewritten(server, monkeypatch):
+    manager = adspaste.MirrorManager(adspaste.ADS_MIRRORS,
+                                     preferred=server.netloc)
+    monkeypatch.setattr(adspaste, '_mirror_manager', manager)
+    url = 'http://cdsads.u-strasbg.fr/abs/%s' % BIBCODE
+    with adspaste.open_ads_url(url) as stream:
+        body = stream.read()
+    assert stream.url == 'http://%s/abs/%s' % (server.netloc, BIBCODE)
+    assert BIBCODE.encode('ascii') in body
+    assert 'cdsads.u-strasbg.fr' not in manager.stats
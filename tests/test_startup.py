@@ -0,0 +1,71 @@
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import adspaste
+from benchmarks.suite import benchmark_startup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIBCODE = '2015MNRAS.449..316N'
+
+# the client side of the fast path, with the clipboard left out
+CLIENT = '''
+import json
+import sys
+
+import adspaste
+
+
+class Clipboard(object):
+    def write(self, entry):
+        pass
+
+    def close(self):
+        pass
+
+
+adspaste.ClipboardSink = Clipboard
+sys.argv = ['adspaste', %r]
+adspaste.main()
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+
+def test_import_time_budget():
+    options = optparse.Values({'size': 5, 'startup_budget': 60.})
+    results = benchmark_startup(options, None)
+    assert results['passed'], results['stages']['import']
+
+
+def test_daemon_fast_path_imports(server, tmp_path):
+    env = dict(os.environ, HOME=str(tmp_path),
+               ADSPASTE_PREFS=str(tmp_path / 'adsbibdesk'),
+               ADSPASTE_ADS_MIRROR=server.netloc,
+               ADSPASTE_DOWNLOAD_PDF='no')
+    socket_path = str(tmp_path / '.adsbibdesk.sock')
+    daemon = subprocess.Popen(
+        [sys.executable, 'adspaste.py', '--daemon'], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(200):
+            if adspaste.connect_daemon(socket_path) is not None:
+                break
+            time.sleep(0.05)
+        else:
+            raise AssertionError('the daemon did not start')
+        client = subprocess.run(
+            [sys.executable, '-c', CLIENT % BIBCODE], cwd=ROOT, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, timeout=60)
+    finally:
+        assert adspaste.stop_daemon(socket_path)
+        daemon.wait(timeout=30)
+    assert '@ARTICLE{%s,' % BIBCODE in client.stdout
+    modules = json.loads(client.stderr)
+    assert 'optparse' not in modules
+    assert 'logging' not in modules
+    # resolved by the daemon, not in the client
+    assert 'http.client' not in modules
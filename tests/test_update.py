@@ -0,0 +1,29 @@
+import optparse
+import os
+import stat
+
+import adspaste
+
+PREPRINT = '''@ARTICLE{2014arXiv1406.7420N,
+   author = {{Nemmen}, R.~S. and {Tchekhovskoy}, A.},
+    title = "{On the efficiency of jet production in radio galaxies}",
+  journal = {ArXiv e-prints},
+   eprint = {1406.7420},
+     year = 2014,
+    month = jun
+}
+'''
+
+
+def test_update_keeps_library_mode(server, prefs, tmp_path):
+    path = tmp_path / 'library.bib'
+    path.write_text(PREPRINT)
+    os.chmod(str(path), 0o640)
+    prefs['arxiv_update_state'] = str(tmp_path / 'state.json')
+    options = optparse.Values({'from_date': None, 'to_date': None,
+                               'refresh': True, 'jobs': 2})
+    adspaste.update_arxiv(options, [str(path)], prefs)
+    text = path.read_text()
+    assert text.startswith('@ARTICLE{2014arXiv1406.7420N,')
+    assert 'MNRAS' in text
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o640